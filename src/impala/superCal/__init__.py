@@ -1,4 +1,5 @@
 from . import post_process
 from .impala_clust import *
 from .impala_noprobit_emu import *
+from .impala_smc import *
 from .models_withlik import *
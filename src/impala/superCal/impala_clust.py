@@ -7,16 +7,20 @@ import numpy as np
 import scipy
 from numpy.linalg import slogdet
 from numpy.random import beta, choice, gamma, uniform
-from scipy.stats import invwishart
 
 from .impala_noprobit_emu import (
     chol_sample_1per,
     chol_sample_1per_constraints,
     chol_sample_nper_constraints,
     cov_4d_pcm,
+    eval_theta,
     gamma_logpdf,
     initfunc_unif,
     invwishart_logpdf,
+    invwishart_rvs_batch,
+    lik_cov_theta,
+    lik_engines,
+    llik_theta,
     mvnorm_logpdf,  # , invgamma_logpdf
     mvnorm_logpdf_,
     tran_unif,
@@ -275,57 +279,25 @@ class AMcov_clust:
 
     def cluster_covariance_update(self, n, delta):
         # https://www.mathworks.com/help/matlab/import_export/using-mapreduce-to-compute-covariance-and-related-quantities.html
-        self.cov_clust[:] = (
-            0.0  # accumulating covariance                                                                                   #(c1)
-        )
-        self.mu_clust[:] = (
-            0.0  # accumulating mean                                                                                           #(m1)
-        )
-        self.n_hc[:] = (
-            0.0  # accumulating count                                                                                              #(n1)
-        )
-        mu_new = np.empty((self.ntemps, self.cov_clust.shape[-1]))  # (m)
-        n_new = np.zeros((self.ntemps, 1))  # (n)
-        for i in range(self.nexp):  # loop over unvectorized experiments
-            for j in range(
-                delta[i].shape[1]
-            ):  # loop over vectorized experiments
-                n_new[:] = (
-                    self.n_hc[self.temps, delta[i].T[j], None] + n
-                )  # (n=n1+n2)
-                mu_new[:] = (
-                    self.n_hc[self.temps, delta[i].T[j], None]
-                    * self.mu_clust[self.temps, delta[i].T[j]]
-                    + n * self.mu_hist[i][self.temps, j]
-                ) / n_new  # (m=(n1*m1 + n2*m2)/n)
-                self.cov_clust[self.temps, delta[i].T[j]] = (
-                    1
-                    / n_new[:, :, None]
-                    * (  # 1/n *
-                        +self.n_hc[self.temps, delta[i].T[j], None, None]
-                        * self.cov_clust[
-                            self.temps, delta[i].T[j]
-                        ]  # cov1 (what has accumulated so far)  #(c1)
-                        + n
-                        * self.cov_hist[i][
-                            self.temps, j
-                        ]  # cov2 (history for experiment ij)          #(c2)
-                        + np.einsum(
-                            "t,tp,tq->tpq",
-                            self.n_hc[self.temps, delta[i].T[j]],  # mu1
-                            self.mu_clust[self.temps, delta[i].T[j]] - mu_new,
-                            self.mu_clust[self.temps, delta[i].T[j]] - mu_new,
-                        )
-                        + n
-                        * np.einsum(
-                            "tp,tq->tpq",
-                            self.mu_hist[i][self.temps, j] - mu_new,
-                            self.mu_hist[i][self.temps, j] - mu_new,
-                        )  # mu2
-                    )
-                )
-                self.mu_clust[self.temps, delta[i].T[j]] = mu_new  # (m1=m)
-                self.n_hc[self.temps, delta[i].T[j]] = n_new.ravel()  # (n1=n)
+        # every experiment history carries the same weight n, so the pooled cluster moments are
+        # plain averages over members: one scatter-add over all (temperature, member) pairs
+        lab = np.concatenate(delta, axis=1)  # cluster label of each member
+        cell = (self.temps[:, None] * self.nclustmax + lab).ravel()
+        mu = np.concatenate(self.mu_hist, axis=1).reshape(-1, self.p)
+        cov = np.concatenate(self.cov_hist, axis=1).reshape(-1, self.p, self.p)
+        nmem = np.bincount(cell, minlength=self.ntemps * self.nclustmax)
+        nmem_div = np.maximum(nmem, 1)
+        self.n_hc[:] = (n * nmem).reshape(self.ntemps, self.nclustmax)
+        mu_clust = np.zeros((self.ntemps * self.nclustmax, self.p))
+        np.add.at(mu_clust, cell, mu)
+        mu_clust /= nmem_div[:, None]
+        dev = mu - mu_clust[cell]
+        cov_clust = np.zeros((self.ntemps * self.nclustmax, self.p, self.p))
+        np.add.at(cov_clust, cell, cov + dev[:, :, None] * dev[:, None, :])
+        cov_clust /= nmem_div[:, None, None]
+        # empty clusters keep zero mean and covariance
+        self.mu_clust[:] = mu_clust.reshape(self.mu_clust.shape)
+        self.cov_clust[:] = cov_clust.reshape(self.cov_clust.shape)
 
     def update_tau(
         self, m
@@ -348,6 +320,37 @@ class AMcov_clust:
         return x_cand
 
 
+class ThetaHist:
+    """
+    Theta history of one experiment in a cluster calibration, derived on request from the
+    cluster thetas and memberships rather than stored: self[m, t, j] is theta[m, t, delta[m, t, j]].
+    Indexes like the (nmcmc, ntemps, ntheta[i], p) array it stands in for, along the first axis
+    first.
+    """
+
+    def __init__(self, theta, delta):
+        self.theta = theta  # (nmcmc, ntemps, nclustmax, p)
+        self.delta = delta  # (nmcmc, ntemps, ntheta[i])
+        self.shape = delta.shape + theta.shape[-1:]
+        self.ndim = len(self.shape)
+        self.dtype = theta.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        lab = self.delta[key[0]]
+        out = np.take_along_axis(
+            self.theta[key[0]], lab[..., None].astype(np.intp), axis=-2
+        )
+        return out[(slice(None),) * (lab.ndim - 2) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
 OutCalibClust = namedtuple(
     "OutCalibClust",
     "theta theta_hist s2 count count_temper pred_curr theta0 Sigma0 delta eta nclustmax theta_am",
@@ -356,7 +359,55 @@ OutCalibClust = namedtuple(
 ## DP Cluster Calibration
 
 
+def llik_delta(setup, i, engine, pred, sse, log_s2, covs, theta_which, active):
+    """
+    log-likelihood of each theta of experiment i under the prediction of each active cluster
+    (occupied or auxiliary); the other clusters have zero probability in the delta draw.
+
+    pred is (ntemps, nclustmax, ylens[i]) (sse the matching sums of squares when engine is not
+    None), log_s2 (ntemps, ns2[i]) and active (ntemps, nclustmax).  Returns
+    (active.sum(), ntheta[i]), in the order of active's nonzero entries.
+    """
+    temps, clusts = np.nonzero(active)
+    if engine is not None:
+        return engine.llik(sse[temps, clusts], log_s2[temps])
+    model = setup.models[i]
+    out = np.empty([temps.shape[0], setup.ntheta[i]])
+    for a, (t, k) in enumerate(zip(temps, clusts)):
+        for j, idx in enumerate(theta_which):
+            out[a, j] = model.llik(
+                setup.ys[i][idx], pred[t, k][idx], covs[t][j]
+            )
+    return out
+
+
+def aux_clusters(theta_ext, naux):
+    """
+    Empty clusters offered as new-cluster candidates (auxiliary components, Neal's Algorithm 8):
+    the first naux empty clusters of each temperature.
+    """
+    empty = ~theta_ext
+    return empty & (empty.cumsum(axis=1) <= naux)
+
+
+def cluster_rows(cache, delta, owner):
+    """
+    Entries of a per-cluster cache (ntemps, nclustmax, n) at the current clusters: column c is
+    taken from cluster delta[:, owner[c]], for delta (ntemps, ntheta) and owner the theta of
+    each column.  Returns (ntemps, n).
+    """
+    return cache[
+        np.arange(cache.shape[0])[:, None],
+        delta[:, owner],
+        np.arange(cache.shape[2]),
+    ]
+
+
 def calibClust(setup, parallel=False):
+    if setup.fidelity_levels is not None:
+        raise ValueError(
+            "calibClust does not support fidelity ladders (setFidelityLadder)"
+        )
     t0 = time.time()
 
     if parallel:
@@ -397,21 +448,13 @@ def calibClust(setup, parallel=False):
     #        setup.checkConstraints, setup.bounds_mat, setup.bounds.keys(), setup.bounds, setup.constants
     #        )
     theta0_start = initfunc_unif(size=[setup.ntemps, setup.p])
-    good = setup.checkConstraints(
-        tran_unif(theta0_start, setup.bounds_mat, setup.bounds.keys()),
-        setup.bounds,
-    )
+    good = setup.checkConstraintsUnit(theta0_start)
     while np.any(np.logical_not(good)):
         theta0_start[np.where(np.logical_not(good))] = initfunc_unif(
             size=[(np.logical_not(good)).sum(), setup.p]
         )
-        good[np.where(np.logical_not(good))] = setup.checkConstraints(
-            tran_unif(
-                theta0_start[np.where(np.logical_not(good))],
-                setup.bounds_mat,
-                setup.bounds.keys(),
-            ),
-            setup.bounds,
+        good[np.where(np.logical_not(good))] = setup.checkConstraintsUnit(
+            theta0_start[np.where(np.logical_not(good))]
         )
     theta0[0] = theta0_start
 
@@ -419,7 +462,10 @@ def calibClust(setup, parallel=False):
     Sigma0[0] = np.eye(setup.p) * 0.25**2
     # initialize delta, the cluster membership indicator (for each experiment)
     delta = [
-        np.empty([setup.nmcmc, setup.ntemps, setup.ntheta[i]], dtype=int)
+        np.empty(
+            [setup.nmcmc, setup.ntemps, setup.ntheta[i]],
+            dtype=np.min_scalar_type(setup.nclustmax),
+        )
         for i in range(setup.nexp)
     ]
     for i in range(setup.nexp):
@@ -461,23 +507,19 @@ def calibClust(setup, parallel=False):
         setup.bounds.keys(),
         setup.bounds,
         setup.constants,
+        check=setup.checkConstraintsUnit,
     )
-    theta_hist = [
-        np.empty((setup.nmcmc, setup.ntemps, setup.ntheta[i], setup.p))
-        for i in range(setup.nexp)
-    ]
+    # theta of each experiment, gathered from theta and delta when needed
+    theta_hist = [ThetaHist(theta, delta[i]) for i in range(setup.nexp)]
     theta_cand = np.empty(theta_wide_shape)
-    for i in range(setup.nexp):
-        theta_hist[i][0] = theta[
-            0, theta_unravel[i], delta[i][0].ravel()
-        ].reshape(setup.ntemps, setup.ns2[i], setup.p)
-    theta_eval = np.empty(theta_wide_shape)
     theta_ext = np.zeros(
         (setup.ntemps, setup.nclustmax), dtype=bool
     )  # array of (current) extant theta locs
     for i in range(setup.nexp):
         theta_ext[theta_unravel[i], delta[i][0].ravel()] += True
     ntheta = theta_ext.sum(axis=1)  # count extant thetas
+    # candidate (empty) clusters; other empty clusters are neither drawn nor evaluated
+    aux = aux_clusters(theta_ext, setup.nclust_aux)
     # initialize sigma2 and eta
     log_s2 = [
         np.ones([setup.nmcmc, setup.ntemps, setup.ns2[i]])
@@ -486,10 +528,6 @@ def calibClust(setup, parallel=False):
     eta = np.empty((setup.nmcmc, setup.ntemps))
     eta[0] = 5.0
 
-    s2_which_mat = [
-        [np.where(s2_ind_mat[i][:, j])[0] for j in range(setup.ntheta[i])]
-        for i in range(setup.nexp)
-    ]
     theta_which_mat = [
         [np.where(theta_ind_mat[i][:, j])[0] for j in range(setup.ntheta[i])]
         for i in range(setup.nexp)
@@ -516,61 +554,71 @@ def calibClust(setup, parallel=False):
     marg_lik_cov_curr = (
         [None] * setup.nexp
     )  # does not need to get summed over experiments (should be one for each experiment, regardless of cluster)
+    # vectorized likelihoods (diagonal Gaussian models), with cached residual sums of squares
+    engine = lik_engines(setup)
+    sse_curr_theta = [None] * setup.nexp  # [i] x [ntemps, ncell]
+    sse_cand_theta = [None] * setup.nexp
+    sse_curr_delta = [None] * setup.nexp  # [i] x [ntemps, nclustmax, ncell]
     for i in range(setup.nexp):
         ### Initialize predictions for theta_i's
-        pred_curr_theta[i] = setup.models[i].eval(
+        pred_curr_theta[i] = setup.models[i].cached_eval(
             tran_unif(
                 theta_hist[i][0].reshape(-1, setup.p),  # 0 for first iteration
                 setup.bounds_mat,
                 setup.bounds.keys(),
             ),
-            False,
+            pool=False,
         )
         pred_cand_theta[i] = pred_curr_theta[i].copy()
-        marg_lik_cov_curr[i] = [None] * setup.ntemps
-        llik_curr_theta[i] = np.empty([setup.ntemps, setup.ntheta[i]])
-        for t in range(setup.ntemps):
-            marg_lik_cov_curr[i][t] = [None] * setup.ntheta[i]
-            s2_stretched = log_s2[i][0][t, setup.theta_ind[i]]
-            for j in range(setup.ntheta[i]):
-                marg_lik_cov_curr[i][t][j] = setup.models[i].lik_cov_inv(
-                    np.exp(s2_stretched[s2_which_mat[i][j]])
-                )
-                llik_curr_theta[i][t][j] = setup.models[i].llik(
-                    setup.ys[i][theta_which_mat[i][j]],
-                    pred_curr_theta[i][t][theta_which_mat[i][j]],
-                    marg_lik_cov_curr[i][t][j],
-                )
+        if engine[i] is not None:
+            sse_curr_theta[i] = engine[i].sse(pred_curr_theta[i])
+            sse_cand_theta[i] = sse_curr_theta[i].copy()
+            llik_curr_theta[i] = engine[i].llik(sse_curr_theta[i], log_s2[i][0])
+        else:
+            marg_lik_cov_curr[i] = lik_cov_theta(
+                setup.models[i],
+                log_s2[i][0],
+                setup.s2_ind[i],
+                theta_which_mat[i],
+            )
+            llik_curr_theta[i] = llik_theta(
+                setup.models[i],
+                setup.ys[i],
+                pred_curr_theta[i],
+                marg_lik_cov_curr[i],
+                theta_which_mat[i],
+            )
         llik_cand_theta[i] = llik_curr_theta[i].copy()
 
         ### Initialize predictions for clusters
         pred_curr_delta[i] = (
             setup
             .models[i]
-            .eval(
+            .cached_eval(
                 tran_unif(
                     theta[0].reshape(-1, setup.p),
                     setup.bounds_mat,
                     setup.bounds.keys(),
-                ),
-                True,
+                )
             )
             .reshape(setup.ntemps, setup.nclustmax, setup.y_lens[i])
         )
-        llik_curr_delta[i] = np.empty([
-            setup.ntemps,
-            setup.nclustmax,
-            setup.ntheta[i],
-        ])
-        for t in range(setup.ntemps):
-            s2_stretched = log_s2[i][0][t, setup.theta_ind[i]]
-            for j in range(setup.ntheta[i]):
-                for k in range(setup.nclustmax):
-                    llik_curr_delta[i][t][k][j] = setup.models[i].llik(
-                        setup.ys[i][theta_which_mat[i][j]],
-                        pred_curr_delta[i][t][k][theta_which_mat[i][j]],
-                        marg_lik_cov_curr[i][t][j],
-                    )
+        if engine[i] is not None:
+            sse_curr_delta[i] = engine[i].sse(pred_curr_delta[i])
+        llik_curr_delta[i] = np.full(
+            [setup.ntemps, setup.nclustmax, setup.ntheta[i]], -np.inf
+        )
+        llik_curr_delta[i][theta_ext | aux] = llik_delta(
+            setup,
+            i,
+            engine[i],
+            pred_curr_delta[i],
+            sse_curr_delta[i],
+            log_s2[i][0],
+            marg_lik_cov_curr[i],
+            theta_which_mat[i],
+            theta_ext | aux,
+        )
 
     ## Initialize Adaptive Metropolis related Variables
     # S   = np.empty((setup.ntemps, setup.nclustmax, setup.p, setup.p))
@@ -643,9 +691,7 @@ def calibClust(setup, parallel=False):
             clust_mem_count[:] += bincount2D_vectorized(
                 delta[l][m], setup.nclustmax
             )
-        clust_nomem_bool[:] = (
-            clust_mem_count == 0
-        )  # fixed at start of iteration
+        clust_nomem_bool[:] = aux  # fixed at start of iteration
         # if (non-extant) cluster j becomes extant, then set this to False.
 
         ##################
@@ -696,20 +742,17 @@ def calibClust(setup, parallel=False):
         ### Update Theta Evals ###
         ##########################
         for i in range(setup.nexp):
-            pred_curr_theta[i][:] = setup.models[i].eval(
-                tran_unif(
-                    theta[m - 1, theta_unravel[i], delta[i][m].ravel()],
-                    setup.bounds_mat,
-                    setup.bounds.keys(),
+            # from the cluster cache (at theta[m - 1], log_s2[i][m - 1]), no evaluations
+            pred_curr_theta[i][:] = cluster_rows(
+                pred_curr_delta[i], delta[i][m], setup.theta_ind[i]
+            )
+            llik_curr_theta[i][:] = cluster_rows(
+                llik_curr_delta[i], delta[i][m], np.arange(setup.ntheta[i])
+            )
+            if engine[i] is not None:
+                sse_curr_theta[i][:] = cluster_rows(
+                    sse_curr_delta[i], delta[i][m], engine[i].cell_theta
                 )
-            )  # update after delta update before
-            for t in range(setup.ntemps):
-                for j in range(setup.ntheta[i]):
-                    llik_curr_theta[i][t][j] = setup.models[i].llik(
-                        setup.ys[i][theta_which_mat[i][j]],
-                        pred_curr_theta[i][t][theta_which_mat[i][j]],
-                        marg_lik_cov_curr[i][t][j],
-                    )
 
         # ------------------------------------------------------------------------------------------
         ## adaptive Metropolis per Cluster
@@ -765,40 +808,49 @@ def calibClust(setup, parallel=False):
         llik_cand_theta_[:] = 0.0
         llik_curr_theta_[:] = 0.0
         theta[m] = theta[m - 1]
-        theta_eval[:] = theta[m - 1]
 
         cov_theta_cand.update(theta_hist, m, curr_delta)
         theta_cand = cov_theta_cand.gen_cand(theta, m)
-        good_values[:] = setup.checkConstraints(
-            tran_unif(
-                theta_cand.reshape(theta_long_shape),
-                setup.bounds_mat,
-                setup.bounds.keys(),
-            ),
-            setup.bounds,
+        good_values[:] = setup.checkConstraintsUnit(
+            theta_cand.reshape(theta_long_shape)
         ).reshape(setup.ntemps, setup.nclustmax)
-        theta_eval[good_values] = theta_cand[good_values]
         for i in range(setup.nexp):
-            pred_cand_theta[i][:] = setup.models[i].eval(
-                tran_unif(
-                    theta_eval[theta_unravel[i], delta[i][m].ravel()],
-                    setup.bounds_mat,
-                    setup.bounds.keys(),
+            # predictions at valid candidates only
+            pred_cand_theta[i][:] = eval_theta(
+                setup,
+                i,
+                theta_cand[theta_unravel[i], delta[i][m].ravel()].reshape(
+                    setup.ntemps, setup.ntheta[i], setup.p
+                ),
+                good_values[theta_unravel[i], delta[i][m].ravel()].reshape(
+                    setup.ntemps, setup.ntheta[i]
+                ),
+                pred_curr_theta[i],
+            )
+            if engine[i] is not None:
+                sse_cand_theta[i][:] = engine[i].sse(pred_cand_theta[i])
+                llik_cand_theta[i][:] = engine[i].llik(
+                    sse_cand_theta[i], log_s2[i][m - 1]
                 )
+            else:
+                llik_cand_theta[i][:] = llik_theta(
+                    setup.models[i],
+                    setup.ys[i],
+                    pred_cand_theta[i],
+                    marg_lik_cov_curr[i],
+                    theta_which_mat[i],
+                )
+            # sum over the experiments sharing each cluster
+            np.add.at(
+                llik_cand_theta_,
+                (theta_unravel[i], curr_delta[i].ravel()),
+                llik_cand_theta[i].ravel(),
+            )
+            np.add.at(
+                llik_curr_theta_,
+                (theta_unravel[i], curr_delta[i].ravel()),
+                llik_curr_theta[i].ravel(),
             )
-            for t in range(setup.ntemps):
-                for j in range(setup.ntheta[i]):
-                    llik_cand_theta[i][t][j] = setup.models[i].llik(
-                        setup.ys[i][theta_which_mat[i][j]],
-                        pred_cand_theta[i][t][theta_which_mat[i][j]],
-                        marg_lik_cov_curr[i][t][j],
-                    )
-                    llik_cand_theta_[t][curr_delta[i][t, j]] += llik_cand_theta[
-                        i
-                    ][t][j]
-                    llik_curr_theta_[t][curr_delta[i][t, j]] += llik_curr_theta[
-                        i
-                    ][t][j]
 
         alpha[:] = -np.inf
         alpha[good_values] = (
@@ -814,18 +866,16 @@ def calibClust(setup, parallel=False):
         theta[m, accept] = theta_cand[accept]
 
         for i in range(setup.nexp):
-            theta_hist[i][m] = theta[
-                m, theta_unravel[i], delta[i][m].ravel()
-            ].reshape(setup.ntemps, setup.ns2[i], setup.p)
-            pred_curr_theta[i][:] = setup.models[i].eval(
-                tran_unif(
-                    theta_hist[i][m].reshape(-1, setup.p),
-                    setup.bounds_mat,
-                    setup.bounds.keys(),
-                ),
-                False,
-            )
-            llik_curr_theta[i][:] = llik_cand_theta[i][:]
+            # accepted (temperature, theta) pairs take their candidate predictions
+            accept_theta = accept[
+                theta_unravel[i], delta[i][m].ravel()
+            ].reshape(setup.ntemps, setup.ntheta[i])
+            ind = accept_theta[:, setup.theta_ind[i]]
+            pred_curr_theta[i][ind] = pred_cand_theta[i][ind]
+            if engine[i] is not None:
+                ind = accept_theta[:, engine[i].cell_theta]
+                sse_curr_theta[i][ind] = sse_cand_theta[i][ind]
+            llik_curr_theta[i][accept_theta] = llik_cand_theta[i][accept_theta]
 
         count += accept.sum(axis=1)
         cov_theta_cand.count_100 += accept.sum(axis=1)
@@ -840,10 +890,16 @@ def calibClust(setup, parallel=False):
         ###  Gibbs update s2 ###
         ########################
         for i in range(setup.nexp):
+            if setup.models[i].s2 not in ("gibbs", "fix"):
+                print("TODO: fill in s2 sampling without gibbs")
+                continue
             if setup.models[i].s2 == "gibbs":
-                dev_sq = (pred_curr_theta[i] - setup.ys[i]) ** 2 @ s2_ind_mat[
-                    i
-                ]  # squared deviations
+                if engine[i] is not None:  # from cached sums of squares, O(ns2)
+                    dev_sq = engine[i].dev_sq(sse_curr_theta[i])
+                else:
+                    dev_sq = (
+                        pred_curr_theta[i] - setup.ys[i]
+                    ) ** 2 @ s2_ind_mat[i]  # squared deviations
                 log_s2[i][m] = np.log(
                     1
                     / np.random.gamma(
@@ -852,62 +908,27 @@ def calibClust(setup, parallel=False):
                         1 / (itl_mat_s2[i] * (setup.ig_b[i] + dev_sq / 2)),
                     )
                 )
-                for t in range(setup.ntemps):
-                    s2_stretched = log_s2[i][m][t, setup.theta_ind[i]]
-                    for j in range(setup.ntheta[i]):
-                        marg_lik_cov_curr[i][t][j] = setup.models[
-                            i
-                        ].lik_cov_inv(np.exp(s2_stretched[s2_which_mat[i][j]]))
-                        llik_curr_theta[i][t][j] = setup.models[i].llik(
-                            setup.ys[i][s2_which_mat[i][j]],
-                            pred_curr_theta[i][t][s2_which_mat[i][j]],
-                            marg_lik_cov_curr[i][t][j],
-                        )
-
-            elif setup.models[i].s2 == "fix":
+            else:
                 log_s2[i][m] = np.log(setup.sd_est[i] ** 2)
 
-                for t in range(setup.ntemps):
-                    s2_stretched = log_s2[i][m][t, setup.theta_ind[i]]
-                    for j in range(setup.ntheta[i]):
-                        marg_lik_cov_curr[i][t][j] = setup.models[
-                            i
-                        ].lik_cov_inv(np.exp(s2_stretched[s2_which_mat[i][j]]))
-                        llik_curr_theta[i][t][j] = setup.models[i].llik(
-                            setup.ys[i][s2_which_mat[i][j]],
-                            pred_curr_theta[i][t][s2_which_mat[i][j]],
-                            marg_lik_cov_curr[i][t][j],
-                        )
-
+            if engine[i] is not None:
+                llik_curr_theta[i][:] = engine[i].llik(
+                    sse_curr_theta[i], log_s2[i][m]
+                )
             else:
-                print("TODO: fill in s2 sampling without gibbs")
-
-        ##########################
-        ### Update Delta Evals ### (THIS IS THE SLOW CHUNK THAT IS MESSING WITH RUNTIME!!!! Problem is compute_state_history looping over NHist)
-        ##########################
-        for i in range(setup.nexp):
-            pred_curr_delta[i][:] = (
-                setup
-                .models[i]
-                .eval(  # (IN PARTICULAR, THIS CALL!!!!)
-                    tran_unif(
-                        theta[m]
-                        .reshape(-1, setup.p)
-                        .repeat(setup.ns2[i], axis=0),
-                        setup.bounds_mat,
-                        setup.bounds.keys(),
-                    ),
+                marg_lik_cov_curr[i] = lik_cov_theta(
+                    setup.models[i],
+                    log_s2[i][m],
+                    setup.s2_ind[i],
+                    theta_which_mat[i],
+                )
+                llik_curr_theta[i][:] = llik_theta(
+                    setup.models[i],
+                    setup.ys[i],
+                    pred_curr_theta[i],
+                    marg_lik_cov_curr[i],
+                    theta_which_mat[i],
                 )
-                .reshape(setup.ntemps, setup.nclustmax, setup.y_lens[i])
-            )
-            for t in range(setup.ntemps):
-                for j in range(setup.ntheta[i]):
-                    for k in range(setup.nclustmax):
-                        llik_curr_delta[i][t][k][j] = setup.models[i].llik(
-                            setup.ys[i][theta_which_mat[i][j]],
-                            pred_curr_delta[i][t][k][theta_which_mat[i][j]],
-                            marg_lik_cov_curr[i][t][j],
-                        )
 
         ###########################
         ### Gibbs Update Theta0 ###
@@ -933,6 +954,7 @@ def calibClust(setup, parallel=False):
             setup.bounds.keys(),
             setup.bounds,
             setup.constants,
+            check=setup.checkConstraintsUnit,
         )
 
         ###########################
@@ -964,12 +986,12 @@ def calibClust(setup, parallel=False):
         # theta[m,0,np.where(theta_ext.reshape(setup.ntemps, setup.nclustmax, 1))[1],:].T @ theta[m,0,np.where(theta_ext.reshape(setup.ntemps, setup.nclustmax, 1))[1],:]
         Sigma0_scales[:] = Sigma0_prior_scale + mat
         Sigma0_dfs[:] = Sigma0_prior_df + theta_ext.sum(axis=1) * setup.itl
-        for t in range(setup.ntemps):
-            Sigma0[m, t] = invwishart.rvs(
-                df=Sigma0_dfs[t], scale=Sigma0_scales[t]
-            )
-        Sigma0_ldet_curr[:] = np.linalg.slogdet(Sigma0[m])[1]
-        Sigma0_inv_curr[:] = np.linalg.inv(Sigma0[m])
+        (
+            Sigma0[m],
+            Sigma0_chol,
+            Sigma0_inv_curr[:],
+            Sigma0_ldet_curr[:],
+        ) = invwishart_rvs_batch(Sigma0_dfs, Sigma0_scales)
 
         ###############################################
         ### Gibbs Update for Theta (Not in Cluster) ###
@@ -983,8 +1005,41 @@ def calibClust(setup, parallel=False):
             setup.bounds.keys(),
             setup.bounds,
             setup.constants,
+            check=setup.checkConstraintsUnit,
+            chols=Sigma0_chol,
         )
-        theta[m, ~theta_ext] = theta_cand[~theta_ext]
+        aux[:] = aux_clusters(theta_ext, setup.nclust_aux)
+        theta[m, aux] = theta_cand[aux]
+
+        ##########################
+        ### Update Delta Evals ###
+        ##########################
+        # cluster predictions are cached; only accepted and redrawn (candidate) clusters changed
+        changed = (accept & theta_ext) | aux
+        active = theta_ext | aux
+        for i in range(setup.nexp):
+            if changed.any():
+                pred_curr_delta[i][changed] = setup.models[i].cached_eval(
+                    tran_unif(
+                        theta[m][changed], setup.bounds_mat, setup.bounds.keys()
+                    )
+                )
+                if engine[i] is not None:
+                    sse_curr_delta[i][changed] = engine[i].sse(
+                        pred_curr_delta[i][changed]
+                    )
+            # s2 changed, so the likelihoods of all active clusters (the others are stale)
+            llik_curr_delta[i][active] = llik_delta(
+                setup,
+                i,
+                engine[i],
+                pred_curr_delta[i],
+                sse_curr_delta[i],
+                log_s2[i][m],
+                marg_lik_cov_curr[i],
+                theta_which_mat[i],
+                active,
+            )
 
         # TODO: add decorrelation step here?
 
@@ -1024,10 +1079,18 @@ def calibClust(setup, parallel=False):
                         theta0_prior_ldet,
                     )
                     - invwishart_logpdf(
-                        Sigma0[m][sw.T[1]], Sigma0_prior_df, Sigma0_prior_scale
+                        Sigma0[m][sw.T[1]],
+                        Sigma0_prior_df,
+                        Sigma0_prior_scale,
+                        Sigma0_ldet_curr[sw.T[1]],
+                        Sigma0_inv_curr[sw.T[1]],
                     )
                     + invwishart_logpdf(
-                        Sigma0[m][sw.T[0]], Sigma0_prior_df, Sigma0_prior_scale
+                        Sigma0[m][sw.T[0]],
+                        Sigma0_prior_df,
+                        Sigma0_prior_scale,
+                        Sigma0_ldet_curr[sw.T[0]],
+                        Sigma0_inv_curr[sw.T[0]],
                     )
                     - gamma_logpdf(eta[m][sw.T[1]], 2, 0.1)
                     + gamma_logpdf(eta[m][sw.T[0]], 2, 0.1)
@@ -1142,10 +1205,6 @@ def calibClust(setup, parallel=False):
                         Sigma0_ldet_curr[tt[0]].copy(),
                     )
                     for i in range(setup.nexp):
-                        theta_hist[i][m, tt[0]], theta_hist[i][m, tt[1]] = (
-                            theta_hist[i][m, tt[1]].copy(),
-                            theta_hist[i][m, tt[0]].copy(),
-                        )
                         delta[i][m, tt[0]], delta[i][m, tt[1]] = (
                             delta[i][m, tt[1]].copy(),
                             delta[i][m, tt[0]].copy(),
@@ -1170,10 +1229,14 @@ def calibClust(setup, parallel=False):
                             llik_curr_delta[i][tt[1]].copy(),
                             llik_curr_delta[i][tt[0]].copy(),
                         )
+                        if engine[i] is not None:
+                            sse_curr_theta[i][tt] = sse_curr_theta[i][tt[::-1]]
+                            sse_curr_delta[i][tt] = sse_curr_delta[i][tt[::-1]]
                     theta_ext[tt[0]], theta_ext[tt[1]] = (
                         theta_ext[tt[1]].copy(),
                         theta_ext[tt[0]].copy(),
                     )
+                    aux[tt] = aux[tt[::-1]]
         print(
             f"\rCalibration MCMC {m / setup.nmcmc:.01%} Complete",
             end="",
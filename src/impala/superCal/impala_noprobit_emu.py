@@ -11,14 +11,16 @@
 import time
 from collections import namedtuple
 from math import floor, log, sqrt
-from multiprocessing import Pool
+from multiprocessing import Pipe, Pool, Process
 
 import numpy as np
 import scipy
+import scipy.sparse
 from numpy.linalg import cholesky, slogdet
 from numpy.random import normal, uniform
-from scipy.special import erf, erfinv, gammaln, multigammaln
-from scipy.stats import invwishart
+from scipy.interpolate import RBFInterpolator
+from scipy.optimize import nnls
+from scipy.special import erf, erfinv, gammaln, logsumexp, multigammaln, ndtri
 
 from ..physics import PTW_goodparam
 
@@ -44,6 +46,13 @@ class CalibSetup:
     * addVecExperiments
     * setTemperatureLadder
     * setMCMC
+    * setProposal
+    * setEmulatorRefresh
+    * setDelayedAcceptance
+    * setFidelityLadder
+    * setEarlyRejection
+    * setSubsampling
+    * setCoreset
     * setHierPriors
     * setClusterPriors
 
@@ -59,7 +68,9 @@ class CalibSetup:
             as the dictionary of bounds and (these should have matching keys) and returns a vector
             of 1s and 0s with 1s where the parameter combinations meet the constraint. Alternatively,
             if no constraints other than bounds exist, passing "bounds" for this argument will use
-            the proper constraint function.
+            the proper constraint function.  Linear constraints (a LinearConstraints object, or
+            cf_bounds and constraints_ptw, which are linear) are checked by the samplers directly
+            on the unit scale, see checkConstraintsUnit.
         """
 
         self.nexp = 0  # Number of independent emulators
@@ -77,6 +88,10 @@ class CalibSetup:
             constraint_func = cf_bounds
         # self.checkConstraints = constraint_func  ## see wrapper below (maintains run-script compatibility with earlier impala versions)
         self._constraint_func = constraint_func
+        self._linear = LINEAR_CONSTRAINTS.get(constraint_func, constraint_func)
+        if not isinstance(self._linear, LinearConstraints):
+            self._linear = None
+        self._linear_unit = None  # (constant values, A, b) on the unit scale
         self.nmcmc = 10000
         self.nburn = 5000
         self.thin = 5
@@ -95,6 +110,26 @@ class CalibSetup:
         self.nswap = 5
         self.s2_prior_kern = []
         self.constants = None
+        self.emu_refresh_every = 1
+        self.emu_refresh_prob = None
+        self.proposal = "am"
+        self.proposal_nz0 = None
+        self.proposal_jump_every = 10
+        self.proposal_stretch_a = 2.0
+        self.da_start = None
+        self.da_neighbors = 50
+        self.da_kernel = "thin_plate_spline"
+        self.da_max_points = 5000
+        self.fidelity_levels = None
+        self.fidelity_model_args = None
+        self.fidelity_obs = None
+        self.early_reject_order = None
+        self.subsample_start = None
+        self.subsample_batch = 1000
+        self.subsample_eps = 0.05
+        self.subsample_refit_every = None
+        self.obs_weights = []
+        self.coreset_full = None
 
     def checkConstraints(self, x, *args):
         """Calls the constraint function set by the user. Argument x contains the parameters to be checked
@@ -111,6 +146,39 @@ class CalibSetup:
             consts = args[1]
         return self._constraint_func(x, bounds, consts)
 
+    def checkConstraintsUnit(self, theta):
+        """
+        Constraint check of parameters on the unit scale, theta (..., p) as sampled, returning a
+        boolean array theta.shape[:-1].  Linear constraints are checked in one vectorized pass
+        on theta; other constraint functions get the native parameters (checkConstraints).
+        """
+        if self._linear is None:
+            good = self.checkConstraints(
+                tran_unif(
+                    theta.reshape(-1, self.p),
+                    self.bounds_mat,
+                    self.bounds.keys(),
+                )
+            )
+            good = np.broadcast_to(
+                np.asarray(good, dtype=bool), (theta.size // self.p,)
+            )
+            return good.reshape(theta.shape[:-1]).copy()
+        # keyed on the constant values, which may be changed in place
+        consts = None
+        if self.constants is not None:
+            consts = [
+                (k, np.asarray(v).tolist()) for k, v in self.constants.items()
+            ]
+        if self._linear_unit is None or self._linear_unit[0] != consts:
+            self._linear_unit = (consts,) + self._linear.unit(
+                self.bounds, self.constants
+            )
+        _, A, b = self._linear_unit
+        return np.all((theta > 0) & (theta < 1), axis=-1) & np.all(
+            theta @ A.T < b, axis=-1
+        )
+
     def addVecExperiments(
         self,
         yobs,
@@ -140,7 +208,7 @@ class CalibSetup:
         :param s2_ind: a list or numpy array of indices for s2 value associated with each element of yobs, len(s2_ind) = len(yobs), max(s2_ind)+1 = len(sd_est)
         :param meas_error_cor: (optional) correlation matrix for observation measurement errors, default = independent
         :param theta_ind: a list or numpy array of indices for theta_i associated with each element of yobs (usually, indexes experiments), len(theta_ind) = len(yobs)
-        :param D: (optional) numpy array containing basis functions for discrepancy, possibly including intercept. D.shape = (length of yobs, number of bases)
+        :param D: (optional) numpy array or scipy.sparse matrix containing basis functions for discrepancy, possibly including intercept. D.shape = (length of yobs, number of bases)
         :param discrep_tau: (optional) fixed prior variance for discrepancy basis coefficients (discrepancy = D @ discrep_vars, discrep_vars ~ N(0,discrep_tau))
         """
         # if theta_ind specified, s2_ind is?
@@ -160,6 +228,7 @@ class CalibSetup:
             raise ValueError("len(yobs) and len(s2_ind) should be the same")
         self.ys.append(np.array(yobs))
         self.y_lens.append(len(yobs))
+        self.obs_weights.append(None)
         if theta_ind is None:
             theta_ind = [0] * len(yobs)
         theta_ind = np.array(theta_ind)
@@ -175,6 +244,8 @@ class CalibSetup:
             model.meas_error_cor = meas_error_cor
 
         if D is not None:
+            if scipy.sparse.issparse(D):
+                D = D.tocsr()  # row slicing and products with dense vectors
             model.D = D
             model.nd = D.shape[1]
             model.discrep_tau = discrep_tau
@@ -251,6 +322,264 @@ class CalibSetup:
         self.start_tau_ls2 = start_tau_ls2
         self.start_adapt_iter = start_adapt_iter
 
+    def setProposal(self, move="am", nz0=None, jump_every=10, stretch_a=2.0):
+        """
+        Choose the theta proposals of calibPool and calibHier.  The population moves ("de" and
+        "stretch") build candidates from an archive of past states at the same temperature, which
+        tempering swaps fill with states of all replicas.  The archive is seeded with draws from
+        the prior, so they need no adaptation warm-up (start_adapt_iter).
+
+        :param move : "am" (default) adaptive Metropolis on each chain's own history,
+            "de" differential evolution x + gamma (z1 - z2) (DE-MCz), or "stretch" affine-invariant
+            stretch moves z1 + Z (x - z1), for archive states z1, z2
+        :param nz0 : (optional) number of prior draws seeding the archive, default 10 * p
+        :param jump_every : (optional) "de" only, every jump_every-th iteration uses gamma = 1 to jump between modes
+        :param stretch_a : (optional) "stretch" only, Z is drawn from g(Z) ~ 1/sqrt(Z) on [1/stretch_a, stretch_a]
+        """
+        if move not in ("am", "de", "stretch"):
+            raise ValueError("move should be one of 'am', 'de', 'stretch'")
+        if stretch_a <= 1:
+            raise ValueError("stretch_a should be greater than 1")
+        self.proposal = move
+        self.proposal_nz0 = nz0
+        self.proposal_jump_every = jump_every
+        self.proposal_stretch_a = stretch_a
+
+    def setEmulatorRefresh(self, every=1, prob=None):
+        """
+        Define how often stochastic models (emulators with posterior samples) take a new
+        posterior draw during MCMC.  On a refresh iteration, every stochastic model steps
+        and the current predictions and likelihoods are recomputed in one batched call;
+        on other iterations the previous draw is kept.
+
+        :param every : (optional) take a new emulator draw every `every` MCMC iterations, default = 1 (every iteration)
+        :param prob : (optional) if given, take a new emulator draw on a random subset of iterations,
+            each iteration independently with probability prob.  Overrides every.
+        """
+        if int(every) != every or every < 1:
+            raise ValueError("every should be a positive integer")
+        if prob is not None and not 0 < prob <= 1:
+            raise ValueError("prob should be in (0, 1]")
+        self.emu_refresh_every = int(every)
+        self.emu_refresh_prob = prob
+
+    def setDelayedAcceptance(
+        self,
+        start=1000,
+        neighbors=50,
+        kernel="thin_plate_spline",
+        max_points=5000,
+    ):
+        """
+        Screen the theta proposals of calibPool with a cheap surrogate of the model predictions
+        (delayed acceptance).  The (theta, prediction) pairs of all model evaluations before
+        iteration start are used to fit a local RBF interpolant of each experiment's
+        predictions.  After that, a proposal is first accepted or rejected with the surrogate
+        likelihood, and the models are only evaluated for proposals that pass, with a second
+        acceptance step that corrects for the surrogate (the posterior is unchanged).
+
+        :param start : MCMC iteration at which the surrogate is fit, None turns delayed acceptance off
+        :param neighbors : (optional) number of nearest training points used by each RBF interpolation
+        :param kernel : (optional) RBF kernel, see scipy.interpolate.RBFInterpolator
+        :param max_points : (optional) maximum number of training points, the latest are kept
+        """
+        if start is not None and start < 1:
+            raise ValueError("start should be a positive iteration")
+        if neighbors <= self.p:
+            raise ValueError(
+                "neighbors should be larger than the number of parameters"
+            )
+        if max_points < neighbors:
+            raise ValueError("max_points should be at least neighbors")
+        self.da_start = start
+        self.da_neighbors = neighbors
+        self.da_kernel = kernel
+        self.da_max_points = max_points
+
+    def setFidelityLadder(self, levels, model_args=None, obs=None):
+        """
+        Bind cheaper model configurations to the hotter temperatures of calibPool and calibHier
+        (not calibClust).  Each temperature runs at a fidelity level, 0 being the full models
+        and data; at level k > 0, the models are evaluated with the attributes in
+        model_args[k - 1] (e.g. fewer ModelMaterialStrength history steps, {"Nhist": 20}) and
+        only predict the observations obs[k - 1] (model.setObservations, e.g. ModelF_bigdata
+        with f_obs only evaluates those), which the likelihood then uses.  Each temperature then targets
+        its own tempered posterior, and swaps between levels evaluate both states at the other
+        level (two extra evaluations per such pair), so that the cold chain still samples the
+        full posterior.
+
+        :param levels : fidelity level of each temperature, starting at 0 and nondecreasing
+        :param model_args : (optional) list over levels 1, 2, ... of lists over experiments of
+            dictionaries of model attributes set while evaluating at that level
+        :param obs : (optional) list over levels 1, 2, ... of lists over experiments of sorted
+            indices of the observations used at that level (None for all).  Needs a diagonal likelihood
+            without discrepancy, and every s2 group (s2_ind) should keep some observations.
+            calibPool only: calibHier levels can only differ in model_args.
+        """
+        levels = np.asarray(levels, dtype=int)
+        if levels.shape != (self.ntemps,):
+            raise ValueError("levels should give a level for each temperature")
+        if levels[0] != 0 or np.any(np.diff(levels) < 0):
+            raise ValueError("levels should start at 0 and be nondecreasing")
+        nlevels = levels.max() + 1
+        if model_args is None:
+            model_args = [[{}] * self.nexp] * (nlevels - 1)
+        if obs is None:
+            obs = [[None] * self.nexp] * (nlevels - 1)
+        if len(model_args) != nlevels - 1 or len(obs) != nlevels - 1:
+            raise ValueError(
+                "model_args and obs should be given for levels 1, 2, ..."
+            )
+        for k in range(nlevels - 1):
+            if len(model_args[k]) != self.nexp or len(obs[k]) != self.nexp:
+                raise ValueError(
+                    "model_args and obs should be given for each experiment"
+                )
+            for i in range(self.nexp):
+                if obs[k][i] is None:
+                    continue
+                if not self.models[i].diag_lik or self.models[i].nd > 0:
+                    raise ValueError(
+                        "obs needs a diagonal likelihood without discrepancy"
+                    )
+                if (
+                    np.unique(self.s2_ind[i][obs[k][i]]).size
+                    < np.unique(self.s2_ind[i]).size
+                ):
+                    raise ValueError("obs should keep every s2 group")
+        self.fidelity_levels = levels
+        self.fidelity_model_args = [[{}] * self.nexp] + list(model_args)
+        self.fidelity_obs = [[None] * self.nexp] + list(obs)
+
+    def setEarlyRejection(self, order="auto"):
+        """
+        Early rejection of the theta proposals of calibPool.  The acceptance thresholds are
+        drawn first, and the experiments are evaluated one at a time, each only for the
+        temperatures whose proposal can still be accepted when the experiments not yet
+        evaluated are replaced by their likelihood upper bounds (at the current s2).  The
+        accepted proposals, and so the chains' distribution, are unchanged.
+
+        :param order : "auto" to evaluate experiments in decreasing order of their average
+            likelihood gap below the bound per second of evaluation, a list of experiment
+            indices for a fixed order, or None to turn early rejection off
+        """
+        if (
+            order is not None
+            and not isinstance(order, str)
+            and sorted(order) != list(range(self.nexp))
+        ):
+            raise ValueError(
+                'order should be "auto" or list each experiment once'
+            )
+        if isinstance(order, str) and order != "auto":
+            raise ValueError(
+                'order should be "auto" or list each experiment once'
+            )
+        self.early_reject_order = order
+
+    def setSubsampling(
+        self, start=1000, batch=1000, eps=0.05, refit_every=None
+    ):
+        """
+        Decide the theta proposals of calibPool from random subsets of the observations, for
+        very long outputs (models with diagonal likelihoods and no discrepancy).  From iteration
+        start, the log-likelihood difference is the exact difference of Gauss-Newton proxies
+        (predictions linearized at the cold chain's theta) plus the proxy errors, summed over
+        all observations and estimated from batches of random observations.  Batches are added
+        until a normal test decides acceptance at level eps, or up to half the observations,
+        after which the exact test is used.  Accepted proposals are evaluated in full, so s2
+        updates and tempering swaps are exact.  Predictions at subsets of observations use
+        model.eval_obs (e.g. ModelF_bigdata with f_obs).
+
+        :param start : MCMC iteration at which the proxies are built, None turns subsampling off
+        :param batch : (optional) number of observations added to the subsample at a time
+        :param eps : (optional) level of the test, the probability of a wrong decision is about eps
+        :param refit_every : (optional) rebuild the proxies at the cold chain's theta every
+            refit_every iterations, default = never
+        """
+        if start is not None and start < 1:
+            raise ValueError("start should be a positive iteration")
+        if batch < 2:
+            raise ValueError("batch should be at least 2")
+        if not 0 < eps < 0.5:
+            raise ValueError("eps should be in (0, 0.5)")
+        self.subsample_start = start
+        self.subsample_batch = batch
+        self.subsample_eps = eps
+        self.subsample_refit_every = refit_every
+
+    def setCoreset(self, size, nprobe=200):
+        """
+        Replace the data of each experiment by a weighted coreset: a subset of its observations
+        whose weighted Gaussian log-likelihood approximates the full one over the prior region.
+        The observations of each cell (theta_ind, s2_ind) get a share of size proportional to
+        the cell's length.  Within a cell, observations are sampled with probabilities mixing
+        uniform and the size of their squared residuals at nprobe prior draws of theta, and
+        their weights are fit by nonnegative least squares to the cell's sum of squared
+        residuals at each draw and to its number of observations (so s2 keeps the full data's
+        degrees of freedom).  The models then only predict the kept observations
+        (model.setObservations) and all samplers run on the coreset; coresetReweight gives
+        importance weights of calibPool draws under the full data.  Call once, after adding
+        all experiments.  Needs diagonal likelihoods without discrepancy.
+
+        :param size : number of observations kept per experiment, or a list over experiments.
+            Experiments with at most size observations are kept whole.
+        :param nprobe : (optional) number of prior draws of theta the weights are fit at
+        """
+        if self.coreset_full is not None:
+            raise ValueError("setCoreset should only be called once")
+        if any(not model.diag_lik or model.nd > 0 for model in self.models):
+            raise ValueError(
+                "coresets need diagonal likelihoods without discrepancy"
+            )
+        size = np.broadcast_to(size, (self.nexp,))
+        theta = initfunc_unif(size=[nprobe, self.p])
+        good = self.checkConstraintsUnit(theta)
+        while np.any(~good):
+            theta[~good] = initfunc_unif(size=[(~good).sum(), self.p])
+            good[~good] = self.checkConstraintsUnit(theta[~good])
+        parmat = tran_unif(theta, self.bounds_mat, self.bounds.keys())
+        self.coreset_full = []
+        for i in range(self.nexp):
+            r2 = (self.models[i].eval(parmat, pool=True) - self.ys[i]) ** 2
+            r2 = r2[np.all(np.isfinite(r2), axis=1)]
+            if r2.shape[0] == 0:
+                raise ValueError(f"no finite predictions for experiment {i}")
+            cell = self.theta_ind[i] * self.ns2[i] + self.s2_ind[i]
+            keep, weights = [], []
+            for c in np.unique(cell):
+                obs = np.flatnonzero(cell == c)
+                k, w = coreset_cell(
+                    r2[:, obs],
+                    max(2, round(size[i] * obs.shape[0] / cell.shape[0])),
+                )
+                keep.append(obs[k])
+                weights.append(w)
+            keep = np.concatenate(keep)
+            order = np.argsort(keep)
+            keep, weights = keep[order], np.concatenate(weights)[order]
+            self.coreset_full.append((
+                keep,
+                self.ys[i],
+                self.s2_ind[i],
+                self.theta_ind[i],
+            ))
+            self.ys[i] = self.ys[i][keep]
+            self.y_lens[i] = keep.shape[0]
+            self.s2_ind[i] = self.s2_ind[i][keep]
+            self.theta_ind[i] = self.theta_ind[i][keep]
+            self.obs_weights[i] = weights
+            self.ny_s2[i] = np.bincount(
+                self.s2_ind[i], weights, minlength=self.ns2[i]
+            )
+            self.models[i].setObservations(keep)
+
+    def emulatorRefresh(self, m):
+        """Whether stochastic models take a new posterior draw at MCMC iteration m"""
+        if self.emu_refresh_prob is not None:
+            return uniform() < self.emu_refresh_prob
+        return m % self.emu_refresh_every == 0
+
     def setHierPriors(
         self,
         theta0_prior_mean,
@@ -275,7 +604,11 @@ class CalibSetup:
         self.Sigma0_prior_scale = Sigma0_prior_scale
 
     def setClusterPriors(
-        self, nclustmax=None, eta_prior_shape=2, eta_prior_rate=0.1
+        self,
+        nclustmax=None,
+        eta_prior_shape=2,
+        eta_prior_rate=0.1,
+        nclust_aux=None,
     ):
         """
         Define clustered experiment model hyperparameters
@@ -283,10 +616,18 @@ class CalibSetup:
         :param nclustmax : maximum number of unique theta values to estimate (i.e., maximum number of clusters)
         :param eta_prior_shape : NEED TO ADD
         :param eta_prior_rate :  NEED TO ADD
+        :param nclust_aux : number of empty clusters offered as new-cluster candidates in each delta
+            update (auxiliary components of Neal's Algorithm 8); only occupied and auxiliary clusters
+            are drawn and evaluated.  None uses every empty cluster.
         """
         if nclustmax is None:
             nclustmax = max(sum(self.ntheta), 10)
+        if nclust_aux is None:
+            nclust_aux = nclustmax
+        if nclust_aux < 1:
+            raise ValueError("nclust_aux must be at least 1")
         self.nclustmax = nclustmax
+        self.nclust_aux = nclust_aux
         self.eta_prior_shape = eta_prior_shape
         self.eta_prior_rate = eta_prior_rate
 
@@ -316,6 +657,78 @@ def constraints_ptw(x, bounds, constants=None):
     return good
 
 
+class LinearConstraints:
+    """
+    Linear inequality constraints A @ x < b on named parameters (native scale), besides the
+    bounds.  Constants (parameters kept fixed) move to the right-hand side, and the system is
+    rescaled to the unit scale the samplers work on (see CalibSetup.checkConstraintsUnit).
+    Calling the object checks a dictionary of native parameters, like other constraint
+    functions.
+    """
+
+    def __init__(self, A, b, names):
+        """
+        :param A : constraint matrix, one row per constraint, one column per name
+        :param b : right-hand sides
+        :param names : parameter (or constant) names of the columns of A
+        """
+        self.b = np.asarray(b, dtype=float).reshape(-1)
+        self.names = list(names)
+        A = np.asarray(A, dtype=float)
+        if A.size != self.b.shape[0] * len(self.names):
+            raise ValueError(
+                "A should have a row for each constraint and a column for each name"
+            )
+        self.A = A.reshape(self.b.shape[0], len(self.names))
+
+    def native(self, bounds, constants=None):
+        """constraint matrix over the parameters in bounds, and right-hand sides with the constants"""
+        if constants is None:
+            constants = {}
+        A = np.zeros((self.A.shape[0], len(bounds)))
+        b = self.b.copy()
+        cols = {k: j for j, k in enumerate(bounds)}
+        for k, name in enumerate(self.names):
+            if name in cols:
+                A[:, cols[name]] += self.A[:, k]
+            elif name in constants:
+                b -= self.A[:, k] * np.asarray(constants[name], dtype=float)
+            else:
+                raise ValueError(
+                    f"{name} is neither a parameter nor a constant"
+                )
+        return A, b
+
+    def unit(self, bounds, constants=None):
+        """constraint matrix and right-hand sides for the parameters on the unit scale"""
+        A, b = self.native(bounds, constants)
+        lower, upper = np.array(list(bounds.values()), dtype=float).T
+        return A * (upper - lower), b - A @ lower
+
+    def __call__(self, x, bounds, constants=None):
+        A, b = self.native(bounds, constants)
+        xmat = np.column_stack([np.atleast_1d(x[k]) for k in bounds])
+        bounds_mat = np.array(list(bounds.values()), dtype=float)
+        return np.all(
+            (xmat > bounds_mat[:, 0]) & (xmat < bounds_mat[:, 1]), axis=1
+        ) & np.all(xmat @ A.T < b, axis=1)
+
+
+# PTW_goodparam as linear constraints
+ptw_linear_constraints = LinearConstraints(
+    A=[
+        [-1, 1, 0, 0, 0, 0, 0],  # sInf < s0
+        [0, 0, -1, 1, 0, 0, 0],  # yInf < y0
+        [-1, 0, 1, 0, 0, 0, 0],  # y0 < s0
+        [0, -1, 0, 1, 0, 0, 0],  # yInf < sInf
+        [1, 0, 0, 0, -1, 0, 0],  # y1 > s0
+        [0, 0, 0, 0, 0, -1, 1],  # y2 > beta
+    ],
+    b=np.zeros(6),
+    names=["s0", "sInf", "y0", "yInf", "y1", "y2", "beta"],
+)
+
+
 def cf_bounds(x, bounds, constants=None):
     """default for bounds checking, variable 'constants' is not used here and present only to have a consistent api."""
     if constants is None:
@@ -327,6 +740,13 @@ def cf_bounds(x, bounds, constants=None):
     return good
 
 
+# linear equivalents of the constraint functions, used by CalibSetup.checkConstraintsUnit
+LINEAR_CONSTRAINTS = {
+    cf_bounds: LinearConstraints(np.zeros((0, 0)), [], []),
+    constraints_ptw: ptw_linear_constraints,
+}
+
+
 def normalize(x, bounds):
     """Normalize to 0-1 scale"""
     return (x - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
@@ -378,6 +798,28 @@ def chol_sample_1per(means, covs):
     )
 
 
+def chol_rank1_update(L, x):
+    """
+    In-place rank-one update of lower cholesky factors stored with the batch axes last: L
+    (p, p, ...) becomes the factor of L L^T + x x^T, for x (p, ...).  O(p^2) per matrix, each
+    step vectorized over the (contiguous) batch.
+    """
+    x = x.copy()
+    for k in range(L.shape[0]):
+        lkk = L[k, k]
+        r = np.hypot(lkk, x[k])
+        c = r / lkk
+        s = x[k] / lkk
+        L[k, k] = r
+        col = L[k + 1 :, k]
+        xr = x[k + 1 :]
+        col += s * xr
+        col /= c
+        xr *= c
+        xr -= s * col
+    return L
+
+
 def chol_sample_nper(means, covs, n):
     return means + np.einsum(
         "ijk,ilk->ilj", cholesky(covs), normal(size=(*means.shape, n))
@@ -385,12 +827,29 @@ def chol_sample_nper(means, covs, n):
 
 
 def chol_sample_1per_constraints(
-    means, covs, cf, bounds_mat, bounds_keys, bounds, consts
+    means,
+    covs,
+    cf,
+    bounds_mat,
+    bounds_keys,
+    bounds,
+    consts,
+    chols=None,
+    check=None,
 ):
-    """Sample with constraints.  If fail constraints, resample."""
-    chols = cholesky(covs)
+    """
+    Sample with constraints.  If fail constraints, resample.  chols: (optional) cholesky(covs).
+    check: (optional) constraint check on the unit scale (CalibSetup.checkConstraintsUnit), used
+    instead of cf.
+    """
+    if check is None:
+        check = lambda x: cf(
+            tran_unif(x, bounds_mat, bounds_keys), bounds, consts
+        )
+    if chols is None:
+        chols = cholesky(covs)
     cand = means + np.einsum("ijk,ik->ij", chols, normal(size=means.shape))
-    good = cf(tran_unif(cand, bounds_mat, bounds_keys), bounds, consts)
+    good = check(cand)
     while np.any(np.logical_not(good)):
         cand[np.where(np.logical_not(good))] = +means[
             np.logical_not(good)
@@ -399,36 +858,45 @@ def chol_sample_1per_constraints(
             chols[np.logical_not(good)],
             normal(size=((np.logical_not(good)).sum(), means.shape[1])),
         )
-        good[np.logical_not(good)] = cf(
-            tran_unif(cand[np.logical_not(good)], bounds_mat, bounds_keys),
-            bounds,
-        )
+        good[np.logical_not(good)] = check(cand[np.logical_not(good)])
     return cand
 
 
 def chol_sample_nper_constraints(
-    means, covs, n, cf, bounds_mat, bounds_keys, bounds, consts
+    means,
+    covs,
+    n,
+    cf,
+    bounds_mat,
+    bounds_keys,
+    bounds,
+    consts,
+    chols=None,
+    check=None,
 ):
-    """Sample with constraints.  If fail constraints, resample."""
-    chols = cholesky(covs)
+    """
+    Sample with constraints.  If fail constraints, resample.  chols: (optional) cholesky(covs).
+    check: (optional) constraint check on the unit scale, used instead of cf.
+    """
+    if check is None:
+        check = lambda x: cf(
+            tran_unif(x, bounds_mat, bounds_keys), bounds, consts
+        )
+    if chols is None:
+        chols = cholesky(covs)
     cand = means.reshape(means.shape[0], 1, means.shape[1]) + np.einsum(
         "ijk,ink->inj", chols, normal(size=(means.shape[0], n, means.shape[1]))
     )
     for i in range(cand.shape[0]):
-        goodi = cf(tran_unif(cand[i], bounds_mat, bounds_keys), bounds, consts)
+        goodi = check(cand[i])
         while np.any(np.logical_not(goodi)):
             cand[i, np.where(np.logical_not(goodi))[0]] = +means[i] + np.einsum(
                 "ik,nk->ni",
                 chols[i],
                 normal(size=((np.logical_not(goodi)).sum(), means.shape[1])),
             )
-            goodi[np.where(np.logical_not(goodi))[0]] = cf(
-                tran_unif(
-                    cand[i, np.where(np.logical_not(goodi))[0]],
-                    bounds_mat,
-                    bounds_keys,
-                ),
-                bounds,
+            goodi[np.where(np.logical_not(goodi))[0]] = check(
+                cand[i, np.where(np.logical_not(goodi))[0]]
             )
     return cand
 
@@ -501,21 +969,48 @@ def mvnorm_logpdf_(x, mean, prec, ldet):  # VALIDATED
     return ld
 
 
-def invwishart_logpdf(w, df, scale):  # VALIDATED
-    """unnormalized logpdf of inverse wishart w given df and scale"""
+def invwishart_logpdf(w, df, scale, ldet=None, inv=None):  # VALIDATED
+    """
+    unnormalized logpdf of inverse wishart w given df and scale
+    ldet, inv: (optional) precomputed log-determinant and inverse of w
+    """
+    if ldet is None:
+        ldet = slogdet(w)[1]
+    if inv is None:
+        inv = np.linalg.inv(w)
     ld = (
         +0.5 * df * slogdet(scale)[1]
         - multigammaln(df / 2, scale.shape[-1])
         - 0.5 * df * scale.shape[-1] * log(2.0)
-        - 0.5 * (df + w.shape[-1] + 1) * slogdet(w)[1]
-        - 0.5
-        * np.einsum(
-            "...ii->...", np.einsum("ji,...ij->...ij", scale, np.linalg.inv(w))
-        )
+        - 0.5 * (df + w.shape[-1] + 1) * ldet
+        - 0.5 * np.einsum("ij,...ji->...", scale, inv)  # trace(scale @ inv)
     )
     return ld
 
 
+def invwishart_rvs_batch(dfs, scales):
+    """
+    Inverse Wishart draws for a batch of (df, scale) pairs, by the Bartlett decomposition
+    dfs = (ntemps), scales = (ntemps x p x p)
+    returns Sigma, its (lower) cholesky factor, inverse, and log-determinant
+    """
+    dfs = np.asarray(dfs, dtype=float)
+    nt, p = scales.shape[0], scales.shape[-1]
+    # Sigma^-1 = L^-T B B^T L^-1 with scale = L L^T and B upper triangular, so that
+    # B B^T ~ Wishart(df, I) and the cholesky factor of Sigma is L B^-T
+    B = np.triu(normal(size=(nt, p, p)), 1)
+    B[:, range(p), range(p)] = np.sqrt(
+        np.random.chisquare(dfs[:, None] - np.arange(p)[::-1])
+    )
+    L = cholesky(scales)
+    chol = L @ np.swapaxes(np.linalg.inv(B), -1, -2)
+    G = np.swapaxes(B, -1, -2) @ np.linalg.inv(L)
+    Sigma = chol @ np.swapaxes(chol, -1, -2)
+    inv = np.swapaxes(G, -1, -2) @ G
+    ldet = 2 * np.log(np.diagonal(chol, axis1=-2, axis2=-1)).sum(axis=-1)
+    return Sigma, chol, inv, ldet
+
+
 def invgamma_logpdf(s, alpha, beta):
     """log pdf of inverse gamma distribution -- Assume s = (n x p); alpha, beta = (p)"""
     ld = (
@@ -546,9 +1041,310 @@ def ldhc_kern(x, a, b):  # half cauchy
     return -np.log(x + 1)
 
 
+def coreset_cell(r2, size):
+    """
+    Coreset of one cell (see CalibSetup.setCoreset) from squared residuals r2 (nprobe x n):
+    indices of the kept observations and their weights
+    """
+    n = r2.shape[1]
+    if n <= size:
+        return np.arange(n), np.ones(n)
+    sens = np.sqrt((r2 * r2).mean(axis=0))
+    prob = 0.5 * sens / sens.sum() + 0.5 / n if sens.sum() > 0 else None
+    idx = np.sort(np.random.choice(n, size, replace=False, p=prob))
+    # relative errors of the sums of squares at each probe, and of the number of observations
+    target = np.maximum(r2.sum(axis=1), np.finfo(float).tiny)
+    A = np.vstack([
+        r2[:, idx] / target[:, None],
+        np.full(size, sqrt(r2.shape[0]) / n),
+    ])
+    b = np.r_[np.ones(r2.shape[0]), sqrt(r2.shape[0])]
+    w = nnls(A, b)[0]
+    return idx[w > 0], w[w > 0]
+
+
+class GaussLikSegments:
+    """
+    Independent Gaussian log-likelihoods for every theta of a vectorized experiment.
+
+    Observations are sorted once by cell (theta_ind, s2_ind).  Squared residuals are then
+    summed within cells by a single np.add.reduceat over the last axis, so any number of
+    leading dimensions (temperatures, clusters) are handled in one pass.  Cells are ordered
+    by theta, so log-likelihoods per theta (and squared deviations per s2 group, for the
+    Gibbs update of s2) are small segmented sums over cells.  Optional observation weights
+    (coresets, see CalibSetup.setCoreset) scale each observation's term.
+    """
+
+    def __init__(self, yobs, theta_ind, ntheta, s2_ind, ns2, weights=None):
+        cell = np.asarray(theta_ind) * ns2 + np.asarray(s2_ind)
+        self.order = np.argsort(cell, kind="stable")
+        cell_sorted = cell[self.order]
+        self.starts = np.flatnonzero(
+            np.r_[True, cell_sorted[1:] != cell_sorted[:-1]]
+        )
+        self.wsort = None if weights is None else weights[self.order]
+        if weights is None:
+            self.ny = np.diff(np.r_[self.starts, cell.shape[0]])  # obs per cell
+        else:
+            self.ny = np.add.reduceat(self.wsort, self.starts)
+        self.cell_theta = cell_sorted[self.starts] // ns2
+        self.cell_s2 = cell_sorted[self.starts] % ns2
+        self.theta_starts = np.flatnonzero(
+            np.r_[True, self.cell_theta[1:] != self.cell_theta[:-1]]
+        )
+        self.thetas = self.cell_theta[self.theta_starts]
+        self.s2_mat = self.cell_s2[:, None] == np.arange(ns2)
+        self.ysort = np.asarray(yobs)[self.order]
+        self.ntheta = ntheta
+
+    def sse(self, pred):
+        """sum of squared residuals per cell: pred (..., n) -> (..., ncell)"""
+        r = pred[..., self.order] - self.ysort
+        if self.wsort is not None:
+            return np.add.reduceat(r * r * self.wsort, self.starts, axis=-1)
+        return np.add.reduceat(r * r, self.starts, axis=-1)
+
+    def llik(self, sse, log_s2):
+        """log-likelihood per theta: sse (..., ncell), log_s2 (..., ns2) -> (..., ntheta)"""
+        ls2 = log_s2[..., self.cell_s2]
+        terms = -0.5 * (self.ny * ls2 + sse * np.exp(-ls2))
+        out = np.zeros(terms.shape[:-1] + (self.ntheta,))
+        out[..., self.thetas] = np.add.reduceat(
+            terms, self.theta_starts, axis=-1
+        )
+        return out
+
+    def dev_sq(self, sse):
+        """squared deviations per s2 group: sse (..., ncell) -> (..., ns2)"""
+        return sse @ self.s2_mat
+
+
+def lik_engines(setup, pooled=False):
+    """
+    GaussLikSegments for each experiment with a diagonal Gaussian likelihood, else None.
+    If pooled, all observations of an experiment share one theta.
+    """
+    return [
+        GaussLikSegments(
+            setup.ys[i],
+            np.zeros_like(setup.s2_ind[i]) if pooled else setup.theta_ind[i],
+            1 if pooled else setup.ntheta[i],
+            setup.s2_ind[i],
+            setup.ns2[i],
+            setup.obs_weights[i],
+        )
+        if setup.models[i].diag_lik
+        else None
+        for i in range(setup.nexp)
+    ]
+
+
+class FidelityEngine:
+    """
+    GaussLikSegments of an experiment at the fidelity level of each temperature (see
+    CalibSetup.setFidelityLadder), one per level.  Arrays have a row per temperature, or a row
+    per entry of levels if given.
+
+    Every level keeps the cells of the full data, with zero weight outside the level's
+    observations, so predictions (eval_levels) and sse have the same shape at all levels.
+    """
+
+    def __init__(self, setup, i, pooled=True):
+        self.levels = setup.fidelity_levels
+        weights = setup.obs_weights[i]
+        self.engines = []
+        for obs in setup.fidelity_obs:
+            w = weights
+            if obs[i] is not None:
+                w = np.zeros(setup.y_lens[i])
+                w[obs[i]] = 1.0 if weights is None else weights[obs[i]]
+            self.engines.append(
+                GaussLikSegments(
+                    setup.ys[i],
+                    np.zeros_like(setup.s2_ind[i])
+                    if pooled
+                    else setup.theta_ind[i],
+                    1 if pooled else setup.ntheta[i],
+                    setup.s2_ind[i],
+                    setup.ns2[i],
+                    w,
+                )
+            )
+        self.cell_theta = self.engines[0].cell_theta
+        self.s2_mat = self.engines[0].s2_mat
+        # observations per s2 group at each temperature, for the Gibbs update of s2
+        self.ny_s2 = np.stack([
+            self.engines[k].ny @ self.s2_mat for k in self.levels
+        ])
+
+    def sse(self, pred, levels=None):
+        levels = self.levels if levels is None else levels
+        out = np.empty(pred.shape[:-1] + (self.s2_mat.shape[0],))
+        for k in np.unique(levels):
+            rows = levels == k
+            out[rows] = self.engines[k].sse(pred[rows])
+        return out
+
+    def llik(self, sse, log_s2, levels=None):
+        levels = self.levels if levels is None else levels
+        out = np.empty(sse.shape[:-1] + (self.engines[0].ntheta,))
+        for k in np.unique(levels):
+            rows = levels == k
+            out[rows] = self.engines[k].llik(sse[rows], log_s2[rows])
+        return out
+
+    def dev_sq(self, sse):
+        return sse @ self.s2_mat
+
+
+def fidelity_engines(setup, engine, pooled=True):
+    """likelihood engines, per temperature fidelity if a ladder is set"""
+    if setup.fidelity_levels is None:
+        return engine
+    return [
+        None if engine[i] is None else FidelityEngine(setup, i, pooled)
+        for i in range(setup.nexp)
+    ]
+
+
+def set_level_obs(setup, i, obs):
+    """
+    Have the models of experiment i predict only the observations obs (indices into
+    setup.ys[i], None for all, see CalibSetup.setFidelityLadder), on top of any coreset.  The
+    eval cache is kept, levels k > 0 have their own eval_tag.
+    """
+    model = setup.models[i]
+    if setup.coreset_full is not None:
+        keep = setup.coreset_full[i][0]
+        obs = keep if obs is None else keep[obs]
+    cache, model.eval_cache = model.eval_cache, None
+    try:
+        model.setObservations(obs)
+    finally:
+        model.eval_cache = cache
+
+
+def eval_levels(setup, i, evaluate, theta, levels):
+    """
+    evaluate(theta[rows]) for the rows (first axis) of theta at each fidelity level, with the
+    models of experiment i configured for that level (see CalibSetup.setFidelityLadder).  At
+    levels with a subset of observations, the models only predict those, and the others are
+    filled with the data (they have zero weight in FidelityEngine).
+    """
+    model = setup.models[i]
+    pred = np.empty((theta.shape[0], setup.y_lens[i]))
+    for k in np.unique(levels):
+        rows = levels == k
+        args = setup.fidelity_model_args[k][i]
+        obs = setup.fidelity_obs[k][i]
+        if k > 0:  # cached predictions are kept apart per level
+            args = dict(args, eval_tag=k)
+        saved = {key: getattr(model, key) for key in args}
+        for key, val in args.items():
+            setattr(model, key, val)
+        try:
+            if obs is not None:
+                set_level_obs(setup, i, obs)
+            pk = evaluate(rows)
+        finally:
+            if obs is not None:
+                set_level_obs(setup, i, None)
+            for key, val in saved.items():
+                setattr(model, key, val)
+        if obs is None:
+            pred[rows] = pk
+        else:
+            pred[rows] = setup.ys[i]
+            pred[np.ix_(rows, obs)] = pk
+    return pred
+
+
+def eval_pool(setup, i, theta, levels=None):
+    """
+    Pooled predictions of experiment i at theta (n x p, unit scale), row j at fidelity level
+    levels[j] (see CalibSetup.setFidelityLadder)
+    """
+    model = setup.models[i]
+    if levels is None or setup.fidelity_levels is None:
+        return model.cached_eval(
+            tran_unif(theta, setup.bounds_mat, setup.bounds.keys())
+        )
+    return eval_levels(
+        setup,
+        i,
+        lambda rows: model.cached_eval(
+            tran_unif(theta[rows], setup.bounds_mat, setup.bounds.keys())
+        ),
+        theta,
+        levels,
+    )
+
+
+def eval_theta(setup, i, theta, rows=None, pred_curr=None, levels=None):
+    """
+    Non-pooled predictions (ntemps x ylens[i]) for experiment i at theta (ntemps x ntheta[i] x p,
+    unit scale).  If rows (ntemps x ntheta[i]) is given, only those (valid, changed) thetas are
+    evaluated, on their own observations; the others keep their predictions from pred_curr.
+    If levels is given, row t is evaluated at fidelity level levels[t].
+    """
+    if levels is not None and setup.fidelity_levels is not None:
+        return eval_levels(
+            setup,
+            i,
+            lambda t: eval_theta(
+                setup,
+                i,
+                theta[t],
+                None if rows is None else rows[t],
+                None if rows is None else pred_curr[t],
+            ),
+            theta,
+            levels,
+        )
+    model = setup.models[i]
+    if rows is None or rows.all():
+        return model.cached_eval(
+            tran_unif(
+                theta.reshape(-1, setup.p),
+                setup.bounds_mat,
+                setup.bounds.keys(),
+            ),
+            pool=False,
+        )
+    pred = pred_curr.copy()
+    for j in np.where(rows.any(axis=0))[0]:
+        pred[np.ix_(rows[:, j], setup.theta_ind[i] == j)] = model.cached_eval(
+            tran_unif(
+                theta[rows[:, j], j], setup.bounds_mat, setup.bounds.keys()
+            ),
+            i=j,
+        )
+    return pred
+
+
+def lik_cov_theta(model, log_s2, s2_ind, theta_which):
+    """likelihood covariances for each (temperature, theta): log_s2 (ntemps x ns2)"""
+    return [
+        [
+            model.lik_cov_inv(np.exp(log_s2[t, s2_ind[idx]]))
+            for idx in theta_which
+        ]
+        for t in range(log_s2.shape[0])
+    ]
+
+
+def llik_theta(model, yobs, pred, covs, theta_which):
+    """log-likelihood for each (temperature, theta) with model covariances: pred (ntemps x n)"""
+    out = np.empty((len(covs), len(theta_which)))
+    for t in range(len(covs)):
+        for j, idx in enumerate(theta_which):
+            out[t, j] = model.llik(yobs[idx], pred[t][idx], covs[t][j])
+    return out
+
+
 OutCalibPool = namedtuple(
     "OutCalibPool",
-    "theta s2 count count_s2 count_decor cov_theta_cand cov_ls2_cand pred_curr discrep_vars llik theta_native",
+    "theta s2 count count_s2 count_decor cov_theta_cand cov_ls2_cand pred_curr discrep_vars llik theta_native surrogate early_reject subsample",
 )
 OutCalibHier = namedtuple(
     "OutCalibHier",
@@ -571,6 +1367,8 @@ class AMcov_pool:
         self.p = p
         self.start_adapt_iter = start_adapt_iter
         self.count_100 = np.zeros(ntemps, dtype=int)
+        # log proposal-density correction for the acceptance ratio (asymmetric proposals)
+        self.lcorr = np.zeros(ntemps)
 
     def update(self, x, m):
         if m > self.start_adapt_iter:
@@ -615,6 +1413,9 @@ class AMcov_pool:
 
 
 class AMcov_hier:
+    # iterations between full refactorizations of the rank-one updated cholesky factors
+    CHOL_REFRESH = 100
+
     def __init__(
         self,
         nexp,
@@ -630,9 +1431,13 @@ class AMcov_hier:
         self.tau = [
             tau_start * np.ones((ntemps, ntheta[i])) for i in range(nexp)
         ]
-        self.S = [np.empty((ntemps, ntheta[i], p, p)) for i in range(nexp)]
+        # S[i] = chol_scale[i] * chol[i] chol[i]^T, factors kept with the (temp, theta) axes last
+        self.chol = [np.empty((p, p, ntemps, ntheta[i])) for i in range(nexp)]
         for i in range(nexp):
-            self.S[i][:] = np.eye(p) * start_var
+            self.chol[i][:] = np.eye(p)[:, :, None, None]
+        self.chol_scale = [
+            start_var * np.ones((ntemps, ntheta[i])) for i in range(nexp)
+        ]
         self.cov = [np.empty((ntemps, ntheta[i], p, p)) for i in range(nexp)]
         self.mu = [np.empty((ntemps, ntheta[i], p)) for i in range(nexp)]
         self.nexp = nexp
@@ -640,6 +1445,8 @@ class AMcov_hier:
         self.p = p
         self.start_adapt_iter = start_adapt_iter
         self.count_100 = [np.zeros((ntemps, ntheta[i])) for i in range(nexp)]
+        # log proposal-density correction for the acceptance ratio (asymmetric proposals)
+        self.lcorr = [np.zeros((ntemps, ntheta[i])) for i in range(nexp)]
 
     def update(
         self, x, m
@@ -654,22 +1461,39 @@ class AMcov_hier:
                     x[i][m - 1] - self.mu[i],
                     x[i][m - 1] - self.mu[i],
                 )
-                self.S[i] = self.AM_SCALAR * np.einsum(
-                    "tejl,te->tejl",
-                    self.cov[i] + np.eye(self.p) * self.eps,
-                    np.exp(self.tau[i]),
-                )
+                if (m - self.start_adapt_iter) % self.CHOL_REFRESH == 0:
+                    self.chol[i][:] = np.moveaxis(
+                        cholesky(self.cov[i] + np.eye(self.p) * self.eps),
+                        (0, 1),
+                        (2, 3),
+                    )
+                else:  # (m-1)/m * (cov + u u^T / m), u = x - mu
+                    chol_rank1_update(
+                        self.chol[i],
+                        np.moveaxis(x[i][m - 1] - self.mu[i], -1, 0) / sqrt(m),
+                    )
+                    self.chol[i] *= sqrt((m - 1) / m)
+                self.chol_scale[i] = self.AM_SCALAR * np.exp(self.tau[i])
 
         elif m == self.start_adapt_iter:
             for i in range(self.nexp):
                 self.mu[i][:] = x[i][:m].mean(axis=0)
                 # self.mu[i][:]  = x[i].mean(axis = 0)
                 self.cov[i][:] = cov_4d_pcm(x[i][:m], self.mu[i])
-                self.S[i][:] = self.AM_SCALAR * np.einsum(
-                    "tejl,te->tejl",
-                    self.cov[i] + np.eye(self.p) * self.eps,
-                    np.exp(self.tau[i]),
+                self.chol[i][:] = np.moveaxis(
+                    cholesky(self.cov[i] + np.eye(self.p) * self.eps),
+                    (0, 1),
+                    (2, 3),
                 )
+                self.chol_scale[i] = self.AM_SCALAR * np.exp(self.tau[i])
+
+    @property
+    def S(self):
+        """proposal covariances [i] (ntemps x ntheta[i] x p x p), from the cholesky factors"""
+        return [
+            np.einsum("pqtn,rqtn,tn->tnpr", chol, chol, scale)
+            for chol, scale in zip(self.chol, self.chol_scale)
+        ]
 
     def update_tau(self, m):
         # diminishing adaptation based on acceptance rate for each temperature
@@ -682,885 +1506,1278 @@ class AMcov_hier:
 
     def gen_cand(self, x, m):
         x_cand = [
-            chol_sample_1per(x[i][m - 1], self.S[i]) for i in range(self.nexp)
+            x[i][m - 1]
+            + np.einsum(
+                "pqtn,tnq,tn->tnp",
+                self.chol[i],
+                normal(size=x[i][m - 1].shape),
+                np.sqrt(self.chol_scale[i]),
+            )
+            for i in range(self.nexp)
         ]
         return x_cand
 
 
-##############################################################################################################################################################################
-## Hierarchical Calibration
-# @profile
-def calibHier(setup):
+def population_cand(x, m, z0, move, gamma=1.0, sd=0.0, a=2.0):
     """
-    Hierarchical calibration
+    Population (DE-MCz) candidates from two states z1, z2 drawn without replacement from each
+    chain's archive: the seed draws z0[:, b] followed by the history x[:m, b].
+
+    :param x : history (nmcmc x batch x p), current states x[m - 1]
+    :param z0 : archive seed (nz0 x batch x p)
+    :param move : "de" for x + gamma (z1 - z2) + N(0, sd^2), "stretch" for z1 + Z (x - z1)
+    :return : candidates (batch x p) and the log proposal-density correction for the acceptance
+        ratio (batch), (p - 1) log Z for stretch moves
     """
-    t0 = time.time()
-    theta0 = np.zeros([setup.nmcmc, setup.ntemps, setup.p])
-    theta0 += 0.0
-    Sigma0 = np.zeros([setup.nmcmc, setup.ntemps, setup.p, setup.p])
-    Sigma0 += 0.0
-    ntheta = np.sum(setup.ntheta)
-    log_s2 = [
-        np.zeros([setup.nmcmc, setup.ntemps, setup.ns2[i]]) + 0.0
-        for i in range(setup.nexp)
-    ]
-    for i in range(setup.nexp):
-        log_s2[i][0] = np.log(setup.sd_est[i] ** 2)
-
-    # sse    = [np.ones([setup.nmcmc, setup.ntemps, setup.ns2[i]]) for i in range(setup.nexp)]
-    theta = [
-        np.zeros([setup.nmcmc, setup.ntemps, setup.ntheta[i], setup.p]) + 0.0
-        for i in range(setup.nexp)
-    ]
-    theta_ind_mat = [
-        (setup.theta_ind[i][:, None] == range(setup.ntheta[i]))
-        for i in range(setup.nexp)
-    ]
-    s2_ind_mat = [
-        (setup.s2_ind[i][:, None] == range(setup.ns2[i]))
-        for i in range(setup.nexp)
-    ]
-    s2_which_mat = [
-        [np.where(s2_ind_mat[i][:, j])[0] for j in range(setup.ntheta[i])]
-        for i in range(setup.nexp)
-    ]
-    theta_which_mat = [
-        [np.where(theta_ind_mat[i][:, j])[0] for j in range(setup.ntheta[i])]
-        for i in range(setup.nexp)
-    ]
-    theta0_start = initfunc_unif(size=[setup.ntemps, setup.p])
-    good = setup.checkConstraints(
-        tran_unif(theta0_start, setup.bounds_mat, setup.bounds.keys())
-    )
-    while np.any(np.logical_not(good)):
-        theta0_start[np.where(np.logical_not(good))] = initfunc_unif(
-            size=[(np.logical_not(good)).sum(), setup.p]
+    batch = x.shape[1:-1]
+    nz0 = z0.shape[0]
+    n = nz0 + m
+    idx = tuple(np.indices(batch))
+    k1 = np.random.randint(n, size=batch)
+    k2 = (k1 + np.random.randint(1, n, size=batch)) % n
+
+    def state(k):
+        return np.where(
+            (k < nz0)[..., None],
+            z0[(np.minimum(k, nz0 - 1),) + idx],
+            x[(np.maximum(k - nz0, 0),) + idx],
         )
-        good[np.where(np.logical_not(good))] = setup.checkConstraints(
-            tran_unif(
-                theta0_start[np.where(np.logical_not(good))],
-                setup.bounds_mat,
-                setup.bounds.keys(),
-            )
+
+    z1 = state(k1)
+    curr = x[m - 1]
+    if move == "de":
+        cand = (
+            curr
+            + gamma[..., None] * (z1 - state(k2))
+            + sd * normal(size=curr.shape)
         )
-    theta0[0] = theta0_start
-    Sigma0[0] = np.eye(setup.p) * 0.25**2
+        return cand, np.zeros(batch)
+    Z = ((a - 1) * uniform(size=batch) + 1) ** 2 / a
+    return z1 + Z[..., None] * (curr - z1), (x.shape[-1] - 1) * np.log(Z)
 
-    pred_curr = [None] * setup.nexp  # [i], ntemps x ylens[i]
-    pred_cand = [None] * setup.nexp  # [i], ntemps x ylens[i]
-    llik_curr = [None] * setup.nexp  # [i], ntheta[i] x ntemps
-    llik_cand = [None] * setup.nexp  # [i], ntheta[i] x ntemps
-    # dev_sq    = [None] * setup.nexp # [i], ntheta[i] x ntemps
-    itl_mat = [  # matrix of temperatures for use with alpha calculation--to skip nested for loops.
-        (np.ones((setup.ntheta[i], setup.ntemps)) * setup.itl).T
-        for i in range(setup.nexp)
-    ]
 
-    marg_lik_cov_curr = [None] * setup.nexp
+class DEprop_pool(AMcov_pool):
+    """
+    Population proposals for pooled calibration (see CalibSetup.setProposal and population_cand).
+    The DE step size 2.38 / sqrt(2 p) is tuned by the acceptance-rate adaptation of AMcov_pool
+    (exp(tau / 2)); start_var is the variance of the DE jitter.
+    """
 
-    for i in range(setup.nexp):
-        theta[i][0] = chol_sample_nper_constraints(
-            theta0[0],
-            Sigma0[0],
-            setup.ntheta[i],
-            setup.checkConstraints,
-            setup.bounds_mat,
-            setup.bounds.keys(),
-            setup.bounds,
-            setup.constants,
-        )
-        pred_curr[i] = setup.models[i].eval(
-            tran_unif(
-                theta[i][0].reshape(setup.ntemps * setup.ntheta[i], setup.p),
-                setup.bounds_mat,
-                setup.bounds.keys(),
-            ),
-            pool=False,
-        )  # .reshape(setup.ntemps, setup.y_lens[i])
-        pred_cand[i] = pred_curr[i].copy()
+    def __init__(
+        self,
+        ntemps,
+        p,
+        move="de",
+        nz0=None,
+        jump_every=10,
+        stretch_a=2.0,
+        start_var=1e-8,
+        start_adapt_iter=300,
+        tau_start=0.0,
+    ):
+        super().__init__(ntemps, p, start_var, start_adapt_iter, tau_start)
+        self.move = move
+        self.jump_every = jump_every
+        self.stretch_a = stretch_a
+        self.sd = sqrt(start_var)
+        self.z0 = initfunc_unif(size=[nz0 or 10 * p, ntemps, p])
+        self.lcorr = np.zeros(ntemps)
 
-        marg_lik_cov_curr[i] = [None] * setup.ntemps
-        llik_curr[i] = np.empty([setup.ntemps, setup.ntheta[i]])
-        for t in range(setup.ntemps):
-            marg_lik_cov_curr[i][t] = [None] * setup.ntheta[i]
-            s2_stretched = log_s2[i][0][t, setup.theta_ind[i]]
-            for j in range(setup.ntheta[i]):
-                # marg_lik_cov_curr[i][t][j] = setup.models[i].lik_cov_inv(np.exp(log_s2[i][0, t, setup.s2_ind[i]])[setup.s2_ind[i]==j])
-                marg_lik_cov_curr[i][t][j] = setup.models[i].lik_cov_inv(
-                    np.exp(s2_stretched[s2_which_mat[i][j]])
-                )
-                # right now, assuming for vectorized models that new theta means new s2.
-                # if you wanted to have multiple s2 for one theta, you would have to update thetas
-                # jointly or sequentially (not independently), unless working with diagonal
-                # many possible cases, for now make it work for strength project, generalize later
-                # llik_curr[i][t][j] = setup.models[i].llik(setup.ys[i][setup.theta_ind[i]==j], pred_curr[i][t][setup.theta_ind[i]==j], marg_lik_cov_curr[i][t][j])
-                llik_curr[i][t][j] = setup.models[i].llik(
-                    setup.ys[i][theta_which_mat[i][j]],
-                    pred_curr[i][t][theta_which_mat[i][j]],
-                    marg_lik_cov_curr[i][t][j],
-                )
-                # this isnt getting nthetas correct, probably need to change models script...
-                # there should be a separate likelihood evaluation (with separate covariance)
-                # for every i, t, ntheta. In diagonal case, we could vectorize over t ntheta...
-                # for now, break into separate calls.  Later may be worthwhile to try to vectorize more.
-        llik_cand[i] = llik_curr[i].copy()
-    # requirements: pooled, anything goes; hier, must have theta_ind matching s2_ind
-    # tau = [-0 * np.ones((setup.ntemps, setup.ntheta[i])) for i in range(setup.nexp)]
-    # S   = [np.empty((setup.ntemps, setup.ntheta[i], setup.p, setup.p)) for i in range(setup.nexp)]
-    # cov = [np.empty((setup.ntemps, setup.ntheta[i], setup.p, setup.p)) for i in range(setup.nexp)]
-    # mu  = [np.empty((setup.ntemps, setup.ntheta[i], setup.p)) for i in range(setup.nexp)]
-    # for i in range(setup.nexp):
-    #     S[i][:] = np.eye(setup.p) * 1e-4
-
-    cov_theta_cand = AMcov_hier(
-        setup.nexp,
-        np.array([setup.ntheta[i] for i in range(setup.nexp)]),
-        setup.ntemps,
-        setup.p,
-        start_var=setup.start_var_theta,
-        start_adapt_iter=setup.start_adapt_iter,
-        tau_start=setup.start_tau_theta,
-    )
-    cov_ls2_cand = [
-        AMcov_pool(
-            setup.ntemps,
-            setup.ns2[i],
-            start_var=setup.start_var_ls2,
-            start_adapt_iter=setup.start_adapt_iter,
-            tau_start=setup.start_tau_ls2,
+    def update(self, x, m):
+        pass  # the archive is the history itself
+
+    def gen_cand(self, x, m):
+        gamma = np.exp(self.tau / 2) * 2.38 / sqrt(2 * self.p)
+        if m % self.jump_every == 0:
+            gamma[:] = 1.0
+        x_cand, self.lcorr = population_cand(
+            x, m, self.z0, self.move, gamma, self.sd, self.stretch_a
         )
-        for i in range(setup.nexp)
-    ]
+        return x_cand
 
-    theta0_prior_mean = setup.theta0_prior_mean  # np.repeat(0.5, setup.p)
-    theta0_prior_cov = setup.theta0_prior_cov  # np.eye(setup.p)*1**2
-    theta0_prior_prec = scipy.linalg.inv(theta0_prior_cov)
-    theta0_prior_ldet = slogdet(theta0_prior_cov)[1]
 
-    tbar = np.empty(theta0[0].shape)
-    mat = np.zeros((setup.ntemps, setup.p, setup.p))
+class DEprop_hier(AMcov_hier):
+    """
+    Population proposals for the theta_i of hierarchical calibration, one archive per
+    (temperature, theta) chain; see DEprop_pool.
+    """
 
-    Sigma0_prior_df = setup.Sigma0_prior_df  # setup.p
-    Sigma0_prior_scale = (
-        setup.Sigma0_prior_scale
-    )  # np.eye(setup.p)*1**2#/setup.p
-    Sigma0_dfs = Sigma0_prior_df + ntheta * setup.itl
+    def __init__(
+        self,
+        nexp,
+        ntheta,
+        ntemps,
+        p,
+        move="de",
+        nz0=None,
+        jump_every=10,
+        stretch_a=2.0,
+        start_var=1e-8,
+        start_adapt_iter=300,
+        tau_start=0.0,
+    ):
+        super().__init__(
+            nexp, ntheta, ntemps, p, start_var, start_adapt_iter, tau_start
+        )
+        self.move = move
+        self.jump_every = jump_every
+        self.stretch_a = stretch_a
+        self.sd = sqrt(start_var)
+        self.z0 = [
+            initfunc_unif(size=[nz0 or 10 * p, ntemps, ntheta[i], p])
+            for i in range(nexp)
+        ]
+        self.lcorr = [np.zeros((ntemps, ntheta[i])) for i in range(nexp)]
 
-    Sigma0_ldet_curr = slogdet(Sigma0[0])[1]
-    Sigma0_inv_curr = np.linalg.inv(Sigma0[0])
+    def update(self, x, m):
+        pass  # the archive is the history itself
 
-    count_temper = np.zeros([setup.ntemps, setup.ntemps])
-    count = [
-        np.zeros((setup.ntemps, setup.ntheta[i])) for i in range(setup.nexp)
-    ]
-    # count_decor = [
-    #     np.zeros((setup.ntemps, setup.ntheta[i], setup.p))
-    #     for i in range(setup.nexp)
-    # ]
-    count_decor2 = np.zeros((setup.ntemps, setup.p))
-    # count_100 = [np.zeros((setup.ntemps, setup.ntheta[i])) for i in range(setup.nexp)]
-    count_s2 = np.zeros([setup.nexp, setup.ntemps], dtype=int)
+    def gen_cand(self, x, m):
+        x_cand = [None] * self.nexp
+        for i in range(self.nexp):
+            gamma = np.exp(self.tau[i] / 2) * 2.38 / sqrt(2 * self.p)
+            if m % self.jump_every == 0:
+                gamma[:] = 1.0
+            x_cand[i], self.lcorr[i] = population_cand(
+                x[i], m, self.z0[i], self.move, gamma, self.sd, self.stretch_a
+            )
+        return x_cand
 
-    # theta_cand = [
-    #     np.empty([setup.ntemps, setup.ntheta[i], setup.p])
-    #     for i in range(setup.nexp)
-    # ]
-    theta_cand_mat = [
-        np.empty([setup.ntemps * setup.ntheta[i], setup.p])
-        for i in range(setup.nexp)
-    ]
-    theta_eval_mat = [
-        np.empty(theta_cand_mat[i].shape) for i in range(setup.nexp)
-    ]
 
-    alpha = [
-        np.ones((setup.ntemps, setup.ntheta[i])) * -np.inf
-        for i in range(setup.nexp)
-    ]
-    alpha_s2 = np.ones([setup.nexp, setup.ntemps]) * (-np.inf)
-    accept = [np.zeros(alpha[i].shape, dtype=bool) for i in range(setup.nexp)]
-    sw_alpha = np.zeros(setup.nswap_per)
-    good_values = [
-        np.zeros(alpha[i].shape, dtype=bool) for i in range(setup.nexp)
-    ]
-    good_values_mat = [
-        good_values[i].reshape(setup.ntheta[i] * setup.ntemps)
-        for i in range(setup.nexp)
-    ]
-    ## start MCMC
-    for m in pbar(range(1, setup.nmcmc)):
+def theta_proposal(setup, ntheta=None):
+    """
+    Theta proposal of calibPool (ntheta None) or of the theta_i of calibHier for experiments
+    with ntheta thetas, as chosen by setup.setProposal
+    """
+    kw = {
+        "start_var": setup.start_var_theta,
+        "start_adapt_iter": setup.start_adapt_iter,
+        "tau_start": setup.start_tau_theta,
+    }
+    if setup.proposal != "am":
+        kw.update(
+            move=setup.proposal,
+            nz0=setup.proposal_nz0,
+            jump_every=setup.proposal_jump_every,
+            stretch_a=setup.proposal_stretch_a,
+        )
+    if ntheta is None:
+        cls = AMcov_pool if setup.proposal == "am" else DEprop_pool
+        return cls(setup.ntemps, setup.p, **kw)
+    cls = AMcov_hier if setup.proposal == "am" else DEprop_hier
+    return cls(len(ntheta), np.array(ntheta), setup.ntemps, setup.p, **kw)
+
+
+class SurrogateDA:
+    """
+    Surrogate of the model predictions for delayed acceptance in calibPool (see
+    CalibSetup.setDelayedAcceptance).  Training pairs are collected until the surrogate is fit,
+    then each experiment's predictions are interpolated by a local RBFInterpolator.
+    """
+
+    def __init__(self, setup):
+        self.start = setup.da_start
+        self.neighbors = setup.da_neighbors
+        self.kernel = setup.da_kernel
+        self.max_points = setup.da_max_points
+        self.x = []
+        self.y = [[] for _ in range(setup.nexp)]
+        self.interp = None
+        self.count_screen = np.zeros(setup.ntemps, dtype=int)  # surrogate stage
+        self.count_pass = np.zeros(setup.ntemps, dtype=int)  # true model stage
+
+    def add(self, theta, pred):
+        """training pairs: theta (n x p, unit scale), pred[i] (n x ylens[i])"""
+        self.x.append(theta.copy())
+        for i in range(len(pred)):
+            self.y[i].append(pred[i].copy())
+
+    def fit(self):
+        """fit the surrogate once there are enough (distinct) training points"""
+        x = np.concatenate(self.x)
+        keep = np.sort(np.unique(x, axis=0, return_index=True)[1])
+        keep = keep[-self.max_points :]
+        if keep.shape[0] < self.neighbors:
+            return
+        self.x = x[keep]
+        self.y = [np.concatenate(y)[keep] for y in self.y]
+        self.interp = [
+            RBFInterpolator(
+                self.x, y, neighbors=self.neighbors, kernel=self.kernel
+            )
+            for y in self.y
+        ]
+
+    def llik(self, setup, engine, theta, log_s2, discrep, covs):
+        """surrogate log-likelihood (nexp x ntemps) at theta (ntemps x p)"""
+        out = np.empty((setup.nexp, theta.shape[0]))
         for i in range(setup.nexp):
-            theta[i][m] = theta[i][
-                m - 1
-            ].copy()  # current set to previous, will change if accepted
-            log_s2[i][m] = log_s2[i][m - 1].copy()
-            setup.models[i].step()
-            if setup.models[i].stochastic:  # update emulator
-                pred_curr[i] = setup.models[i].eval(
+            pred = self.interp[i](theta)
+            if engine[i] is not None:
+                out[i] = engine[i].llik(
+                    engine[i].sse(pred + discrep[i]), log_s2[i]
+                )[:, 0]
+                continue
+            for t in range(theta.shape[0]):
+                out[i, t] = setup.models[i].llik(
+                    setup.ys[i] - discrep[i][t], pred[t], covs[i][t]
+                )
+        return out
+
+
+class EarlyReject:
+    """
+    Experiment order and counts of early rejection in calibPool (see
+    CalibSetup.setEarlyRejection).  count_eval[i] is the number of proposals experiment i
+    was evaluated for, out of count_cand proposals within the constraints.
+    """
+
+    def __init__(self, setup):
+        self.fixed = (
+            None
+            if isinstance(setup.early_reject_order, str)
+            else np.array(setup.early_reject_order)
+        )
+        self.gap = np.zeros(setup.nexp)  # likelihood below the bound, summed
+        self.time = np.zeros(setup.nexp)  # seconds of evaluation, summed
+        self.count_eval = np.zeros(setup.nexp, dtype=int)
+        self.count_cand = 0
+
+    def order(self):
+        if self.fixed is not None:
+            return self.fixed
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.where(self.time > 0, self.gap / self.time, np.inf)
+        return np.argsort(-rate, kind="stable")
+
+    def record(self, i, gap, seconds):
+        self.gap[i] += gap.sum()
+        self.time[i] += seconds
+        self.count_eval[i] += gap.shape[0]
+
+
+class SubsampledLik:
+    """
+    Subsampled acceptance test for the theta updates of calibPool (see
+    CalibSetup.setSubsampling).  Observations of all experiments are sampled uniformly (with
+    replacement).  count_obs counts candidate predictions at single observations, count_test
+    the tests and count_exact those left to the exact test.
+    """
+
+    # finite difference step of the Gauss-Newton proxies (unit scale theta)
+    STEP = 1e-5
+
+    def __init__(self, setup):
+        self.start = setup.subsample_start
+        self.batch = setup.subsample_batch
+        self.z = ndtri(1 - setup.subsample_eps)
+        self.refit_every = setup.subsample_refit_every
+        self.offsets = np.cumsum([0] + setup.y_lens)
+        self.n = self.offsets[-1]
+        self.theta_ref = None
+        self.count_obs = 0
+        self.count_test = 0
+        self.count_exact = 0
+
+    def screen(
+        self, setup, m, theta_cand, theta_curr, good, pred_curr, log_s2, lcorr
+    ):
+        """
+        Subsampled test of the candidates good at MCMC iteration m (proxies are rebuilt first
+        if due).  Returns the candidates to evaluate in full (accepted, or left to the exact
+        test) and the log thresholds runif of the exact test, -inf for the accepted ones, or
+        runif None before the proxies are built.
+        """
+        if self.refit(m):
+            self.fit(setup, theta_curr[0], [_[0] for _ in pred_curr])
+        if self.theta_ref is None:
+            return good, None
+        runif = np.log(uniform(size=setup.ntemps))
+        accept, exact = self.test(
+            setup,
+            theta_cand,
+            theta_curr,
+            good,
+            pred_curr,
+            log_s2,
+            lcorr,
+            runif,
+        )
+        runif[accept] = -np.inf
+        return accept | exact, runif
+
+    def refit(self, m):
+        return m == self.start or (
+            self.refit_every is not None
+            and m > self.start
+            and (m - self.start) % self.refit_every == 0
+        )
+
+    def fit(self, setup, theta_ref, pred_ref):
+        """
+        Gauss-Newton proxies around theta_ref (p, unit scale), from its predictions pred_ref[i]
+        and forward differences (p evaluations per experiment)
+        """
+        step = np.where(theta_ref + self.STEP < 1, self.STEP, -self.STEP)
+        x = theta_ref + np.diag(step)
+        self.theta_ref = theta_ref.copy()
+        self.resid, self.jac, self.A, self.b, self.C = [], [], [], [], []
+        for i in range(setup.nexp):
+            jac = ((eval_pool(setup, i, x) - pred_ref[i]) / step[:, None]).T
+            resid = setup.ys[i] - pred_ref[i]
+            # per s2 group sums, so proxies summed over all observations are O(p^2)
+            A = np.empty(setup.ns2[i])
+            b = np.empty((setup.ns2[i], setup.p))
+            C = np.empty((setup.ns2[i], setup.p, setup.p))
+            for g in range(setup.ns2[i]):
+                rows = setup.s2_ind[i] == g
+                A[g] = resid[rows] @ resid[rows]
+                b[g] = jac[rows].T @ resid[rows]
+                C[g] = jac[rows].T @ jac[rows]
+            self.resid.append(resid)
+            self.jac.append(jac)
+            self.A.append(A)
+            self.b.append(b)
+            self.C.append(C)
+
+    def proxy_sum(self, i, delta, log_s2):
+        """proxy log-likelihoods of experiment i summed over observations (s2 terms excluded)"""
+        quad = (
+            self.A[i]
+            - 2 * delta @ self.b[i].T
+            + np.einsum("tp,gpq,tq->tg", delta, self.C[i], delta)
+        )
+        return -0.5 * (np.exp(-log_s2) * quad).sum(axis=1)
+
+    def proxy_obs(self, i, idx, delta, w):
+        """proxy log-likelihoods at observations idx of experiment i, weights w = 1 / s2"""
+        r = self.resid[i][idx] - delta @ self.jac[i][idx].T
+        return -0.5 * w * r * r
+
+    def test(
+        self,
+        setup,
+        theta_cand,
+        theta_curr,
+        rows,
+        pred_curr,
+        log_s2,
+        lcorr,
+        runif,
+    ):
+        """
+        Acceptance of the candidates in rows (ntemps) at thresholds runif, and the rows left to
+        the exact test
+        """
+        self.count_test += rows.sum()
+        d_cand, d_curr = (
+            theta_cand - self.theta_ref,
+            theta_curr - self.theta_ref,
+        )
+        proxy_diff = sum(
+            self.proxy_sum(i, d_cand, log_s2[i])
+            - self.proxy_sum(i, d_curr, log_s2[i])
+            for i in range(setup.nexp)
+        )
+        with np.errstate(invalid="ignore"):
+            # acceptance if the mean proxy error over all observations exceeds mu0
+            mu0 = ((runif - lcorr) / setup.itl - proxy_diff) / self.n
+        accept = np.zeros(setup.ntemps, dtype=bool)
+        open_ = rows.copy()
+        tot, totsq, nsub = np.zeros(setup.ntemps), np.zeros(setup.ntemps), 0
+        while np.any(open_) and nsub + self.batch <= self.n / 2:
+            obs = np.random.randint(self.n, size=self.batch)
+            exps = np.searchsorted(self.offsets, obs, side="right") - 1
+            err = np.empty((open_.sum(), self.batch))
+            for i in np.unique(exps):
+                cols = np.where(exps == i)[0]
+                idx = obs[cols] - self.offsets[i]
+                w = np.exp(-log_s2[i][open_][:, setup.s2_ind[i][idx]])
+                pred = setup.models[i].eval_obs(
                     tran_unif(
-                        theta[i][m].reshape(
-                            setup.ntemps * setup.ntheta[i], setup.p
-                        ),
-                        setup.bounds_mat,
-                        setup.bounds.keys(),
+                        theta_cand[open_], setup.bounds_mat, setup.bounds.keys()
                     ),
-                    pool=False,
+                    idx,
                 )
-                for t in range(setup.ntemps):
-                    for j in range(setup.ntheta[i]):
-                        llik_curr[i][t][j] = setup.models[i].llik(
-                            setup.ys[i][theta_which_mat[i][j]],
-                            pred_curr[i][t][theta_which_mat[i][j]],
-                            marg_lik_cov_curr[i][t][j],
-                        )
-        # No discrepancy for now...update here if added later
+                r_cand = setup.ys[i][idx] - pred
+                r_curr = setup.ys[i][idx] - pred_curr[i][open_][:, idx]
+                err[:, cols] = (
+                    -0.5 * w * (r_cand * r_cand - r_curr * r_curr)
+                    - self.proxy_obs(i, idx, d_cand[open_], w)
+                    + self.proxy_obs(i, idx, d_curr[open_], w)
+                )
+            self.count_obs += err.size
+            nsub += self.batch
+            tot[open_] += err.sum(axis=1)
+            totsq[open_] += (err * err).sum(axis=1)
+            mean = tot / nsub
+            se = np.sqrt(
+                np.maximum(totsq / nsub - mean * mean, 0.0) / (nsub - 1)
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                decided = open_ & (np.abs(mean - mu0) > self.z * se)
+            accept[decided] = mean[decided] > mu0[decided]
+            open_ &= ~decided
+        self.count_exact += open_.sum()
+        return accept, open_
 
-        # ------------------------------------------------------------------------------------------
-        ## adaptive Metropolis for each temperature / experiment
-        # if m > 300:
-        #     for i in range(setup.nexp):
-        #         mu[i] += (theta[i][m-1] - mu[i]) / m
-        #         cov[i][:] = (
-        #             + ((m-1) / m) * cov[i]
-        #             + ((m-1) / (m * m)) * np.einsum(
-        #                 'tej,tel->tejl', theta[i][m-1] - mu[i], theta[i][m-1] - mu[i],
-        #                 )
-        #             )
-        #         S[i] = AM_SCALAR * np.einsum(
-        #             'tejl,te->tejl', cov[i] + np.eye(setup.p) * eps, np.exp(tau[i]),
-        #             )
-        # elif m == 300:
-        #     for i in range(setup.nexp):
-        #         mu[i][:]  = theta[i][:m].mean(axis = 0)
-        #         cov[i][:] = cov_4d_pcm(theta[i][:m], mu[i])
-        #         S[i][:]   = AM_SCALAR * np.einsum('tejl,te->tejl', cov[i] + np.eye(setup.p) * eps, np.exp(tau[i]))
-        # else:
-        #     pass
 
-        cov_theta_cand.update(theta, m)
-        # ------------------------------------------------------------------------------------------
-        # MCMC update for thetas
-        theta_cand = cov_theta_cand.gen_cand(theta, m)
+def llik_bounds(setup, engine, sse, log_s2, covs):
+    """upper bounds (nexp x ntemps) of the pooled log-likelihoods over predictions, at log_s2"""
+    out = np.empty((setup.nexp, setup.ntemps))
+    for i in range(setup.nexp):
+        if engine[i] is not None:
+            out[i] = engine[i].llik(np.zeros_like(sse[i]), log_s2[i])[:, 0]
+            continue
+        for t in range(setup.ntemps):
+            out[i, t] = setup.models[i].llik_bound(covs[i][t])
+    return out
 
-        for i in range(setup.nexp):
-            # Find new candidate values for theta
-            theta_eval_mat[i][:] = theta[i][m - 1].reshape(
-                setup.ntemps * setup.ntheta[i], setup.p
+
+##############################################################################################################################################################################
+## Hierarchical Calibration
+
+
+class HierShard:
+    """
+    Experiment-level state of hierarchical calibration for a group of experiments.
+
+    Given theta0 and Sigma0, the experiments are conditionally independent, so the theta_i
+    and s2 updates of each group can run in its own process (see ShardWorker).  Shards only
+    report sufficient statistics back, per experiment: sums of theta_i and of their outer
+    products for the theta0/Sigma0 Gibbs updates, and per-temperature sums of log-probability
+    terms for the decorrelation step and tempering swaps.
+
+    Random numbers come from the global numpy generator of the process running the shard.
+
+    :param setup : CalibSetup object
+    :param exps : indices of the experiments owned by this shard
+    """
+
+    def __init__(self, setup, exps):
+        self.setup = setup
+        self.exps = list(exps)
+        nexp = len(self.exps)
+        ntheta = [setup.ntheta[i] for i in self.exps]
+        self.log_s2 = [
+            np.zeros([setup.nmcmc, setup.ntemps, setup.ns2[i]]) + 0.0
+            for i in self.exps
+        ]
+        self.theta = [
+            np.zeros([setup.nmcmc, setup.ntemps, setup.ntheta[i], setup.p])
+            + 0.0
+            for i in self.exps
+        ]
+        self.theta_which_mat = [
+            [
+                np.where(setup.theta_ind[i] == j)[0]
+                for j in range(setup.ntheta[i])
+            ]
+            for i in self.exps
+        ]
+        # matrix of temperatures for use with alpha calculation--to skip nested for loops.
+        self.itl_mat = [
+            (np.ones((setup.ntheta[i], setup.ntemps)) * setup.itl).T
+            for i in self.exps
+        ]
+        self.pred_curr = [None] * nexp  # [e], ntemps x ylens[i]
+        self.llik_curr = [None] * nexp  # [e], ntemps x ntheta[i]
+        self.marg_lik_cov_curr = [None] * nexp
+        # vectorized likelihoods (diagonal Gaussian models), with cached residual sums of squares
+        engines = fidelity_engines(setup, lik_engines(setup), pooled=False)
+        self.engine = [engines[i] for i in self.exps]
+        self.sse_curr = [None] * nexp  # [e], ntemps x ncell
+        # observations per s2 group, at the fidelity of each temperature if a ladder is set
+        self.ny_s2 = [
+            engines[i].ny_s2
+            if isinstance(engines[i], FidelityEngine)
+            else setup.ny_s2[i]
+            for i in self.exps
+        ]
+        self.levels = setup.fidelity_levels
+        self.swap_cache = {}  # (e, state, level) -> state evaluated at another fidelity
+        self.decor_cand = None
+
+        self.cov_theta_cand = theta_proposal(setup, ntheta)
+        self.cov_ls2_cand = [
+            AMcov_pool(
+                setup.ntemps,
+                setup.ns2[i],
+                start_var=setup.start_var_ls2,
+                start_adapt_iter=setup.start_adapt_iter,
+                tau_start=setup.start_tau_ls2,
             )
-            # theta_cand[i][:] = chol_sample_1per(theta[i][m-1], S[i])
-            theta_cand_mat[i][:] = theta_cand[i].reshape(
-                setup.ntemps * setup.ntheta[i], setup.p
+            for i in self.exps
+        ]
+        self.count = [np.zeros((setup.ntemps, n)) for n in ntheta]
+        self.count_s2 = np.zeros([nexp, setup.ntemps], dtype=int)
+
+    def send(self, name, *args):
+        # same interface as ShardWorker, evaluated in-process
+        self.out = getattr(self, name)(*args)
+
+    def recv(self):
+        return self.out
+
+    def eval(self, e, theta, rows=None, levels=None):
+        """
+        predictions at theta for experiment e, evaluating only rows (see eval_theta), at the
+        fidelity of each temperature or at levels
+        """
+        return eval_theta(
+            self.setup,
+            self.exps[e],
+            theta,
+            rows,
+            self.pred_curr[e],
+            self.levels if levels is None else levels,
+        )
+
+    def llik(self, e, pred, log_s2, covs=None, levels=None):
+        """
+        log-likelihood (ntemps x ntheta[i]) and cached sums of squares for experiment e, at the
+        fidelity of each temperature or at levels
+        """
+        i = self.exps[e]
+        if self.engine[e] is not None:
+            lev = () if levels is None else (levels,)
+            sse = self.engine[e].sse(pred, *lev)
+            return self.engine[e].llik(sse, log_s2, *lev), sse
+        return (
+            llik_theta(
+                self.setup.models[i],
+                self.setup.ys[i],
+                pred,
+                self.marg_lik_cov_curr[e] if covs is None else covs,
+                self.theta_which_mat[e],
+            ),
+            None,
+        )
+
+    def set_cov(self, e, log_s2):
+        # likelihood covariances for models without a vectorized likelihood
+        if self.engine[e] is None:
+            i = self.exps[e]
+            self.marg_lik_cov_curr[e] = lik_cov_theta(
+                self.setup.models[i],
+                log_s2,
+                self.setup.s2_ind[i],
+                self.theta_which_mat[e],
             )
-            # Check constraints
-            good_values_mat[i][:] = setup.checkConstraints(
-                tran_unif(
-                    theta_cand_mat[i], setup.bounds_mat, setup.bounds.keys()
-                )
+
+    def theta_stats(self, m):
+        """
+        sums of theta_i and of theta_i theta_i^T for each experiment (nexp x ntemps x ...),
+        summed over experiments by sum_exps
+        """
+        tsum = np.stack([theta[m].sum(axis=1) for theta in self.theta])
+        tsum2 = np.stack([
+            np.einsum("tnp,tnq->tpq", theta[m], theta[m])
+            for theta in self.theta
+        ])
+        return tsum, tsum2
+
+    def init(self, theta0, Sigma0):
+        setup = self.setup
+        for e, i in enumerate(self.exps):
+            self.log_s2[e][0] = np.log(setup.sd_est[i] ** 2)
+            self.theta[e][0] = chol_sample_nper_constraints(
+                theta0,
+                Sigma0,
+                setup.ntheta[i],
+                setup.checkConstraints,
+                setup.bounds_mat,
+                setup.bounds.keys(),
+                setup.bounds,
+                setup.constants,
+                check=setup.checkConstraintsUnit,
             )
-            good_values[i][:] = good_values_mat[i].reshape(
-                setup.ntemps, setup.ntheta[i]
+            self.pred_curr[e] = self.eval(e, self.theta[e][0])
+            # right now, assuming for vectorized models that new theta means new s2.
+            # if you wanted to have multiple s2 for one theta, you would have to update thetas
+            # jointly or sequentially (not independently), unless working with diagonal
+            self.set_cov(e, self.log_s2[e][0])
+            self.llik_curr[e], self.sse_curr[e] = self.llik(
+                e, self.pred_curr[e], self.log_s2[e][0]
             )
-            # Generate Predictions at new Theta values
-            theta_eval_mat[i][good_values_mat[i]] = theta_cand_mat[i][
-                good_values_mat[i]
-            ]
-            pred_cand[i][:] = setup.models[i].eval(
-                tran_unif(
-                    theta_eval_mat[i], setup.bounds_mat, setup.bounds.keys()
-                ),
-                pool=False,
-            )  # .reshape(setup.ntemps, setup.y_lens[i])
-
-            # marg_lik_cov_curr[i] = [None] * setup.ntemps
-            for t in range(setup.ntemps):
-                for j in range(setup.ntheta[i]):
-                    # marg_lik_cov_curr[i][t][j] = setup.models[i].lik_cov_inv(np.exp(log_s2[i][0, t, setup.s2_ind[i]])[setup.s2_ind[i]==j])
-                    llik_cand[i][t][j] = setup.models[i].llik(
-                        setup.ys[i][theta_which_mat[i][j]],
-                        pred_cand[i][t][theta_which_mat[i][j]],
-                        marg_lik_cov_curr[i][t][j],
-                    )
 
-            # sse_cand[i][:] = ((pred_cand[i] - setup.ys[i])**2 @ s2_ind_mat[i]) / s2[i][m-1]
-            # Calculate log-probability of MCMC accept
-            alpha[i][:] = -np.inf
-            alpha[i][good_values[i]] = itl_mat[i][good_values[i]] * (
-                # - 0.5 * (sse_cand[i][good_values[i]] - sse_curr[i][good_values[i]])
-                llik_cand[i][good_values[i]]
-                - llik_curr[i][good_values[i]]
-                + mvnorm_logpdf_(
-                    theta_cand[i],
-                    theta0[m - 1],
-                    Sigma0_inv_curr,
-                    Sigma0_ldet_curr,
-                )[good_values[i]]
-                - mvnorm_logpdf_(
-                    theta[i][m - 1],
-                    theta0[m - 1],
-                    Sigma0_inv_curr,
-                    Sigma0_ldet_curr,
-                )[good_values[i]]
+    def step(self, m, refresh, theta0, Sigma0_inv, Sigma0_ldet):
+        """
+        theta_i and s2 updates of iteration m given the previous theta0, Sigma0
+
+        :return : sufficient statistics for the theta0 and Sigma0 Gibbs updates (see theta_stats)
+        """
+        setup = self.setup
+        for e, i in enumerate(self.exps):
+            # current set to previous, will change if accepted
+            self.theta[e][m] = self.theta[e][m - 1].copy()
+            self.log_s2[e][m] = self.log_s2[e][m - 1].copy()
+            if setup.models[i].stochastic and refresh:  # update emulator
+                setup.models[i].step()
+                self.pred_curr[e] = self.eval(e, self.theta[e][m])
+                self.llik_curr[e], self.sse_curr[e] = self.llik(
+                    e, self.pred_curr[e], self.log_s2[e][m]
+                )
+        # No discrepancy for now...update here if added later
+
+        ## adaptive Metropolis for each temperature / experiment
+        self.cov_theta_cand.update(self.theta, m)
+        theta_cand = self.cov_theta_cand.gen_cand(self.theta, m)
+        for e in range(len(self.exps)):
+            self.update_theta(
+                e, m, theta_cand[e], theta0, Sigma0_inv, Sigma0_ldet
             )
-            # MCMC Accept
-            accept[i][:] = np.log(uniform(size=alpha[i].shape)) < alpha[i]
-            # Where accept, make changes
-            theta[i][m][accept[i]] = theta_cand[i][accept[i]].copy()
-            # ind = accept[i] @ theta_ind_mat[i].T
-            # pred_curr[i][ind] = pred_cand[i][ind].copy()
-
-            for t in range(setup.ntemps):
-                accept_t = np.where(accept[i][t])[0]
-                if accept_t.shape[0] > 0:
-                    ind = np.hstack([theta_which_mat[i][j] for j in accept_t])
-                    pred_curr[i][t][ind] = pred_cand[i][t][ind].copy()
-                # for j in np.where(accept[i][t])[0]:
-                #    pred_curr[i][t][theta_which_mat[i][j]] = pred_cand[i][t][theta_which_mat[i][j]]
-            llik_curr[i][accept[i]] = llik_cand[i][accept[i]].copy()
-            count[i][accept[i]] += 1
-            cov_theta_cand.count_100[i][accept[i]] += 1
-            # count_100[i][accept[i]] += 1
+        self.cov_theta_cand.update_tau(m)
+
+        for e in range(len(self.exps)):
+            self.update_s2(e, m)
+        return self.theta_stats(m)
+
+    def update_theta(self, e, m, theta_cand, theta0, Sigma0_inv, Sigma0_ldet):
+        setup = self.setup
+        theta = self.theta[e]
+        # Check constraints
+        good = setup.checkConstraintsUnit(
+            theta_cand.reshape(-1, setup.p)
+        ).reshape(theta_cand.shape[:2])
+        # Generate Predictions at new Theta values (valid ones only)
+        pred_cand = self.eval(e, theta_cand, good)
+        llik_cand, sse_cand = self.llik(e, pred_cand, self.log_s2[e][m - 1])
+        # Calculate log-probability of MCMC accept
+        alpha = np.full(good.shape, -np.inf)
+        alpha[good] = (
+            self.itl_mat[e][good]
+            * (
+                llik_cand[good]
+                - self.llik_curr[e][good]
+                + mvnorm_logpdf_(theta_cand, theta0, Sigma0_inv, Sigma0_ldet)[
+                    good
+                ]
+                - mvnorm_logpdf_(theta[m - 1], theta0, Sigma0_inv, Sigma0_ldet)[
+                    good
+                ]
+            )
+            + self.cov_theta_cand.lcorr[e][good]
+        )
+        # MCMC Accept
+        accept = np.log(uniform(size=alpha.shape)) < alpha
+        # Where accept, make changes
+        theta[m][accept] = theta_cand[accept].copy()
+        self.accept(e, accept, pred_cand, llik_cand, sse_cand)
+        self.count[e][accept] += 1
+        self.cov_theta_cand.count_100[e][accept] += 1
+
+    def accept(self, e, accept, pred_cand, llik_cand, sse_cand):
+        # accept: ntemps x ntheta[i]
+        ind = accept[:, self.setup.theta_ind[self.exps[e]]]  # ntemps x ylens[i]
+        self.pred_curr[e][ind] = pred_cand[ind]
+        if self.engine[e] is not None:
+            ind = accept[:, self.engine[e].cell_theta]  # ntemps x ncell
+            self.sse_curr[e][ind] = sse_cand[ind]
+        self.llik_curr[e][accept] = llik_cand[accept].copy()
+
+    def update_s2(self, e, m):
+        setup = self.setup
+        i = self.exps[e]
+        log_s2 = self.log_s2[e]
+        if setup.models[i].s2 == "gibbs":
+            ## gibbs update s2
+            if (
+                self.engine[e] is not None
+            ):  # from cached sums of squares, O(ns2)
+                dev_sq = self.engine[e].dev_sq(self.sse_curr[e])
+            else:
+                dev_sq = setup.models[i].dev_sq(
+                    setup.ys[i],
+                    self.pred_curr[e],
+                    setup.s2_ind[i],
+                    setup.ns2[i],
+                )  # squared deviations
+            log_s2[m] = np.log(
+                1
+                / np.random.gamma(
+                    self.itl_mat[e] * (self.ny_s2[e] / 2 + setup.ig_a[i] + 1)
+                    - 1,
+                    1 / (self.itl_mat[e] * (setup.ig_b[i] + dev_sq / 2)),
+                )
+            )
+            if self.engine[e] is not None:
+                self.llik_curr[e][:] = self.engine[e].llik(
+                    self.sse_curr[e], log_s2[m]
+                )
+            else:
+                self.set_cov(e, log_s2[m])
+                self.llik_curr[e][:] = self.llik(
+                    e, self.pred_curr[e], log_s2[m]
+                )[0]
 
-        cov_theta_cand.update_tau(m)
+        elif setup.models[i].s2 == "fix":
+            log_s2[m] = np.log(setup.sd_est[i] ** 2)
+
+        else:
+            ## M-H update s2
+            # NOTE: there is something wrong with this...with no tempering, 10 kolski experiments,
+            # reasonable priors, s2 can diverge for some experiments (not a random walk, has weird patterns).
+            # This seems to be because of the joint update, but is strange.  Could be that individual updates
+            # would make it go away, but it shouldn't be there anyway.
+            self.cov_ls2_cand[e].update(log_s2, m)
+            ls2_cand = self.cov_ls2_cand[e].gen_cand(log_s2, m)
+
+            if self.engine[e] is not None:
+                covs_cand = None
+                llik_cand = self.engine[e].llik(self.sse_curr[e], ls2_cand)
+            else:
+                covs_cand = lik_cov_theta(
+                    setup.models[i],
+                    ls2_cand,
+                    setup.s2_ind[i],
+                    self.theta_which_mat[e],
+                )
+                llik_cand = self.llik(
+                    e, self.pred_curr[e], ls2_cand, covs_cand
+                )[0]
+
+            alpha_s2 = setup.itl * (llik_cand - self.llik_curr[e])
+            alpha_s2 += setup.itl * setup.s2_prior_kern[i](
+                np.exp(ls2_cand), setup.ig_a[i], setup.ig_b[i]
+            ).sum(axis=1)
+            alpha_s2 += setup.itl * ls2_cand.sum(axis=1)
+            alpha_s2 -= setup.itl * setup.s2_prior_kern[i](
+                np.exp(log_s2[m - 1]), setup.ig_a[i], setup.ig_b[i]
+            ).sum(axis=1)
+            alpha_s2 -= setup.itl * log_s2[m - 1].sum(axis=1)
+
+            runif = np.log(uniform(size=setup.ntemps))
+            for t in np.where(runif < alpha_s2)[0]:
+                self.count_s2[e, t] += 1
+                self.llik_curr[e][t] = llik_cand[t].copy()
+                log_s2[m][t] = ls2_cand[t].copy()
+                if covs_cand is not None:
+                    self.marg_lik_cov_curr[e][t] = covs_cand[t].copy()
+                self.cov_ls2_cand[e].count_100[t] += 1
+
+            self.cov_ls2_cand[e].update_tau(m)
+
+    def decor_alpha(
+        self, m, k, z, theta0_cand, good_theta0, theta0, Sigma0_inv, Sigma0_ldet
+    ):
+        """
+        shift every theta_i along dimension k with theta0 (joint decorrelation step)
 
-        # if m>10000:
-        #    print('help')
-
-        # # Adaptive Metropolis Update
-        # if m % 100 == 0 and m > 300:
-        #     delta = min(0.1, 1/np.sqrt(m+1)*5)
-        #     for i in range(setup.nexp):
-        #         tau[i][count_100[i] < 23] -= delta
-        #         tau[i][count_100[i] > 23] += delta
-        #         count_100[i] *= 0
-
-        ## Decorrelation Step
-        # if False:  # m % setup.decor == 0:
-        #     for i in range(setup.nexp):
-        #         for k in range(setup.p):
-        #             # Find new candidate values for theta
-        #             theta_cand[i][:] = theta[i][m].copy()
-        #             theta_eval_mat[i][:] = theta[i][m].reshape(
-        #                 setup.ntheta[i] * setup.ntemps, setup.p
-        #             )
-        #             theta_cand[i][:, :, k] = initfunc(
-        #                 size=(setup.ntemps, setup.ntheta[i])
-        #             )
-        #             theta_cand_mat[i][:] = theta_cand[i].reshape(
-        #                 setup.ntheta[i] * setup.ntemps, setup.p
-        #             )
-        #             # Compute constraint flags
-        #             good_values_mat[i][:] = setup.checkConstraints(
-        #                 tran(
-        #                     theta_cand_mat[i],
-        #                     setup.bounds_mat,
-        #                     setup.bounds.keys(),
-        #                 )
-        #             )
-        #             # Generate predictions at "good" candidate values
-        #             theta_eval_mat[i][good_values_mat[i]] = theta_cand_mat[i][
-        #                 good_values_mat[i]
-        #             ]
-        #             good_values[i][:] = good_values_mat[i].reshape(
-        #                 setup.ntemps, setup.ntheta[i]
-        #             )
-        #             pred_cand[i][:] = setup.models[i].eval(
-        #                 tran(
-        #                     theta_eval_mat[i],
-        #                     setup.bounds_mat,
-        #                     setup.bounds.keys(),
-        #                 )
-        #             )
-        #             sse_cand[i][:] = (
-        #                 ((pred_cand[i] - setup.ys[i]) ** 2 @ s2_ind_mat[i])
-        #                 / s2[i][m - 1]
-        #             )  ## check the [:] here !!!!! ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        #             # Calculate log-probability of MCMC Accept
-        #             alpha[i][:] = -np.inf
-        #             alpha[i][good_values[i]] = (
-        #                 -0.5
-        #                 * itl_mat[i][good_values[i]]
-        #                 * (
-        #                     sse_cand[i][good_values[i]]
-        #                     - sse_curr[i][good_values[i]]
-        #                 )
-        #                 + itl_mat[i][good_values[i]]
-        #                 * (
-        #                     +mvnorm_logpdf_(
-        #                         theta_cand[i],
-        #                         theta0[m - 1],
-        #                         Sigma0_inv_curr,
-        #                         Sigma0_ldet_curr,
-        #                     )[good_values[i]]
-        #                     - mvnorm_logpdf_(
-        #                         theta[i][m],
-        #                         theta0[m - 1],
-        #                         Sigma0_inv_curr,
-        #                         Sigma0_ldet_curr,
-        #                     )[good_values[i]]
-        #                 )
-        #             )  ## THIS NEEDS SOMETHING FOR THE PROPOSAL~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        #             # MCMC Accept
-        #             accept[i][:] = (
-        #                 np.log(uniform(size=alpha[i].shape)) < alpha[i]
-        #             )
-        #             # Where accept, make changes
-        #             theta[i][m][accept[i]] = theta_cand[i][accept[i]].copy()
-        #             pred_curr[i][accept[i] @ s2_ind_mat[i].T] = pred_cand[i][
-        #                 accept[i] @ s2_ind_mat[i].T
-        #             ].copy()
-        #             sse_curr[i][accept[i]] = sse_cand[i][accept[i]].copy()
-        #             count_decor[i][accept[i], k] = (
-        #                 count_decor[i][accept[i], k] + 1
-        #             )
+        :return : log acceptance probability of each experiment (nexp x ntemps)
+        """
+        setup = self.setup
+        alpha_tot = np.zeros((len(self.exps), setup.ntemps))
+        self.decor_cand = []
+        for e in range(len(self.exps)):
+            theta = self.theta[e][m]
+            # Find new candidate values for theta
+            theta_cand = theta.copy()
+            theta_cand[:, :, k] += z
+            # Compute constraint flags
+            good = setup.checkConstraintsUnit(
+                theta_cand.reshape(-1, setup.p)
+            ).reshape(theta.shape[:2])
+            # Generate predictions at "good" candidate values only
+            good &= good_theta0[:, None]
+            pred_cand = self.eval(e, theta_cand, good)
+            llik_cand, sse_cand = self.llik(e, pred_cand, self.log_s2[e][m])
+
+            alpha = np.full(good.shape, -np.inf)
+            alpha[good] = self.itl_mat[e][good] * (
+                llik_cand[good]
+                - self.llik_curr[e][good]
+                + mvnorm_logpdf_(
+                    theta_cand, theta0_cand, Sigma0_inv, Sigma0_ldet
+                )[good]
+                - mvnorm_logpdf_(theta, theta0, Sigma0_inv, Sigma0_ldet)[good]
+            )
+            alpha_tot[e] = alpha.sum(axis=1)
+            self.decor_cand.append((theta_cand, pred_cand, llik_cand, sse_cand))
+        return alpha_tot
+
+    def decor_accept(self, m, accept_tot):
+        for e, (theta_cand, pred_cand, llik_cand, sse_cand) in enumerate(
+            self.decor_cand
+        ):
+            self.theta[e][m][accept_tot] = theta_cand[accept_tot]
+            self.pred_curr[e][accept_tot] = pred_cand[accept_tot]
+            self.llik_curr[e][accept_tot] = llik_cand[accept_tot]
+            if self.engine[e] is not None:
+                self.sse_curr[e][accept_tot] = sse_cand[accept_tot]
+        self.decor_cand = None
+
+    def swap_terms(self, m, theta0, Sigma0_inv, Sigma0_ldet):
+        """
+        log-probability terms of the shard's states (s2 prior, theta_i | theta0, Sigma0 and
+        likelihood) of each experiment (nexp x ntemps)
+        """
+        setup = self.setup
+        self.swap_cache = {}
+        out = np.zeros((len(self.exps), setup.ntemps))
+        for e, i in enumerate(self.exps):
+            out[e] = (
+                setup.s2_prior_kern[i](
+                    np.exp(self.log_s2[e][m]), setup.ig_a[i], setup.ig_b[i]
+                ).sum(axis=1)
+                + mvnorm_logpdf_(
+                    self.theta[e][m], theta0, Sigma0_inv, Sigma0_ldet
+                ).sum(axis=1)
+                + self.llik_curr[e].sum(axis=1)
+            )
+        return out
 
-        # ------------------------------------------------------------------------------------------
-        ## update s2
-        for i in range(setup.nexp):
-            if setup.models[i].s2 == "gibbs":
-                ## gibbs update s2
-                dev_sq = (pred_curr[i] - setup.ys[i]) ** 2 @ s2_ind_mat[
-                    i
-                ]  # squared deviations
-                log_s2[i][m] = np.log(
-                    1
-                    / np.random.gamma(
-                        itl_mat[i] * (setup.ny_s2[i] / 2 + setup.ig_a[i] + 1)
-                        - 1,
-                        1 / (itl_mat[i] * (setup.ig_b[i] + dev_sq / 2)),
-                    )
+    def swap_llik(self, m, states, levels):
+        """
+        log-likelihoods of each experiment (nexp x len(states)) of the states at temperatures
+        states (before this iteration's swaps) evaluated at fidelity levels.  States at another
+        level than their own are evaluated and kept for swap_apply.
+        """
+        out = np.zeros((len(self.exps), len(states)))
+        other = levels != self.levels[states]
+        for e in range(len(self.exps)):
+            out[e] = self.llik_curr[e][states].sum(axis=1)
+            if not np.any(other):
+                continue
+            src = states[other]
+            covs = self.marg_lik_cov_curr[e]
+            pred = self.eval(e, self.theta[e][m][src], levels=levels[other])
+            llik, sse = self.llik(
+                e,
+                pred,
+                self.log_s2[e][m][src],
+                None if covs is None else [covs[t] for t in src],
+                levels[other],
+            )
+            out[e, other] = llik.sum(axis=1)
+            for r, (t, k) in enumerate(zip(src, levels[other])):
+                self.swap_cache[e, t, k] = (
+                    pred[r],
+                    None if sse is None else sse[r],
+                    llik[r],
                 )
-                for t in range(setup.ntemps):
-                    s2_stretched = log_s2[i][m][t, setup.theta_ind[i]]
-                    for j in range(setup.ntheta[i]):
-                        marg_lik_cov_curr[i][t][j] = setup.models[
-                            i
-                        ].lik_cov_inv(np.exp(s2_stretched[s2_which_mat[i][j]]))
-                        llik_curr[i][t][j] = setup.models[i].llik(
-                            setup.ys[i][s2_which_mat[i][j]],
-                            pred_curr[i][t][s2_which_mat[i][j]],
-                            marg_lik_cov_curr[i][t][j],
-                        )
+        return out
 
-            elif setup.models[i].s2 == "fix":
-                log_s2[i][m] = np.log(setup.sd_est[i] ** 2)
+    def swap_apply(self, m, perm):
+        # state at temperature t becomes the state previously at temperature perm[t]
+        for e in range(len(self.exps)):
+            self.theta[e][m] = self.theta[e][m][perm]
+            self.log_s2[e][m] = self.log_s2[e][m][perm]
+            self.pred_curr[e] = self.pred_curr[e][perm]
+            self.llik_curr[e] = self.llik_curr[e][perm]
+            if self.engine[e] is None:
+                self.marg_lik_cov_curr[e] = [
+                    self.marg_lik_cov_curr[e][t] for t in perm
+                ]
+            else:
+                self.sse_curr[e] = self.sse_curr[e][perm]
+            if self.levels is None:
+                continue
+            # states now at another fidelity take their evaluations from swap_llik
+            for t in np.where(self.levels != self.levels[perm])[0]:
+                pred, sse, llik = self.swap_cache[e, perm[t], self.levels[t]]
+                self.pred_curr[e][t] = pred
+                self.llik_curr[e][t] = llik
+                if sse is not None:
+                    self.sse_curr[e][t] = sse
+        self.swap_cache = {}
+
+    def result(self):
+        return {
+            "exps": self.exps,
+            "theta": self.theta,
+            "s2": [np.exp(log_s2) for log_s2 in self.log_s2],
+            "count": self.count,
+            "count_s2": self.count_s2,
+            "cov_theta_cand": self.cov_theta_cand,
+            "cov_ls2_cand": self.cov_ls2_cand,
+            "pred_curr": self.pred_curr,
+        }
+
+
+def hier_shard_worker(conn, setup, exps, seed):
+    np.random.seed(seed)
+    shard = HierShard(setup, exps)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        try:
+            shard.send(*msg)
+            conn.send(shard.recv())
+        except Exception as err:  # noqa: BLE001 (re-raised by ShardWorker.recv)
+            conn.send(err)
+            break
+    for model in setup.models:
+        if hasattr(model, "close"):  # worker pools started in this process
+            model.close()
+    conn.close()
+
+
+class ShardWorker:
+    """
+    HierShard running in a separate process, driven through a pipe.  The process is not a
+    daemon, so models can start their own worker pools (ncores); close() joins it.
+    """
 
-                # for t in range(setup.ntemps):
-                #    for j in range(setup.ntheta[i]):
-                #        marg_lik_cov_curr[i][t][j] = setup.models[i].lik_cov_inv(np.exp(log_s2[i][m][t, setup.s2_ind[i]])[setup.s2_ind[i]==j])
-                #        llik_curr[i][t][j] = setup.models[i].llik(setup.ys[i][setup.theta_ind[i]==j], pred_curr[i][t][setup.theta_ind[i]==j], marg_lik_cov_curr[i][t][j])
-
-            else:  # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                # this needs to be fixed ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                ## M-H update s2
-                # NOTE: there is something wrong with this...with no tempering, 10 kolski experiments,
-                # reasonable priors, s2 can diverge for some experiments (not a random walk, has weird patterns).
-                # This seems to be because of the joint update, but is strange.  Could be that individual updates
-                # would make it go away, but it shouldn't be there anyway.
+    def __init__(self, setup, exps, seed):
+        self.conn, child = Pipe()
+        self.process = Process(
+            target=hier_shard_worker,
+            args=(child, setup, exps, seed),
+        )
+        self.process.start()
+        child.close()
 
-                cov_ls2_cand[i].update(log_s2[i], m)
-                ls2_candi = cov_ls2_cand[i].gen_cand(log_s2[i], m)
+    def send(self, name, *args):
+        self.conn.send((name,) + args)
 
-                llik_candi = np.zeros([setup.ntemps, setup.ntheta[i]])
-                marg_lik_cov_candi = [None] * setup.ntemps
-                for t in range(setup.ntemps):
-                    marg_lik_cov_candi[t] = [None] * setup.ntheta[i]
-                    for j in range(setup.ntheta[i]):
-                        marg_lik_cov_candi[t][j] = setup.models[i].lik_cov_inv(
-                            np.exp(ls2_candi[t, setup.s2_ind[i]])[
-                                setup.s2_ind[i] == j
-                            ]
-                        )  # s2[i][0, t, setup.s2_ind[i]])
-                        llik_candi[t][j] = setup.models[i].llik(
-                            setup.ys[i][setup.theta_ind[i] == j],
-                            pred_curr[i][t][setup.theta_ind[i] == j],
-                            marg_lik_cov_candi[t][j],
-                        )
-                        # something wrong still, getting way too large of variance
-                    # marg_lik_cov_candi[t] = setup.models[i].lik_cov_inv(np.exp(ls2_candi[t])[setup.s2_ind[i]])#s2[i][0, t, setup.s2_ind[i]])
-                    # llik_candi[t] = setup.models[i].llik(setup.ys[i], pred_curr[i][t], marg_lik_cov_candi[t])
+    def recv(self):
+        out = self.conn.recv()
+        if isinstance(out, Exception):
+            raise out
+        return out
 
-                llik_diffi = llik_candi - llik_curr[i]
-                alpha_s2 = setup.itl * (llik_diffi)
-                alpha_s2 += (
-                    setup.itl
-                    * setup.s2_prior_kern[i](
-                        np.exp(ls2_candi), setup.ig_a[i], setup.ig_b[i]
-                    ).sum(axis=1)
-                )  # ldhc_kern(np.exp(ls2_cand[i])).sum(axis=1)#ldig_kern(np.exp(ls2_cand[i]),setup.ig_a[i],setup.ig_b[i]).sum(axis=1)
-                alpha_s2 += setup.itl * ls2_candi.sum(axis=1)
-                alpha_s2 -= (
-                    setup.itl
-                    * setup.s2_prior_kern[i](
-                        np.exp(log_s2[i][m - 1]), setup.ig_a[i], setup.ig_b[i]
-                    ).sum(axis=1)
-                )  # ldhc_kern(np.exp(log_s2[i][m-1])).sum(axis=1)#ldig_kern(np.exp(log_s2[i][m-1]),setup.ig_a[i],setup.ig_b[i]).sum(axis=1)
-                alpha_s2 -= setup.itl * log_s2[i][m - 1].sum(axis=1)
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):  # worker exited since the check
+                pass
+        self.process.join()
 
-                runif = np.log(uniform(size=setup.ntemps))
-                for t in np.where(runif < alpha_s2)[0]:
-                    count_s2[i, t] += 1
-                    llik_curr[i][t] = llik_candi[t].copy()
-                    log_s2[i][m][t] = ls2_candi[t].copy()
-                    marg_lik_cov_curr[i][t] = marg_lik_cov_candi[t].copy()
-                    cov_ls2_cand[i].count_100[t] += 1
 
-                cov_ls2_cand[i].update_tau(m)
+def call_shards(shards, name, *args):
+    # send to every shard before waiting on any, so worker processes run concurrently
+    for shard in shards:
+        shard.send(name, *args)
+    return [shard.recv() for shard in shards]
 
-        if False:
-            ## MH update s2
-            for i in range(setup.nexp):
-                cov_ls2_cand[i].update(log_s2[i], m)
-                llik_cand[i][:] = 0.0
 
-            ls2_cand = [
-                cov_ls2_cand[i].gen_cand(log_s2[i], m)
-                for i in range(setup.nexp)
-            ]
+def sum_exps(groups, terms):
+    """
+    sum over experiments of the per-experiment terms returned by each shard, in experiment
+    order so the result does not depend on the sharding
+    """
+    order = np.argsort(np.concatenate(groups))
+    return np.concatenate(terms)[order].sum(axis=0)
 
-            marg_lik_cov_cand = [None] * setup.nexp
-            for i in range(setup.nexp):
-                marg_lik_cov_cand[i] = [None] * setup.ntemps
-                for t in range(setup.ntemps):
-                    marg_lik_cov_cand[i][t] = [None] * setup.ntheta[i]
-                    for j in range(setup.ntheta[i]):
-                        marg_lik_cov_cand[i][t][j] = setup.models[
-                            i
-                        ].lik_cov_inv(
-                            np.exp(ls2_cand[i][t, setup.s2_ind[i]])[
-                                setup.s2_ind[i] == j
-                            ]
-                        )  # s2[i][0, t, setup.s2_ind[i]])
-                        llik_cand[i][t][j] = setup.models[i].llik(
-                            setup.ys[i][setup.theta_ind[i] == j],
-                            pred_curr[i][t][setup.theta_ind[i] == j],
-                            marg_lik_cov_cand[i][t][j],
-                        )
 
-            ## joint update for ntheta[i] s2s
-            # llik_diff = (llik_cand.sum(axis=2) - llik_curr.sum(axis=2)) # should be summing over the nthera axis
-            alpha_s2[:] = -np.inf
-            # alpha_s2 = setup.itl * (llik_diff)
-            for i in range(
-                setup.nexp
-            ):  # this needs help...sum over ntheta axis
-                alpha_s2[i, :] = setup.itl * (
-                    llik_cand[i].sum(axis=1) - llik_curr[i].sum(axis=1)
-                )
-                alpha_s2[i, :] += setup.itl * setup.s2_prior_kern[i](
-                    np.exp(ls2_cand[i]), setup.ig_a[i], setup.ig_b[i]
-                ).sum(axis=1)
-                alpha_s2[i, :] += setup.itl * ls2_cand[i].sum(axis=1)
-                alpha_s2[i, :] -= setup.itl * setup.s2_prior_kern[i](
-                    np.exp(log_s2[i][m - 1]), setup.ig_a[i], setup.ig_b[i]
-                ).sum(axis=1)
-                alpha_s2[i, :] -= setup.itl * log_s2[i][m - 1].sum(axis=1)
+def shard_experiments(setup, nshards):
+    """split experiments into (at most) nshards groups of similar size, ny * ntheta"""
+    size = [setup.y_lens[i] * setup.ntheta[i] for i in range(setup.nexp)]
+    load = np.zeros(nshards)
+    groups = [[] for _ in range(nshards)]
+    for i in np.argsort(size, kind="stable")[::-1]:
+        g = np.argmin(load)
+        groups[g].append(i)
+        load[g] += size[i]
+    return [sorted(group) for group in groups if len(group)]
 
-            runif = np.log(uniform(size=[setup.nexp, setup.ntemps]))
-            for i in range(setup.nexp):
-                for t in np.where(runif[i] < alpha_s2[i])[0]:
-                    if np.any(ls2_cand[0][0] > np.log(100)) and t == 0:
-                        print("bad")
-                    count_s2[i, t] += 1
-                    llik_curr[i][t] = llik_cand[i][t].copy()
-                    log_s2[i][m][t] = ls2_cand[i][t].copy()
-                    marg_lik_cov_curr[i][t] = marg_lik_cov_cand[i][t].copy()
-                    cov_ls2_cand[i].count_100[t] += 1
 
-            for i in range(setup.nexp):
-                cov_ls2_cand[i].update_tau(m)
+# @profile
+def calibHier(setup, nshards=1):
+    """
+    Hierarchical calibration
+
+    :param setup : CalibSetup object
+    :param nshards : (optional) number of worker processes.  Experiments are split into nshards
+        groups, each updated (theta_i, s2) in its own process; only sums of theta_i and their
+        outer products are sent back for the theta0, Sigma0 updates.  Useful when there are many
+        experiments or expensive models.  Default 1 runs everything in this process, on the
+        global numpy random generator.  Each worker process draws from its own generator,
+        seeded from the global one, so seeded chains depend on nshards.
+    """
+    if setup.fidelity_levels is not None and any(
+        obs is not None for level in setup.fidelity_obs for obs in level
+    ):
+        raise ValueError(
+            "calibHier fidelity levels only set model_args, not obs"
+        )
+    t0 = time.time()
+    theta0 = np.zeros([setup.nmcmc, setup.ntemps, setup.p])
+    theta0 += 0.0
+    Sigma0 = np.zeros([setup.nmcmc, setup.ntemps, setup.p, setup.p])
+    Sigma0 += 0.0
+    ntheta = np.sum(setup.ntheta)
 
-            # dev_sq[i][:] = (pred_curr[i] - setup.ys[i])**2 @ s2_ind_mat[i]
-            # s2[i][m] = 1 / np.random.gamma(
-            #     (itl_mat[i] * setup.ny_s2[i] / 2 + setup.ig_a[i] + 1) - 1,
-            #     1 / (itl_mat[i] * (setup.ig_b[i] +  dev_sq[i] / 2)),
-            #     )
-            # sse_curr[i][:] = dev_sq[i] / s2[i][m]
-
-        ## Gibbs update theta0
-        cc = np.linalg.inv(
-            np.einsum("t,tpq->tpq", ntheta * setup.itl, Sigma0_inv_curr)
-            + theta0_prior_prec,
+    theta0_start = initfunc_unif(size=[setup.ntemps, setup.p])
+    good = setup.checkConstraintsUnit(theta0_start)
+    while np.any(np.logical_not(good)):
+        theta0_start[np.where(np.logical_not(good))] = initfunc_unif(
+            size=[(np.logical_not(good)).sum(), setup.p]
         )
-        tbar *= 0.0
-        for i in range(setup.nexp):
-            tbar += theta[i][m].sum(axis=1)
-        tbar /= ntheta
-        dd = +np.einsum(
-            "t,tl->tl",
-            setup.itl,
-            np.einsum("tlk,tk->tl", ntheta * Sigma0_inv_curr, tbar),
-        ) + np.dot(theta0_prior_prec, theta0_prior_mean)
-        theta0[m][:] = chol_sample_1per_constraints(
-            np.einsum("tlk,tk->tl", cc, dd),
-            cc,
-            setup.checkConstraints,
-            setup.bounds_mat,
-            setup.bounds.keys(),
-            setup.bounds,
-            setup.constants,
+        good[np.where(np.logical_not(good))] = setup.checkConstraintsUnit(
+            theta0_start[np.where(np.logical_not(good))]
         )
+    theta0[0] = theta0_start
+    Sigma0[0] = np.eye(setup.p) * 0.25**2
 
-        ## Gibbs update Sigma0
-        mat *= 0.0
-        for i in range(setup.nexp):
-            mat += np.einsum(
-                "tnp,tnq->tpq",
-                theta[i][m] - theta0[m].reshape(setup.ntemps, 1, setup.p),
-                theta[i][m] - theta0[m].reshape(setup.ntemps, 1, setup.p),
+    # None, or the fidelity level of each temperature (see CalibSetup.setFidelityLadder)
+    levels = setup.fidelity_levels
+    groups = shard_experiments(setup, nshards)
+    if len(groups) > 1:
+        seeds = np.random.randint(2**31 - 1, size=len(groups))
+        shards = [
+            ShardWorker(setup, exps, seed) for exps, seed in zip(groups, seeds)
+        ]
+    else:
+        groups = [list(range(setup.nexp))]
+        shards = [HierShard(setup, groups[0])]
+
+    try:
+        call_shards(shards, "init", theta0[0], Sigma0[0])
+
+        theta0_prior_mean = setup.theta0_prior_mean  # np.repeat(0.5, setup.p)
+        theta0_prior_cov = setup.theta0_prior_cov  # np.eye(setup.p)*1**2
+        theta0_prior_prec = scipy.linalg.inv(theta0_prior_cov)
+        theta0_prior_ldet = slogdet(theta0_prior_cov)[1]
+
+        Sigma0_prior_df = setup.Sigma0_prior_df  # setup.p
+        Sigma0_prior_scale = (
+            setup.Sigma0_prior_scale
+        )  # np.eye(setup.p)*1**2#/setup.p
+        Sigma0_dfs = Sigma0_prior_df + ntheta * setup.itl
+
+        Sigma0_ldet_curr = slogdet(Sigma0[0])[1]
+        Sigma0_inv_curr = np.linalg.inv(Sigma0[0])
+
+        count_temper = np.zeros([setup.ntemps, setup.ntemps])
+        count_decor2 = np.zeros((setup.ntemps, setup.p))
+        sw_alpha = np.zeros(setup.nswap_per)
+
+        ## start MCMC
+        for m in pbar(range(1, setup.nmcmc)):
+            refresh = setup.emulatorRefresh(m)
+            # theta_i, s2 updates, returning sums of theta_i and theta_i theta_i^T
+            stats = call_shards(
+                shards,
+                "step",
+                m,
+                refresh,
+                theta0[m - 1],
+                Sigma0_inv_curr,
+                Sigma0_ldet_curr,
             )
-        Sigma0_scales = Sigma0_prior_scale + np.einsum(
-            "t,tml->tml", setup.itl, mat
-        )
-        for t in range(setup.ntemps):
-            Sigma0[m, t] = invwishart.rvs(
-                df=Sigma0_dfs[t], scale=Sigma0_scales[t]
+            tsum = sum_exps(groups, [s[0] for s in stats])
+            tsum2 = sum_exps(groups, [s[1] for s in stats])
+
+            ## Gibbs update theta0
+            cc = np.linalg.inv(
+                np.einsum("t,tpq->tpq", ntheta * setup.itl, Sigma0_inv_curr)
+                + theta0_prior_prec,
+            )
+            tbar = tsum / ntheta
+            dd = +np.einsum(
+                "t,tl->tl",
+                setup.itl,
+                np.einsum("tlk,tk->tl", ntheta * Sigma0_inv_curr, tbar),
+            ) + np.dot(theta0_prior_prec, theta0_prior_mean)
+            theta0[m][:] = chol_sample_1per_constraints(
+                np.einsum("tlk,tk->tl", cc, dd),
+                cc,
+                setup.checkConstraints,
+                setup.bounds_mat,
+                setup.bounds.keys(),
+                setup.bounds,
+                setup.constants,
+                check=setup.checkConstraintsUnit,
             )
-        Sigma0_ldet_curr[:] = np.linalg.slogdet(Sigma0[m])[1]
-        Sigma0_inv_curr[:] = np.linalg.inv(Sigma0[m])
 
-        # better decorrelation step, joint
-        if m % setup.decor == 0:
-            for k in range(setup.p):
-                z = np.random.normal() * 0.1
-                theta0_cand = theta0[m].copy()
-                theta0_cand[:, k] += z
-                good_values_theta0 = setup.checkConstraints(
-                    tran_unif(
-                        theta0_cand, setup.bounds_mat, setup.bounds.keys()
-                    )
-                )
+            ## Gibbs update Sigma0
+            # sum of (theta_i - theta0)(theta_i - theta0)^T, from the shard sums
+            cross = np.einsum("tp,tq->tpq", tsum, theta0[m])
+            mat = (
+                tsum2
+                - cross
+                - np.swapaxes(cross, 1, 2)
+                + ntheta * np.einsum("tp,tq->tpq", theta0[m], theta0[m])
+            )
+            Sigma0_scales = Sigma0_prior_scale + np.einsum(
+                "t,tml->tml", setup.itl, mat
+            )
+            Sigma0[m], _, Sigma0_inv_curr[:], Sigma0_ldet_curr[:] = (
+                invwishart_rvs_batch(Sigma0_dfs, Sigma0_scales)
+            )
 
-                for i in range(setup.nexp):
-                    # Find new candidate values for theta
-                    theta_cand[i][:] = theta[i][m].copy()
-                    theta_eval_mat[i][:] = theta[i][m].reshape(
-                        setup.ntheta[i] * setup.ntemps, setup.p
-                    )
-                    theta_cand[i][:, :, k] += z
-                    theta_cand_mat[i][:] = theta_cand[i].reshape(
-                        setup.ntheta[i] * setup.ntemps, setup.p
-                    )
-                    # Compute constraint flags
-                    good_values_mat[i][:] = setup.checkConstraints(
-                        tran_unif(
-                            theta_cand_mat[i],
-                            setup.bounds_mat,
-                            setup.bounds.keys(),
+            # better decorrelation step, joint
+            if m % setup.decor == 0:
+                for k in range(setup.p):
+                    z = np.random.normal() * 0.1
+                    theta0_cand = theta0[m].copy()
+                    theta0_cand[:, k] += z
+                    good_values_theta0 = setup.checkConstraintsUnit(theta0_cand)
+                    # now sum over alpha (for each temperature), add alpha for theta0 to prior, accept or reject
+                    alpha_tot = (
+                        sum_exps(
+                            groups,
+                            call_shards(
+                                shards,
+                                "decor_alpha",
+                                m,
+                                k,
+                                z,
+                                theta0_cand,
+                                good_values_theta0,
+                                theta0[m],
+                                Sigma0_inv_curr,
+                                Sigma0_ldet_curr,
+                            ),
+                        )
+                        - 0.5
+                        * setup.itl
+                        * np.diag(
+                            (theta0_cand - theta0_prior_mean)
+                            @ theta0_prior_prec
+                            @ (theta0_cand - theta0_prior_mean).T
+                        )
+                        + 0.5
+                        * setup.itl
+                        * np.diag(
+                            (theta0[m] - theta0_prior_mean)
+                            @ theta0_prior_prec
+                            @ (theta0[m] - theta0_prior_mean).T
                         )
                     )
-                    # Generate predictions at "good" candidate values
-                    theta_eval_mat[i][good_values_mat[i]] = theta_cand_mat[i][
-                        good_values_mat[i]
-                    ]
-                    good_values[i][:] = (
-                        good_values_mat[i]
-                        .reshape(setup.ntemps, setup.ntheta[i])
-                        .T
-                        * good_values_theta0
-                    ).T
-                    pred_cand[i][:] = setup.models[i].eval(
-                        tran_unif(
-                            theta_eval_mat[i],
-                            setup.bounds_mat,
-                            setup.bounds.keys(),
-                        ),
-                        pool=False,
-                    )  # .reshape(setup.ntemps, setup.ntheta[i], setup.y_lens[i])
-                    # sse_cand[i][:] = ((pred_cand[i] - setup.ys[i])**2 @ s2_ind_mat[i]) / s2[i][m]
-                    for t in range(setup.ntemps):
-                        for j in range(setup.ntheta[i]):
-                            # llik_cand[i][t][j] = setup.models[i].llik(setup.ys[i][setup.theta_ind[i]==j], pred_cand[i][t][setup.theta_ind[i]==j], marg_lik_cov_curr[i][t][j])
-                            llik_cand[i][t][j] = setup.models[i].llik(
-                                setup.ys[i][theta_which_mat[i][j]],
-                                pred_cand[i][t][theta_which_mat[i][j]],
-                                marg_lik_cov_curr[i][t][j],
-                            )
 
-                    alpha[i][:] = -np.inf
-                    alpha[i][good_values[i]] = itl_mat[i][good_values[i]] * (
-                        llik_cand[i][good_values[i]]
-                        - llik_curr[i][good_values[i]]
-                    ) + itl_mat[i][good_values[i]] * (
-                        +mvnorm_logpdf_(
-                            theta_cand[i],
-                            theta0_cand,
-                            Sigma0_inv_curr,
-                            Sigma0_ldet_curr,
-                        )[good_values[i]]
-                        - mvnorm_logpdf_(
-                            theta[i][m],
-                            theta0[m],
-                            Sigma0_inv_curr,
-                            Sigma0_ldet_curr,
-                        )[good_values[i]]
-                    )
-                # now sum over alpha (for each temperature), add alpha for theta0 to prior, accept or reject
-                # alpha_tot = mvnorm_logpdf_(theta0_cand, theta0_prior_mean.reshape(setup.ntemps,setup.p), theta0_prior_prec, theta0_prior_ldet)*itl + sum(alpha)
-                alpha_tot = (
-                    sum(alpha).T
-                    - 0.5
-                    * setup.itl
-                    * np.diag(
-                        (theta0_cand - theta0_prior_mean)
-                        @ theta0_prior_prec
-                        @ (theta0_cand - theta0_prior_mean).T
-                    )
-                    + 0.5
-                    * setup.itl
-                    * np.diag(
-                        (theta0[m] - theta0_prior_mean)
-                        @ theta0_prior_prec
-                        @ (theta0[m] - theta0_prior_mean).T
+                    accept_tot = np.log(uniform(size=setup.ntemps)) < alpha_tot
+                    # Where accept, make changes
+                    theta0[m][accept_tot, :] = theta0_cand[accept_tot, :]
+                    call_shards(shards, "decor_accept", m, accept_tot)
+
+                    count_decor2[accept_tot, k] = (
+                        count_decor2[accept_tot, k] + 1
                     )
-                )
 
-                accept_tot = np.log(uniform(size=setup.ntemps)) < alpha_tot.sum(
-                    axis=0
+            ## tempering swaps
+            if m > setup.start_temper and setup.ntemps > 1:
+                # experiment-level terms for each temperature; swaps permute them
+                lp = sum_exps(
+                    groups,
+                    call_shards(
+                        shards,
+                        "swap_terms",
+                        m,
+                        theta0[m],
+                        Sigma0_inv_curr,
+                        Sigma0_ldet_curr,
+                    ),
                 )
-                # accept[i][:] = (np.log(uniform(size = alpha[i].shape)) < alpha[i])
-                # Where accept, make changes
-                theta0[m][accept_tot, :] = theta0_cand[accept_tot, :]
-                for i in range(setup.nexp):
-                    theta[i][m][accept_tot] = theta_cand[i][accept_tot].copy()
-                    pred_curr[i][accept_tot, :] = pred_cand[i][
-                        accept_tot, :
-                    ].copy()
-                    llik_curr[i][accept_tot] = llik_cand[i][accept_tot].copy()
-
-                count_decor2[accept_tot, k] = count_decor2[accept_tot, k] + 1
-
-        ## tempering swaps
-        if m > setup.start_temper and setup.ntemps > 1:
-            for _ in range(setup.nswap):
-                sw = np.random.choice(
-                    setup.ntemps, 2 * setup.nswap_per, replace=False
-                ).reshape(-1, 2)
-                sw_alpha[:] = 0.0  # reset swap probability
-                sw_alpha[:] = sw_alpha + (
-                    setup.itl[sw.T[1]] - setup.itl[sw.T[0]]
-                ) * (
-                    +mvnorm_logpdf(
-                        theta0[m][sw.T[0]],
-                        theta0_prior_mean,
-                        theta0_prior_prec,
-                        theta0_prior_ldet,
-                    )
-                    - mvnorm_logpdf(
-                        theta0[m][sw.T[1]],
-                        theta0_prior_mean,
-                        theta0_prior_prec,
-                        theta0_prior_ldet,
-                    )
-                    + invwishart_logpdf(
-                        Sigma0[m][sw.T[0]], Sigma0_prior_df, Sigma0_prior_scale
+                perm = np.arange(setup.ntemps)
+                if levels is not None:
+                    # log-likelihood of each state (by temperature before the swaps) at each
+                    # fidelity level, evaluated when a swap needs it; lp keeps the other terms
+                    lik = np.full((setup.ntemps, levels.max() + 1), np.nan)
+                    lik[perm, levels] = sum_exps(
+                        groups,
+                        call_shards(shards, "swap_llik", m, perm, levels),
                     )
-                    - invwishart_logpdf(
-                        Sigma0[m][sw.T[1]], Sigma0_prior_df, Sigma0_prior_scale
-                    )
-                )
-                for i in range(setup.nexp):
-                    sw_alpha[:] = sw_alpha + (
-                        setup.itl[sw.T[1]] - setup.itl[sw.T[0]]
-                    ) * (
-                        # for t_0
-                        +setup.s2_prior_kern[i](
-                            np.exp(log_s2[i][m][sw.T[0]]),
-                            setup.ig_a[i],
-                            setup.ig_b[i],
-                        ).sum(axis=1)
-                        + mvnorm_logpdf_(
-                            theta[i][m][sw.T[0]],
-                            theta0[m, sw.T[0]],
-                            Sigma0_inv_curr[sw.T[0]],
+                    lp -= lik[perm, levels]
+                for _ in range(setup.nswap):
+                    sw = np.random.choice(
+                        setup.ntemps, 2 * setup.nswap_per, replace=False
+                    ).reshape(-1, 2)
+                    sw_alpha[:] = (setup.itl[sw.T[1]] - setup.itl[sw.T[0]]) * (
+                        +mvnorm_logpdf(
+                            theta0[m][sw.T[0]],
+                            theta0_prior_mean,
+                            theta0_prior_prec,
+                            theta0_prior_ldet,
+                        )
+                        - mvnorm_logpdf(
+                            theta0[m][sw.T[1]],
+                            theta0_prior_mean,
+                            theta0_prior_prec,
+                            theta0_prior_ldet,
+                        )
+                        + invwishart_logpdf(
+                            Sigma0[m][sw.T[0]],
+                            Sigma0_prior_df,
+                            Sigma0_prior_scale,
                             Sigma0_ldet_curr[sw.T[0]],
-                        ).sum(axis=1)
-                        # - 0.5 * (setup.ny_s2[i] * np.log(s2[i][m])).sum(axis = 1)[sw.T[0]]
-                        # - 0.5 * sse_curr[i][sw.T[0]].sum(axis = 1)
-                        + llik_curr[i][sw.T[0]].sum(axis=1)
-                        # for t_1
-                        - setup.s2_prior_kern[i](
-                            np.exp(log_s2[i][m][sw.T[1]]),
-                            setup.ig_a[i],
-                            setup.ig_b[i],
-                        ).sum(axis=1)
-                        - mvnorm_logpdf_(
-                            theta[i][m][sw.T[1]],
-                            theta0[m, sw.T[1]],
-                            Sigma0_inv_curr[sw.T[1]],
+                            Sigma0_inv_curr[sw.T[0]],
+                        )
+                        - invwishart_logpdf(
+                            Sigma0[m][sw.T[1]],
+                            Sigma0_prior_df,
+                            Sigma0_prior_scale,
                             Sigma0_ldet_curr[sw.T[1]],
-                        ).sum(axis=1)
-                        # + 0.5 * (setup.ny_s2[i] * np.log(s2[i][m])).sum(axis = 1)[sw.T[1]]
-                        # + 0.5 * sse_curr[i][sw.T[1]].sum(axis = 1)
-                        - llik_curr[i][sw.T[1]].sum(axis=1)
-                    )
-                for tt in sw[
-                    np.where(np.log(uniform(size=setup.nswap_per)) < sw_alpha)
-                ]:
-                    count_temper[tt[0], tt[1]] = count_temper[tt[0], tt[1]] + 1
-                    for i in range(setup.nexp):
-                        theta[i][m, tt[0]], theta[i][m, tt[1]] = (
-                            theta[i][m, tt[1]].copy(),
-                            theta[i][m, tt[0]].copy(),
+                            Sigma0_inv_curr[sw.T[1]],
                         )
-                        log_s2[i][m][tt[0]], log_s2[i][m][tt[1]] = (
-                            log_s2[i][m][tt[1]].copy(),
-                            log_s2[i][m][tt[0]].copy(),
+                        + lp[sw.T[0]]
+                        - lp[sw.T[1]]
+                    )
+                    if levels is not None:
+                        # each state at the other temperature's fidelity
+                        a, b = sw.T
+                        states = np.r_[perm[a], perm[b]]
+                        lev = np.r_[levels[b], levels[a]]
+                        new = np.isnan(lik[states, lev])
+                        if np.any(new):
+                            lik[states[new], lev[new]] = sum_exps(
+                                groups,
+                                call_shards(
+                                    shards,
+                                    "swap_llik",
+                                    m,
+                                    states[new],
+                                    lev[new],
+                                ),
+                            )
+                        sw_alpha += setup.itl[a] * (
+                            lik[perm[b], levels[a]] - lik[perm[a], levels[a]]
+                        ) + setup.itl[b] * (
+                            lik[perm[a], levels[b]] - lik[perm[b], levels[b]]
                         )
-                        pred_curr[i][tt[0]], pred_curr[i][tt[1]] = (
-                            pred_curr[i][tt[1]].copy(),
-                            pred_curr[i][tt[0]].copy(),
+                    for tt in sw[
+                        np.where(
+                            np.log(uniform(size=setup.nswap_per)) < sw_alpha
                         )
-                        llik_curr[i][tt[0]], llik_curr[i][tt[1]] = (
-                            llik_curr[i][tt[1]].copy(),
-                            llik_curr[i][tt[0]].copy(),
+                    ]:
+                        count_temper[tt[0], tt[1]] = (
+                            count_temper[tt[0], tt[1]] + 1
                         )
-                    theta0[m, tt[0]], theta0[m, tt[1]] = (
-                        theta0[m, tt[1]].copy(),
-                        theta0[m, tt[0]].copy(),
-                    )
-                    Sigma0[m, tt[0]], Sigma0[m, tt[1]] = (
-                        Sigma0[m, tt[1]].copy(),
-                        Sigma0[m, tt[0]].copy(),
-                    )
-                    Sigma0_inv_curr[tt[0]], Sigma0_inv_curr[tt[1]] = (
-                        Sigma0_inv_curr[tt[1]].copy(),
-                        Sigma0_inv_curr[tt[0]].copy(),
-                    )
-                    Sigma0_ldet_curr[tt[0]], Sigma0_ldet_curr[tt[1]] = (
-                        Sigma0_ldet_curr[tt[1]].copy(),
-                        Sigma0_ldet_curr[tt[0]].copy(),
-                    )
-                # if np.exp(log_s2[i][m,0,0])>1:
-                #    print('a')
-        # print('\rCalibration MCMC {:.01%} Complete'.format(m / setup.nmcmc), end='')
+                        perm[tt] = perm[tt[::-1]]
+                        lp[tt] = lp[tt[::-1]]
+                        theta0[m, tt] = theta0[m, tt[::-1]]
+                        Sigma0[m, tt] = Sigma0[m, tt[::-1]]
+                        Sigma0_inv_curr[tt] = Sigma0_inv_curr[tt[::-1]]
+                        Sigma0_ldet_curr[tt] = Sigma0_ldet_curr[tt[::-1]]
+                if np.any(perm != np.arange(setup.ntemps)):
+                    call_shards(shards, "swap_apply", m, perm)
+
+        results = call_shards(shards, "result")
+    finally:
+        for shard in shards:
+            if isinstance(shard, ShardWorker):
+                shard.close()
 
     t1 = time.time()
     print(f"\rCalibration MCMC Complete. Time: {t1 - t0:f} seconds.")
 
-    # theta_parent_01 = chol_sample_1per_constraints(
-    #    theta0[:,0], Sigma0[:,0], setup.checkConstraints,
-    #    setup.bounds_mat, setup.bounds.keys(), setup.bounds, setup.constants
-    #    )
-
-    # theta_native = [tran_unif(theta[i][:,0], setup.bounds_mat, setup.bounds.keys()) for i in range(setup.nexp)]
-    # theta0_native = tran_unif(theta0[:,0], setup.bounds_mat, setup.bounds.keys())
-    # theta_parent_native = tran_unif(theta_parent_01, setup.bounds_mat, setup.bounds.keys())
-    # pred = [setup.models[i].eval(theta_parent_native, pool=True) for i in range(setup.nexp)]
-    # llik = sum([((pred[i]-setup.ys[i])**2).mean(axis=1) for i in range(setup.nexp)])
-
-    s2 = log_s2.copy()
-    for i in range(setup.nexp):
-        s2[i] = np.exp(log_s2[i])
+    # gather experiment-level output, in experiment order
+    theta = [None] * setup.nexp
+    s2 = [None] * setup.nexp
+    count = [None] * setup.nexp
+    pred_curr = [None] * setup.nexp
+    cov_ls2_cand = [None] * setup.nexp
+    count_s2 = np.zeros([setup.nexp, setup.ntemps], dtype=int)
+    cov_theta_cand = theta_proposal(setup, setup.ntheta)
+    for res in results:
+        for e, i in enumerate(res["exps"]):
+            theta[i] = res["theta"][e]
+            s2[i] = res["s2"][e]
+            count[i] = res["count"][e]
+            pred_curr[i] = res["pred_curr"][e]
+            cov_ls2_cand[i] = res["cov_ls2_cand"][e]
+            count_s2[i] = res["count_s2"][e]
+            for attr, val in vars(res["cov_theta_cand"]).items():
+                if isinstance(val, list):  # per-experiment state
+                    getattr(cov_theta_cand, attr)[i] = val[e]
 
     count_temper = (
         count_temper + count_temper.T - np.diag(np.diag(count_temper))
     )
-    # theta_reshape = [np.swapaxes(t,1,2) for t in theta]
     out = OutCalibHier(
         theta,
         s2,
@@ -1573,7 +2790,7 @@ def calibHier(setup):
         pred_curr,
         theta0,
         Sigma0,
-    )  # , llik, theta_native, theta0_native, theta_parent_native)
+    )
     return out
 
 
@@ -1582,34 +2799,143 @@ def calibHier(setup):
 
 
 # @profile
+def fidelity_swap_llik(setup, engine, theta, levels, log_s2, discrep, covs):
+    """
+    Predictions, sums of squares and log-likelihoods (nexp x n) of pooled states (theta, log_s2,
+    discrepancy and likelihood covariances of each row) evaluated at fidelity levels
+    """
+    pred, sse = [None] * setup.nexp, [None] * setup.nexp
+    llik = np.empty((setup.nexp, theta.shape[0]))
+    for i in range(setup.nexp):
+        pred[i] = eval_pool(setup, i, theta, levels)
+        if engine[i] is not None:
+            sse[i] = engine[i].sse(pred[i] + discrep[i], levels)
+            llik[i] = engine[i].llik(sse[i], log_s2[i], levels)[:, 0]
+            continue
+        for j in range(theta.shape[0]):
+            llik[i, j] = setup.models[i].llik(
+                setup.ys[i] - discrep[i][j], pred[i][j], covs[i][j]
+            )
+    return pred, sse, llik
+
+
+def da_screen(
+    setup,
+    surrogate,
+    engine,
+    theta_cand,
+    theta_curr,
+    good,
+    lcorr,
+    log_s2,
+    discrep,
+    covs,
+):
+    """
+    First stage of delayed acceptance (see CalibSetup.setDelayedAcceptance): the candidates
+    good that the surrogate likelihood rejects are dropped.  Returns them with the log
+    proposal correction of the second stage, which divides the surrogate ratio back out.
+    """
+    llik_diff = (
+        surrogate.llik(setup, engine, theta_cand, log_s2, discrep, covs)
+        - surrogate.llik(setup, engine, theta_curr, log_s2, discrep, covs)
+    ).sum(axis=0)
+    alpha = setup.itl * llik_diff + lcorr
+    surrogate.count_screen += good
+    good = good & (np.log(uniform(size=setup.ntemps)) < alpha)
+    surrogate.count_pass += good
+    return good, -setup.itl * llik_diff
+
+
+def eval_cand_pool(
+    setup,
+    engine,
+    theta_cand,
+    good,
+    levels,
+    pred_curr,
+    sse_curr,
+    llik_curr,
+    log_s2,
+    discrep,
+    covs,
+    early=None,
+    lcorr=None,
+):
+    """
+    Predictions, sums of squares and log-likelihoods (nexp x ntemps) of the pooled candidates
+    good; the other temperatures keep their current predictions and log-likelihoods.  With
+    early rejection (see CalibSetup.setEarlyRejection), experiments are evaluated one at a
+    time and candidates are dropped from good once they cannot be accepted.  Returns
+    pred_cand, sse_cand, llik_cand, good and the log acceptance thresholds drawn for early
+    rejection (None without it).
+    """
+    pred_cand = [_.copy() for _ in pred_curr]
+    sse_cand = [None] * setup.nexp
+    llik_cand = llik_curr.copy()
+    runif = None
+    if not np.any(good):
+        return pred_cand, sse_cand, llik_cand, good, runif
+    llik_cand[:, good] = 0.0
+    order = range(setup.nexp)
+    if early is not None:
+        # experiments not yet evaluated count at their upper bounds
+        runif = np.log(uniform(size=setup.ntemps))
+        llik_ub = llik_bounds(setup, engine, sse_curr, log_s2, covs)
+        llik_cand[:, good] = llik_ub[:, good]
+        early.count_cand += good.sum()
+        order = early.order()
+    for i in order:
+        if not np.any(good):
+            break
+        t0_eval = time.perf_counter()
+        pred_cand[i][good] = eval_pool(
+            setup,
+            i,
+            theta_cand[good],
+            None if levels is None else levels[good],
+        )
+        t1_eval = time.perf_counter()
+        if engine[i] is not None:
+            sse_cand[i] = engine[i].sse(pred_cand[i] + discrep[i])
+            llik_cand[i] = engine[i].llik(sse_cand[i], log_s2[i])[:, 0]
+        else:
+            for t in np.where(good)[0]:
+                llik_cand[i, t] = setup.models[i].llik(
+                    setup.ys[i] - discrep[i][t], pred_cand[i][t], covs[i][t]
+                )
+        if early is not None:
+            early.record(
+                i, (llik_ub[i] - llik_cand[i])[good], t1_eval - t0_eval
+            )
+            good = good & (
+                runif
+                < setup.itl * (llik_cand.sum(axis=0) - llik_curr.sum(axis=0))
+                + lcorr
+            )
+    return pred_cand, sse_cand, llik_cand, good, runif
+
+
 def calibPool(setup):
     """Perform pooled calibration"""
     t0 = time.time()
     theta = np.empty([setup.nmcmc, setup.ntemps, setup.p])
-    np.sum(setup.ns2)
     log_s2 = [
         np.ones([setup.nmcmc, setup.ntemps, setup.ns2[i]])
         for i in range(setup.nexp)
     ]
+    for i in range(setup.nexp):
+        if setup.models[i].s2 == "fix":  # held at sd_est from the start
+            log_s2[i][0] = np.log(setup.sd_est[i] ** 2)
     # s2_vec_curr = [s2[i][0,:,setup.s2_ind[i]] for i in range(setup.nexp)]
-    s2_ind_mat = [
-        (setup.s2_ind[i][:, None] == range(setup.ns2[i]))
-        for i in range(setup.nexp)
-    ]
     theta_start = initfunc_unif(size=[setup.ntemps, setup.p])
-    good = setup.checkConstraints(
-        tran_unif(theta_start, setup.bounds_mat, setup.bounds.keys())
-    )
+    good = setup.checkConstraintsUnit(theta_start)
     while np.any(np.logical_not(good)):
         theta_start[np.where(np.logical_not(good))] = initfunc_unif(
             size=[(np.logical_not(good)).sum(), setup.p]
         )
-        good[np.where(np.logical_not(good))] = setup.checkConstraints(
-            tran_unif(
-                theta_start[np.where(np.logical_not(good))],
-                setup.bounds_mat,
-                setup.bounds.keys(),
-            )
+        good[np.where(np.logical_not(good))] = setup.checkConstraintsUnit(
+            theta_start[np.where(np.logical_not(good))]
         )
     theta[0] = theta_start
 
@@ -1619,26 +2945,39 @@ def calibPool(setup):
     ]
 
     pred_curr = [None] * setup.nexp
-    # sse_curr = np.empty([setup.ntemps, setup.nexp])
+    # sufficient statistics (residual sums of squares per s2 group) for diagonal likelihoods
+    engine = fidelity_engines(setup, lik_engines(setup, pooled=True))
+    levels = (
+        setup.fidelity_levels
+    )  # None, or the fidelity level of each temperature
+    ny_s2 = [
+        engine[i].ny_s2
+        if isinstance(engine[i], FidelityEngine)
+        else setup.ny_s2[i]
+        for i in range(setup.nexp)
+    ]
+    sse_curr = [None] * setup.nexp  # [i], ntemps x ncell
     llik_curr = np.empty([setup.nexp, setup.ntemps])
-    # dev_sq = [np.empty((setup.ntemps, setup.ns2[i])) for i in range(setup.nexp)]
+    # covariances are only needed for non-diagonal likelihoods and discrepancy draws
+    need_cov = [
+        engine[i] is None or setup.models[i].nd > 0 for i in range(setup.nexp)
+    ]
     marg_lik_cov_curr = [None] * setup.nexp
-    for i in range(setup.nexp):
+    for i in np.where(need_cov)[0]:
         marg_lik_cov_curr[i] = [None] * setup.ntemps
         for t in range(setup.ntemps):
             marg_lik_cov_curr[i][t] = setup.models[i].lik_cov_inv(
-                np.exp(log_s2[i][0, t, setup.s2_ind[i]])[setup.s2_ind[i]]
+                np.exp(log_s2[i][0, t])[setup.s2_ind[i]]
             )
             # ask around: is list of lists lookup slow?? ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     llik_curr[:] = 0.0
     for i in range(setup.nexp):
-        pred_curr[i] = setup.models[i].eval(
-            tran_unif(theta[0], setup.bounds_mat, setup.bounds.keys()),
-            pool=True,
-        )
-        # sse_curr[:, i] = np.sum((pred_curr[i] - setup.ys[i]) ** 2 / s2_vec_curr[i].T, 1)
-        # ((pred_curr[i] - setup.ys[i])**2 @ s2_ind_mat[i] / s2[i][0]).sum(axis = 1)
+        pred_curr[i] = eval_pool(setup, i, theta[0], levels)
+        if engine[i] is not None:
+            sse_curr[i] = engine[i].sse(pred_curr[i])
+            llik_curr[i] = engine[i].llik(sse_curr[i], log_s2[i][0])[:, 0]
+            continue
         for t in range(setup.ntemps):
             llik_curr[i, t] = setup.models[i].llik(
                 setup.ys[i], pred_curr[i][t], marg_lik_cov_curr[i][t]
@@ -1652,13 +2991,27 @@ def calibPool(setup):
     # cov  = np.empty([setup.ntemps, setup.p, setup.p])
     # mu   = np.empty([setup.ntemps, setup.p])
 
-    cov_theta_cand = AMcov_pool(
-        ntemps=setup.ntemps,
-        p=setup.p,
-        start_var=setup.start_var_theta,
-        tau_start=setup.start_tau_theta,
-        start_adapt_iter=setup.start_adapt_iter,
-    )
+    cov_theta_cand = theta_proposal(setup)
+    surrogate = SurrogateDA(setup) if setup.da_start is not None else None
+    early = EarlyReject(setup) if setup.early_reject_order is not None else None
+    subsample = None
+    if setup.subsample_start is not None:
+        if any(not model.diag_lik or model.nd > 0 for model in setup.models):
+            raise ValueError(
+                "subsampling needs diagonal likelihoods without discrepancy"
+            )
+        if early is not None or levels is not None:
+            raise ValueError(
+                "subsampling cannot be combined with early rejection or a fidelity ladder"
+            )
+        if setup.coreset_full is not None:
+            raise ValueError("subsampling cannot be combined with a coreset")
+        if not all(model.subset_eval for model in setup.models):
+            # each batch would otherwise cost a full evaluation
+            raise ValueError(
+                "subsampling needs models that evaluate subsets of observations (eval_obs), e.g. ModelF_bigdata with f_obs"
+            )
+        subsample = SubsampledLik(setup)
     cov_ls2_cand = [
         AMcov_pool(
             ntemps=setup.ntemps,
@@ -1682,8 +3035,6 @@ def calibPool(setup):
         for i in range(setup.nexp)
     ]
 
-    llik_cand = llik_curr.copy()
-
     alpha = np.ones(setup.ntemps) * (-np.inf)
     alpha_s2 = np.ones([setup.nexp, setup.ntemps]) * (-np.inf)
     sw_alpha = np.zeros(setup.nswap_per)
@@ -1695,27 +3046,29 @@ def calibPool(setup):
         theta[m] = theta[
             m - 1
         ].copy()  # current set to previous, will change if accepted
+        refresh = setup.emulatorRefresh(m)
         for i in range(setup.nexp):
             log_s2[i][m] = log_s2[i][m - 1].copy()
+            emu_step = setup.models[i].stochastic and refresh
             if setup.models[i].nd > 0:  # update discrepancy
-                for t in range(setup.ntemps):
-                    discrep_vars[i][m][t] = setup.models[i].discrep_sample(
-                        setup.ys[i],
-                        pred_curr[i][t],
-                        marg_lik_cov_curr[i][t],
-                        setup.itl[t],
-                    )
-                    discrep_curr[i][t] = (
-                        setup.models[i].D @ discrep_vars[i][m][t]
-                    )
-
-            setup.models[i].step()
-            if setup.models[i].stochastic:  # update emulator
-                pred_curr[i] = setup.models[i].eval(
-                    tran_unif(theta[m], setup.bounds_mat, setup.bounds.keys()),
-                    pool=True,
+                discrep_vars[i][m] = setup.models[i].discrep_sample_batch(
+                    setup.ys[i],
+                    pred_curr[i],
+                    marg_lik_cov_curr[i],
+                    setup.itl,
                 )
-            if setup.models[i].nd > 0 or setup.models[i].stochastic:
+                discrep_curr[i] = (setup.models[i].D @ discrep_vars[i][m].T).T
+
+            if emu_step:  # update emulator
+                setup.models[i].step()
+                pred_curr[i] = eval_pool(setup, i, theta[m], levels)
+            if setup.models[i].nd > 0 or emu_step:
+                if engine[i] is not None:
+                    sse_curr[i] = engine[i].sse(pred_curr[i] + discrep_curr[i])
+                    llik_curr[i] = engine[i].llik(sse_curr[i], log_s2[i][m])[
+                        :, 0
+                    ]
+                    continue
                 for t in range(setup.ntemps):
                     llik_curr[i, t] = setup.models[i].llik(
                         setup.ys[i] - discrep_curr[i][t],
@@ -1754,32 +3107,65 @@ def calibPool(setup):
         #     + theta[m-1]
         #     + np.einsum('ijk,ik->ij', cholesky(cov_theta_cand.S), normal(size = (setup.ntemps, setup.p)))
         #     )
-        good_values = setup.checkConstraints(
-            tran_unif(theta_cand, setup.bounds_mat, setup.bounds.keys())
-        )
+        good_values = setup.checkConstraintsUnit(theta_cand)
+        lcorr = cov_theta_cand.lcorr
+        if (
+            surrogate is not None
+            and surrogate.interp is None
+            and m >= surrogate.start
+        ):
+            surrogate.fit()
+        if surrogate is not None and surrogate.interp is not None:
+            good_values, lcorr = da_screen(
+                setup,
+                surrogate,
+                engine,
+                theta_cand,
+                theta[m],
+                good_values,
+                lcorr,
+                [_[m] for _ in log_s2],
+                discrep_curr,
+                marg_lik_cov_curr,
+            )
+        runif = None
+        if subsample is not None:
+            # accepted proposals, and undecided ones, are evaluated in full below
+            good_values, runif = subsample.screen(
+                setup,
+                m,
+                theta_cand,
+                theta[m],
+                good_values,
+                pred_curr,
+                [_[m] for _ in log_s2],
+                lcorr,
+            )
         # ------------------------------------------------------------------------------------------
         # get predictions and SSE
-        pred_cand = [_.copy() for _ in pred_curr]
-        llik_cand[:] = llik_curr.copy()
-        if np.any(good_values):
-            llik_cand[:, good_values] = 0.0
-            for i in range(setup.nexp):
-                pred_cand[i][good_values] = setup.models[i].eval(
-                    tran_unif(
-                        theta_cand[
-                            good_values
-                        ],  # .repeat(setup.ns2[i], axis = 0),
-                        setup.bounds_mat,
-                        setup.bounds.keys(),
-                    ),
-                    pool=True,
-                )
-                for t in range(setup.ntemps):
-                    llik_cand[i, t] = setup.models[i].llik(
-                        setup.ys[i] - discrep_curr[i][t],
-                        pred_cand[i][t],
-                        marg_lik_cov_curr[i][t],
-                    )  # (((pred_cand[i] - setup.ys[i])**2 @ s2_ind_mat[i]) / s2[i][m-1]).sum(axis = 1)
+        pred_cand, sse_cand, llik_cand, good_values, runif_early = (
+            eval_cand_pool(
+                setup,
+                engine,
+                theta_cand,
+                good_values,
+                levels,
+                pred_curr,
+                sse_curr,
+                llik_curr,
+                [_[m] for _ in log_s2],
+                discrep_curr,
+                marg_lik_cov_curr,
+                early,
+                lcorr,
+            )
+        )
+        if runif_early is not None:
+            runif = runif_early
+        if surrogate is not None and surrogate.interp is None:
+            surrogate.add(
+                theta_cand[good_values], [_[good_values] for _ in pred_cand]
+            )
 
         # tsq_diff = 0.#((theta_cand * theta_cand).sum(axis = 1) - (theta[m-1] * theta[m-1]).sum(axis = 1))[good_values]
         llik_diff = (llik_cand.sum(axis=0) - llik_curr.sum(axis=0))[
@@ -1788,13 +3174,19 @@ def calibPool(setup):
         # ------------------------------------------------------------------------------------------
         # for each temperature, accept or reject
         alpha[:] = -np.inf
-        alpha[good_values] = setup.itl[good_values] * (llik_diff)
-        for t in np.where(np.log(uniform(size=setup.ntemps)) < alpha)[0]:
+        alpha[good_values] = (
+            setup.itl[good_values] * (llik_diff) + lcorr[good_values]
+        )
+        if runif is None:
+            runif = np.log(uniform(size=setup.ntemps))
+        for t in np.where(runif < alpha)[0]:
             theta[m, t] = theta_cand[t].copy()
             count[t, t] += 1
             for i in range(setup.nexp):
                 llik_curr[i, t] = llik_cand[i, t].copy()
                 pred_curr[i][t] = pred_cand[i][t].copy()
+                if engine[i] is not None:
+                    sse_curr[i][t] = sse_cand[i][t]
             cov_theta_cand.count_100[t] += 1
         # ------------------------------------------------------------------------------------------
         # diminishing adaptation based on acceptance rate for each temperature
@@ -1816,31 +3208,20 @@ def calibPool(setup):
                 theta_cand[:, k] = initfunc_unif(
                     size=setup.ntemps
                 )  # independence proposal, will vectorize of columns
-                good_values = setup.checkConstraints(
-                    tran_unif(theta_cand, setup.bounds_mat, setup.bounds.keys())
-                )
-                pred_cand = [_.copy() for _ in pred_curr]
-                llik_cand[:] = llik_curr.copy()
-
-                if np.any(good_values):
-                    llik_cand[:, good_values] = 0.0
-                    for i in range(setup.nexp):
-                        pred_cand[i][good_values] = setup.models[i].eval(
-                            tran_unif(
-                                theta_cand[
-                                    good_values
-                                ],  # .repeat(setup.ns2[i], axis = 0),
-                                setup.bounds_mat,
-                                setup.bounds.keys(),
-                            ),
-                            pool=True,
-                        )
-                        for t in range(setup.ntemps):
-                            llik_cand[i, t] = setup.models[i].llik(
-                                setup.ys[i] - discrep_curr[i][t],
-                                pred_cand[i][t],
-                                marg_lik_cov_curr[i][t],
-                            )  # (((pred_cand[i] - setup.ys[i])**2 @ s2_ind_mat[i]) / s2[i][m-1]).sum(axis = 1)
+                good_values = setup.checkConstraintsUnit(theta_cand)
+                pred_cand, sse_cand, llik_cand, good_values = eval_cand_pool(
+                    setup,
+                    engine,
+                    theta_cand,
+                    good_values,
+                    levels,
+                    pred_curr,
+                    sse_curr,
+                    llik_curr,
+                    [_[m] for _ in log_s2],
+                    discrep_curr,
+                    marg_lik_cov_curr,
+                )[:4]
 
                 alpha[:] = -np.inf
                 # tsq_diff = 0.#((theta_cand * theta_cand).sum(axis = 1) - (theta[m] * theta[m]).sum(axis = 1))[good_values]
@@ -1858,28 +3239,41 @@ def calibPool(setup):
                     for i in range(setup.nexp):
                         pred_curr[i][t] = pred_cand[i][t].copy()
                         llik_curr[i, t] = llik_cand[i, t].copy()
+                        if engine[i] is not None:
+                            sse_curr[i][t] = sse_cand[i][t]
 
         # ------------------------------------------------------------------------------------------
         ## update s2
         for i in range(setup.nexp):
             if setup.models[i].s2 == "gibbs":
                 ## gibbs update s2
-
-                dev_sq = (pred_curr[i] - setup.ys[i]) ** 2 @ s2_ind_mat[
-                    i
-                ]  # squared deviations
+                if engine[i] is not None:  # from cached sums of squares, O(ns2)
+                    dev_sq = engine[i].dev_sq(sse_curr[i])
+                else:
+                    dev_sq = setup.models[i].dev_sq(
+                        setup.ys[i],
+                        pred_curr[i] + discrep_curr[i],
+                        setup.s2_ind[i],
+                        setup.ns2[i],
+                    )  # squared deviations
                 log_s2[i][m] = np.log(
                     1
                     / np.random.gamma(
-                        itl_mat[i] * (setup.ny_s2[i] / 2 + setup.ig_a[i] + 1)
-                        - 1,
+                        itl_mat[i] * (ny_s2[i] / 2 + setup.ig_a[i] + 1) - 1,
                         1 / (itl_mat[i] * (setup.ig_b[i] + dev_sq / 2)),
                     )
                 )
+                if need_cov[i]:
+                    for t in range(setup.ntemps):
+                        marg_lik_cov_curr[i][t] = setup.models[i].lik_cov_inv(
+                            np.exp(log_s2[i][m][t])[setup.s2_ind[i]]
+                        )
+                if engine[i] is not None:
+                    llik_curr[i] = engine[i].llik(sse_curr[i], log_s2[i][m])[
+                        :, 0
+                    ]
+                    continue
                 for t in range(setup.ntemps):
-                    marg_lik_cov_curr[i][t] = setup.models[i].lik_cov_inv(
-                        np.exp(log_s2[i][m][t])[setup.s2_ind[i]]
-                    )
                     llik_curr[i, t] = setup.models[i].llik(
                         setup.ys[i] - discrep_curr[i][t],
                         pred_curr[i][t],
@@ -1901,15 +3295,19 @@ def calibPool(setup):
 
                 llik_candi = np.zeros(setup.ntemps)
                 marg_lik_cov_candi = [None] * setup.ntemps
-                for t in range(setup.ntemps):
+                for t in range(setup.ntemps if need_cov[i] else 0):
                     marg_lik_cov_candi[t] = setup.models[i].lik_cov_inv(
                         np.exp(ls2_candi[t])[setup.s2_ind[i]]
                     )  # s2[i][0, t, setup.s2_ind[i]])
-                    llik_candi[t] = setup.models[i].llik(
-                        setup.ys[i] - discrep_curr[i][t],
-                        pred_curr[i][t],
-                        marg_lik_cov_candi[t],
-                    )
+                if engine[i] is not None:  # from cached sums of squares, O(ns2)
+                    llik_candi[:] = engine[i].llik(sse_curr[i], ls2_candi)[:, 0]
+                else:
+                    for t in range(setup.ntemps):
+                        llik_candi[t] = setup.models[i].llik(
+                            setup.ys[i] - discrep_curr[i][t],
+                            pred_curr[i][t],
+                            marg_lik_cov_candi[t],
+                        )
 
                 llik_diffi = llik_candi - llik_curr[i]
                 alpha_s2 = setup.itl * (llik_diffi)
@@ -1933,7 +3331,8 @@ def calibPool(setup):
                     count_s2[i, t] += 1
                     llik_curr[i, t] = llik_candi[t].copy()
                     log_s2[i][m][t] = ls2_candi[t].copy()
-                    marg_lik_cov_curr[i][t] = marg_lik_cov_candi[t].copy()
+                    if need_cov[i]:
+                        marg_lik_cov_curr[i][t] = marg_lik_cov_candi[t].copy()
                     cov_ls2_cand[i].count_100[t] += 1
 
                 cov_ls2_cand[i].update_tau(m)
@@ -1973,23 +3372,56 @@ def calibPool(setup):
                             * (discrep_vars[i][m][sw.T[1]] ** 2).sum(axis=1)
                             / setup.models[i].discrep_tau
                         )
-                for tt in sw[
-                    np.where(np.log(uniform(size=setup.nswap_per)) < sw_alpha)[
-                        0
-                    ]
-                ]:
+                # pairs at different fidelities: likelihood of each state at the other's level
+                cross = (
+                    np.zeros(setup.nswap_per, dtype=bool)
+                    if levels is None
+                    else levels[sw.T[0]] != levels[sw.T[1]]
+                )
+                if np.any(cross):
+                    src, dst = sw[cross].ravel(), sw[cross][:, ::-1].ravel()
+                    pred_sw, sse_sw, llik_sw = fidelity_swap_llik(
+                        setup,
+                        engine,
+                        theta[m][src],
+                        levels[dst],
+                        [_[m][src] for _ in log_s2],
+                        [_[src] for _ in discrep_curr],
+                        [
+                            None if _ is None else [_[t] for t in src]
+                            for _ in marg_lik_cov_curr
+                        ],
+                    )
+                    sw_alpha[cross] += (
+                        (
+                            setup.itl[dst]
+                            * (llik_sw - llik_curr[:, src]).sum(axis=0)
+                        )
+                        .reshape(-1, 2)
+                        .sum(axis=1)
+                    )
+                    cross_pos = (
+                        np.cumsum(cross) - 1
+                    )  # pair -> row pair of src, dst
+                for j in np.where(
+                    np.log(uniform(size=setup.nswap_per)) < sw_alpha
+                )[0]:
+                    tt = sw[j]
                     for i in range(setup.nexp):
                         log_s2[i][m][tt[0]], log_s2[i][m][tt[1]] = (
                             log_s2[i][m][tt[1]].copy(),
                             log_s2[i][m][tt[0]].copy(),
                         )
-                        (
-                            marg_lik_cov_curr[i][tt[0]],
-                            marg_lik_cov_curr[i][tt[1]],
-                        ) = (
-                            marg_lik_cov_curr[i][tt[1]].copy(),
-                            marg_lik_cov_curr[i][tt[0]].copy(),
-                        )
+                        if need_cov[i]:
+                            (
+                                marg_lik_cov_curr[i][tt[0]],
+                                marg_lik_cov_curr[i][tt[1]],
+                            ) = (
+                                marg_lik_cov_curr[i][tt[1]].copy(),
+                                marg_lik_cov_curr[i][tt[0]].copy(),
+                            )
+                        if engine[i] is not None:
+                            sse_curr[i][tt] = sse_curr[i][tt[::-1]]
                         pred_curr[i][tt[0]], pred_curr[i][tt[1]] = (
                             pred_curr[i][tt[1]].copy(),
                             pred_curr[i][tt[0]].copy(),
@@ -2008,6 +3440,13 @@ def calibPool(setup):
                         )
                         # if np.any(np.exp(log_s2[i][m][0]) > 10*np.exp(log_s2[i][m-1][0])):
                         #    print('bummer2')
+                    if cross[j]:  # the states now run at the other fidelity
+                        rows = 2 * cross_pos[j] + np.arange(2)
+                        for i in range(setup.nexp):
+                            pred_curr[i][dst[rows]] = pred_sw[i][rows]
+                            if engine[i] is not None:
+                                sse_curr[i][dst[rows]] = sse_sw[i][rows]
+                            llik_curr[i, dst[rows]] = llik_sw[i, rows]
                     count[tt[0], tt[1]] += 1
                     theta[m][tt[0]], theta[m][tt[1]] = (
                         theta[m][tt[1]].copy(),
@@ -2038,6 +3477,9 @@ def calibPool(setup):
         discrep_vars,
         llik,
         theta_native,
+        surrogate,
+        early,
+        subsample,
     )
     return out
 
@@ -2063,6 +3505,42 @@ class PoolCalib:
         return self.singleCal(i)
 
 
+def coresetReweight(setup, out, mcmc_use=None):
+    """
+    Importance weights that take draws of calibPool run on a coreset (CalibSetup.setCoreset)
+    to the posterior under the full data, from the full-data log-likelihoods of the cold
+    chain's draws (one batched evaluation of all observations per experiment).
+
+    :param setup : CalibSetup object with a coreset
+    :param out : output of calibPool
+    :param mcmc_use : (optional) MCMC iterations to reweight, default = all
+    :return : normalized weights of the draws out.theta[mcmc_use, 0]
+    """
+    if setup.coreset_full is None:
+        raise ValueError("setup has no coreset")
+    if mcmc_use is None:
+        mcmc_use = np.arange(setup.nmcmc)
+    parmat = tran_unif(
+        out.theta[mcmc_use, 0], setup.bounds_mat, setup.bounds.keys()
+    )
+    lw = -out.llik[mcmc_use]
+    for i in range(setup.nexp):
+        keep, yobs, s2_ind, _ = setup.coreset_full[i]
+        model = setup.models[i]
+        model.setObservations(None)
+        try:
+            pred = model.eval(parmat, pool=True)
+        finally:
+            model.setObservations(keep)
+        engine = GaussLikSegments(
+            yobs, np.zeros_like(s2_ind), 1, s2_ind, setup.ns2[i]
+        )
+        log_s2 = np.log(out.s2[i][mcmc_use, 0])
+        lw += engine.llik(engine.sse(pred), log_s2)[:, 0]
+    lw[np.isnan(lw)] = -np.inf
+    return np.exp(lw - logsumexp(lw))
+
+
 def calibPoolParallel(setup_list, ncores):
     temp = PoolCalib(setup_list)
     out = temp.fit(ncores, len(setup_list))
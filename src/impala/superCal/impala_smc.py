@@ -0,0 +1,246 @@
+import time
+from collections import namedtuple
+from math import log, pi
+from multiprocessing import Pool
+
+import numpy as np
+from numpy.random import normal, uniform
+from scipy.special import gammaln, logsumexp
+
+from .impala_noprobit_emu import initfunc_unif, lik_engines, tran_unif
+
+OutCalibSMC = namedtuple(
+    "OutCalibSMC", "theta llik log_evidence phi ess accept count_eval"
+)
+
+
+def smc_check(setup):
+    """
+    Raise ValueError if calibSMC cannot compute normalized likelihoods for this setup: s2 is
+    either fixed at sd_est (s2 = "fix") or integrated out under its inverse-gamma prior, which
+    needs s2_df > 0 and a diagonal likelihood.
+    """
+    for i in range(setup.nexp):
+        model = setup.models[i]
+        if model.nd > 0:
+            raise ValueError("calibSMC does not support discrepancy (D) models")
+        if model.s2 == "fix":
+            continue
+        if not model.diag_lik:
+            raise ValueError(
+                "calibSMC needs s2='fix' for models without a diagonal likelihood"
+            )
+        if np.any(setup.s2_df[i] <= 0):
+            raise ValueError(
+                "calibSMC integrates s2 out under its inverse-gamma prior, use s2_df > 0 or s2='fix'"
+            )
+
+
+def smc_llik(setup, theta, engine=None):
+    """
+    Log-likelihood (normalized, summed over experiments) of each row of theta (N x p, unit
+    scale), from one batched eval per experiment.  s2 is fixed at sd_est (s2 = "fix") or
+    integrated out under its IG(s2_df / 2, s2_df / 2 * sd_est^2) prior.
+    """
+    if engine is None:
+        engine = lik_engines(setup, pooled=True)
+    parmat = tran_unif(theta, setup.bounds_mat, setup.bounds.keys())
+    out = np.zeros(theta.shape[0])
+    for i in range(setup.nexp):
+        model = setup.models[i]
+        pred = model.cached_eval(parmat)
+        ny = setup.ny_s2[i]
+        if engine[i] is not None:
+            dev_sq = engine[i].dev_sq(engine[i].sse(pred))  # N x ns2
+            if model.s2 == "fix":
+                s2 = setup.sd_est[i] ** 2
+                out -= 0.5 * (ny * np.log(2 * pi * s2) + dev_sq / s2).sum(
+                    axis=1
+                )
+            else:
+                a, b = setup.ig_a[i], setup.ig_b[i]
+                out += (
+                    a * np.log(b)
+                    - gammaln(a)
+                    + gammaln(a + ny / 2)
+                    - (a + ny / 2) * np.log(b + dev_sq / 2)
+                    - ny / 2 * log(2 * pi)
+                ).sum(axis=1)
+            continue
+        cov = model.lik_cov_inv(setup.sd_est[i][setup.s2_ind[i]] ** 2)
+        for k in range(theta.shape[0]):
+            out[k] += model.llik(setup.ys[i], pred[k], cov)
+        out -= setup.y_lens[i] / 2 * log(2 * pi)
+    out[np.isnan(out)] = -np.inf
+    return out
+
+
+# setup and likelihood engines of an SMC worker process, set once by its pool initializer
+_smc_setup = None
+_smc_engine = None
+
+
+def _smc_worker_init(setup):
+    global _smc_setup, _smc_engine
+    _smc_setup = setup
+    _smc_engine = lik_engines(setup, pooled=True)
+
+
+def _smc_worker_llik(theta):
+    return smc_llik(_smc_setup, theta, _smc_engine)
+
+
+def smc_next_phi(llik, phi, ess_frac):
+    """
+    Next inverse temperature: the largest phi' <= 1 whose incremental weights
+    exp((phi' - phi) llik) keep an effective sample size of at least ess_frac * N (bisection)
+    """
+
+    def ess(dphi):
+        lw = dphi * llik
+        lw -= lw.max()
+        w = np.exp(lw)
+        return w.sum() ** 2 / (w * w).sum()
+
+    target = ess_frac * llik.shape[0]
+    if ess(1.0 - phi) >= target:
+        return 1.0
+    lo, hi = 0.0, 1.0 - phi
+    for _ in range(50):
+        mid = (lo + hi) / 2
+        if ess(mid) >= target:
+            lo = mid
+        else:
+            hi = mid
+    return phi + max(lo, 1e-12)
+
+
+def systematic_resample(w):
+    """indices of a systematic resample of normalized weights w"""
+    n = w.shape[0]
+    cum = np.cumsum(w)
+    cum[-1] = 1.0
+    return np.searchsorted(cum, (uniform() + np.arange(n)) / n)
+
+
+def calibSMC(
+    setup, nparticles=2000, ess_frac=0.5, nmove=5, nproc=1, max_stages=1000
+):
+    """
+    Pooled calibration by sequential Monte Carlo (population annealing).  Particles are drawn
+    from the prior (uniform within the bounds and constraints) and annealed to the posterior
+    through likelihood powers 0 = phi_0 < ... < phi_K = 1.  Each step is chosen adaptively to
+    keep the effective sample size at ess_frac * nparticles, followed by systematic resampling
+    and nmove random-walk Metropolis moves with the (scaled) particle covariance.  All particles
+    are evaluated in one batched model call per move.
+
+    :param setup : CalibSetup object, with s2 fixed (s2 = "fix") or with s2_df > 0 (s2 is then
+        integrated out under its inverse-gamma prior)
+    :param nparticles : number of particles
+    :param ess_frac : (optional) effective sample size fraction that sets the tempering steps
+    :param nmove : (optional) Metropolis moves per stage
+    :param nproc : (optional) number of worker processes sharing each batch of particles;
+        batches of fewer than nproc particles are evaluated in this process
+    :param max_stages : (optional) maximum number of tempering stages
+    :return : OutCalibSMC with the final particles theta (nparticles x p, unit scale) and their
+        log-likelihoods, the log marginal likelihood (log_evidence), and per stage the phi
+        ladder, ESS before resampling and move acceptance rates
+    """
+    smc_check(setup)
+    t0 = time.time()
+    n, p = nparticles, setup.p
+    engine = lik_engines(setup, pooled=True)
+    pool = None
+    if nproc > 1:
+        pool = Pool(nproc, initializer=_smc_worker_init, initargs=(setup,))
+    count_eval = 0
+
+    def llik_batch(theta):
+        nonlocal count_eval
+        count_eval += theta.shape[0]
+        # batches smaller than nproc stay in this process
+        if pool is None or theta.shape[0] < nproc:
+            return smc_llik(setup, theta, engine)
+        return np.concatenate(
+            pool.map(_smc_worker_llik, np.array_split(theta, nproc))
+        )
+
+    def check(theta):
+        return setup.checkConstraintsUnit(theta) & np.all(
+            (theta > 0) & (theta < 1), axis=1
+        )
+
+    # prior draws
+    theta = initfunc_unif(size=[n, p])
+    good = check(theta)
+    while np.any(~good):
+        theta[~good] = initfunc_unif(size=[(~good).sum(), p])
+        good[~good] = check(theta[~good])
+    llik = llik_batch(theta)
+
+    phi = [0.0]
+    ess = []
+    accept = []
+    log_evidence = 0.0
+    scale = 2.38**2 / p
+    try:
+        while phi[-1] < 1.0 and len(phi) <= max_stages:
+            if not np.isfinite(llik).any():
+                raise ValueError(
+                    f"calibSMC has no particle with a finite likelihood at phi = {phi[-1]:.3g}"
+                )
+            # reweight
+            phi_new = smc_next_phi(llik, phi[-1], ess_frac)
+            lw = (phi_new - phi[-1]) * llik
+            log_evidence += logsumexp(lw) - log(n)
+            w = np.exp(lw - logsumexp(lw))
+            ess.append(1 / (w * w).sum())
+            phi.append(phi_new)
+            # resample
+            ind = systematic_resample(w)
+            theta, llik = theta[ind], llik[ind]
+            # move
+            chol = np.linalg.cholesky(np.cov(theta.T) + np.eye(p) * 1e-12)
+            acc = 0.0
+            for _ in range(nmove):
+                theta_cand = (
+                    theta + np.sqrt(scale) * normal(size=(n, p)) @ chol.T
+                )
+                good = check(theta_cand)
+                llik_cand = np.full(n, -np.inf)
+                if np.any(good):
+                    llik_cand[good] = llik_batch(theta_cand[good])
+                with np.errstate(invalid="ignore"):
+                    alpha = phi_new * (llik_cand - llik)
+                move = good & (np.log(uniform(size=n)) < alpha)
+                theta[move], llik[move] = theta_cand[move], llik_cand[move]
+                rate = move.mean()
+                acc += rate / nmove
+                # keep the random walk acceptance rate near 0.25
+                scale *= np.exp(np.clip(rate - 0.25, -0.2, 0.2))
+            accept.append(acc)
+            print(
+                f"\rCalibration SMC stage {len(phi) - 1}, phi = {phi_new:.3g}",
+                end="",
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if phi[-1] < 1.0:
+        raise ValueError(
+            f"calibSMC reached max_stages = {max_stages} at phi = {phi[-1]:.3g}"
+        )
+    print(f"\rCalibration SMC Complete. Time: {time.time() - t0:f} seconds.")
+    return OutCalibSMC(
+        theta,
+        llik,
+        log_evidence,
+        np.array(phi),
+        np.array(ess),
+        np.array(accept),
+        count_eval,
+    )
+
+
+# EOF
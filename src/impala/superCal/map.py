@@ -135,11 +135,10 @@ def get_map_impalapool(
                 for i in range(setup.nexp)
             ]
             pred_y = [
-                setup.models[i].eval(
+                setup.models[i].cached_eval(
                     sc.tran_unif(
                         theta_cur, setup.bounds_mat, setup.bounds.keys()
-                    ),
-                    pool=True,
+                    )
                 )
                 for i in range(setup.nexp)
             ]
@@ -354,9 +353,8 @@ def eval_partialintlogposterior_impalapool(
             np.empty([n_samples, len(setup.ys[i])]) for i in range(setup.nexp)
         ]
         for i in range(setup.nexp):
-            pred_y[i] = setup.models[i].eval(
-                sc.tran_unif(theta_cur, setup.bounds_mat, setup.bounds.keys()),
-                pool=True,
+            pred_y[i] = setup.models[i].cached_eval(
+                sc.tran_unif(theta_cur, setup.bounds_mat, setup.bounds.keys())
             )
         disc_y = [
             (setup.models[i].D @ v_cur_list[i]).reshape(1, -1)
@@ -466,9 +464,8 @@ def eval_fullintlogposterior_impalapool(setup, n_samples=1000, theta=None):
             np.empty([n_samples, len(setup.ys[i])]) for i in range(setup.nexp)
         ]
         for i in range(setup.nexp):
-            pred_y[i] = setup.models[i].eval(
-                sc.tran_unif(y, setup.bounds_mat, setup.bounds.keys()),
-                pool=True,
+            pred_y[i] = setup.models[i].cached_eval(
+                sc.tran_unif(y, setup.bounds_mat, setup.bounds.keys())
             )
         disc_y = [
             (setup.models[i].D @ v_cur_list[i].T).T
@@ -10,11 +10,17 @@
 import abc
 import inspect
 import re
+from collections import OrderedDict
+from functools import partial
 from itertools import cycle
+from math import ceil
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from scipy.interpolate import interp1d
 from scipy.linalg import cho_factor, cholesky
+from scipy.sparse import issparse
 
 # import pyBASS as pb
 # import pyBayesPPR as pbppr
@@ -35,6 +41,136 @@ def chol_sample(mean, cov):
     )
 
 
+def scale_rows(D, w):
+    """Rows of D scaled by the vector w, for D a numpy array or scipy.sparse matrix"""
+    if issparse(D):
+        return D.multiply(np.reshape(w, (-1, 1))).tocsr()
+    return np.reshape(w, (-1, 1)) * D
+
+
+def gram(D, WD):
+    """D^T (WD) as a dense (small) array, for D and WD numpy arrays or scipy.sparse matrices"""
+    out = D.T @ WD
+    return out.toarray() if issparse(out) else out
+
+
+def matmul_right(X, D):
+    """X @ D for a numpy array X and D a numpy array or scipy.sparse matrix"""
+    if issparse(D):
+        return np.asarray((D.T @ X.T).T)
+    return X @ D
+
+
+def make_eval_pool(ncores, backend="process"):
+    """Persistent worker pool for evaluating a scalar (single row) function over parameter rows"""
+    if backend == "process":
+        return Pool(ncores)
+    elif backend == "thread":
+        return ThreadPool(ncores)
+    raise ValueError("backend should be 'process' or 'thread'")
+
+
+def eval_rows(f, parmat_array, vectorized=False, pool=None, chunksize=None):
+    """
+    Evaluate user function f at each row of parmat_array, returning a 2d array (rows x outputs).
+
+    f            : if vectorized, f takes the whole parameter matrix and returns one row of
+                   predictions per parameter row; otherwise f takes a single parameter row
+    pool         : (optional) worker pool from make_eval_pool, used to map rows in chunks when
+                   f is not vectorized
+    chunksize    : number of rows per task sent to the pool
+    """
+    if vectorized:
+        return np.asarray(f(parmat_array)).reshape(parmat_array.shape[0], -1)
+    if pool is None or parmat_array.shape[0] < 2:
+        return np.apply_along_axis(f, 1, parmat_array)
+    return np.array(pool.map(f, parmat_array, chunksize=chunksize))
+
+
+def call_exp(f, i, x):
+    """f(x, i); partial(call_exp, f, i) maps a per-experiment function over parameter rows"""
+    return f(x, i)
+
+
+def pca_coefs(mod, parmat_array, mcmc_use, nugget):
+    """Basis coefficients (rows x nbasis) predicted by a pyBASS / pyBayesPPR basis emulator"""
+    return np.stack(
+        [
+            mod.bm_list[k].predict(parmat_array, mcmc_use, nugget)[0]
+            for k in range(mod.nbasis)
+        ],
+        axis=-1,
+    )
+
+
+def pca_expand(mod, coefs, cols):
+    """Emulator predictions from basis coefficients, at output columns cols only"""
+    ny = mod.basis.shape[0]
+    return (
+        coefs @ mod.basis[cols].T * np.broadcast_to(mod.y_sd, ny)[cols]
+        + np.broadcast_to(mod.y_mean, ny)[cols]
+    )
+
+
+class EvalCache:
+    """
+    Bounded LRU cache of pooled model predictions, keyed on exact parameter rows and the model
+    state they depend on (see AbstractModel.setEvalCache).  hits and misses count rows.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def clear(self):
+        self.store.clear()
+
+    def __call__(self, evaluate, parmat, tag):
+        """
+        Predictions evaluate(parmat), one row per parameter row, from the cache where possible;
+        the rows missing under tag are evaluated in one batch
+        """
+        names = tuple(parmat)
+        x = np.column_stack(
+            np.broadcast_arrays(*[
+                np.asarray(parmat[k], dtype=float) for k in names
+            ])
+        )
+        if x.shape[0] == 0:
+            return evaluate(parmat)
+        keys = [(tag, names, row.tobytes()) for row in x]
+        miss = {}  # key -> first row, duplicates are evaluated once
+        for r, key in enumerate(keys):
+            if key in self.store:
+                self.store.move_to_end(key)
+            else:
+                miss.setdefault(key, r)
+        self.hits += len(keys) - len(miss)
+        self.misses += len(miss)
+        new = {}
+        if miss:
+            rows = np.fromiter(miss.values(), dtype=int, count=len(miss))
+            pred_miss = evaluate({k: x[rows, j] for j, k in enumerate(names)})
+            for key, pred in zip(miss, pred_miss):
+                new[key] = pred.copy()
+        out = np.empty(
+            (len(keys),)
+            + (pred_miss.shape[1:] if miss else self.store[keys[0]].shape)
+        )
+        for r, key in enumerate(keys):
+            out[r] = new[key] if key in new else self.store[key]
+        self.store.update(new)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+        return out
+
+
 #####################
 ### Model Classes ### #should have eval method and stochastic attribute
 #####################
@@ -47,9 +183,102 @@ class AbstractModel:
     Base Class for Simulator/Emulator Models.
     """
 
+    # set True when llik is the default independent Gaussian likelihood with variances s2
+    # (lik_cov_inv diagonal), so the samplers may compute it in vectorized form
+    diag_lik = False
+    eval_cache = None  # EvalCache, see setEvalCache
+    eval_tag = None  # set while evaluating at another fidelity (CalibSetup.setFidelityLadder)
+    obs_keep = None  # observations predicted, see setObservations
+    subset_eval = False  # eval_obs evaluates only the observations asked for
+
     def __init__(self):
         pass
 
+    def setEvalCache(self, maxsize=10000):
+        """
+        Memoize the pooled predictions of cached_eval in a bounded LRU cache keyed on the exact
+        parameter rows and the emulator draw.  Batches with some cached rows
+        only evaluate the others.  The hit rate is eval_cache.hit_rate.
+
+        :param maxsize : maximum number of cached rows, None turns the cache off
+        """
+        self.eval_cache = None if maxsize is None else EvalCache(maxsize)
+
+    def setObservations(self, keep=None):
+        """
+        Predict only the observations keep (sorted indices into the yobs of addVecExperiments) in
+        cached_eval, e.g. for coresets (CalibSetup.setCoreset).  By default predictions are
+        computed in full and subset; override when a model can skip the other observations.
+
+        :param keep : indices of the observations kept, None for all
+        """
+        self.obs_keep = None if keep is None else np.asarray(keep)
+        if keep is not None:
+            # positions of the kept observations within each experiment
+            self.obs_keep_exp = [
+                self.obs_keep
+                if isinstance(cols, slice)
+                else np.flatnonzero(np.isin(cols, self.obs_keep))
+                for cols in self.exp_blocks()
+            ]
+        if self.eval_cache is not None:
+            self.eval_cache.clear()
+
+    def keep_obs(self, pred, i=None):
+        """columns of pred (all observations, or those of experiment i) kept by setObservations"""
+        if self.obs_keep is None:
+            return pred
+        return pred[:, self.obs_keep if i is None else self.obs_keep_exp[i]]
+
+    def eval_state(self):
+        """
+        Hashable model state, besides the parameters, that predictions depend on (cache key), or
+        None if predictions should not be cached.  Stochastic models are keyed on their emulator
+        draw ii.
+        """
+        if getattr(self, "stochastic", False) and not hasattr(self, "ii"):
+            return None
+        return (self.eval_tag, getattr(self, "ii", None))
+
+    def cached_eval(self, parmat, pool=True, i=None):
+        """
+        Predictions as the samplers use them: eval(parmat, pool), or eval_exp(parmat, i) when i
+        is given, at the observations kept by setObservations (from eval_obs when pooled, if
+        subset_eval).  Pooled and per experiment predictions come from the eval cache when one
+        is set (setEvalCache).
+        """
+        if (
+            i is None
+            and pool is True
+            and self.subset_eval
+            and self.obs_keep is not None
+        ):
+
+            def evaluate(x):
+                return self.eval_obs(x, self.obs_keep)
+
+            key = ("eval",)
+        elif i is None:
+
+            def evaluate(x):
+                return self.keep_obs(self.eval(x, pool=pool))
+
+            key = ("eval",)
+        else:
+
+            def evaluate(x):
+                return self.keep_obs(self.eval_exp(x, i), i)
+
+            key = ("exp", i)
+        state = self.eval_state()
+        if (
+            self.eval_cache is None
+            or state is None
+            or (i is None and pool is not True)
+        ):
+            return evaluate(parmat)
+        return self.eval_cache(evaluate, parmat, key + state)
+
     @abc.abstractmethod
     def eval(self, parmat):  # this must be implemented for each model type
         pass
@@ -61,6 +290,10 @@ class AbstractModel:
         out = -0.5 * cov["ldet"] - 0.5 * vec2.sum()
         return out
 
+    def llik_bound(self, cov):
+        """upper bound of llik over predictions (the quadratic form is nonnegative)"""
+        return -0.5 * cov["ldet"]
+
     # @profile
     def lik_cov_inv(self, s2vec):  # default is diagonal covariance matrix
         inv = 1 / s2vec
@@ -68,6 +301,97 @@ class AbstractModel:
         out = {"inv": inv, "ldet": ldet}
         return out
 
+    def exp_blocks(self):
+        """output columns of each experiment (exp_ind), for non-pooled evaluation"""
+        if np.ndim(self.exp_ind) == 0:  # single experiment
+            return [slice(None)]
+        return [
+            np.where(self.exp_ind == i)[0]
+            for i in range(self.exp_ind.max() + 1)
+        ]
+
+    def eval_hier(self, x, eval_exp):
+        """
+        Non-pooled (hierarchical) evaluation.  Rows of x cycle over experiments (row r belongs to
+        experiment r % nexp); eval_exp(i, x_i, cols) gives predictions for the rows x_i of
+        experiment i at its output columns cols only.  Output columns are ordered by experiment.
+        """
+        blocks = self.exp_blocks()
+        nexp = len(blocks)
+        return np.concatenate(
+            [eval_exp(i, x[i::nexp], cols) for i, cols in enumerate(blocks)], 1
+        )
+
+    def eval_exp(self, parmat, i):
+        """
+        Predictions at each row of parmat for the outputs of experiment i (exp_ind == i) only.
+        Override when a model can skip the other experiments' outputs.
+        """
+        return self.eval(parmat, pool=True)[:, self.exp_blocks()[i]]
+
+    def eval_obs(self, parmat, idx):
+        """
+        Pooled predictions at the observations idx only, for subsampled likelihoods.  Override
+        (and set subset_eval) when a model can skip the other observations.
+        """
+        return self.eval(parmat, pool=True)[:, idx]
+
+    def dev_sq(self, yobs, pred, s2_ind, ns2):
+        """squared deviations of each row of pred from yobs, summed within each s2 group"""
+        return (pred - yobs) ** 2 @ (s2_ind[:, None] == np.arange(ns2))
+
+    def discrep_gram(self, inv):
+        """D^T W D, for inverse covariance W (a vector if diagonal, else a matrix)"""
+        if np.ndim(inv) < 2:  # diagonal: scale rows of D, O(n nd^2)
+            return gram(self.D, scale_rows(self.D, inv))
+        return gram(self.D, matmul_right(inv, self.D))
+
+    def discrep_rhs(self, resid, invs):
+        """D^T W r for each row of resid (ntemps x n), one inverse covariance per row"""
+        if all(np.ndim(inv) < 2 for inv in invs):
+            Wr = resid * np.stack(np.broadcast_arrays(*invs))
+        else:
+            Wr = np.stack([inv @ r for inv, r in zip(invs, resid)])
+        return matmul_right(Wr, self.D)
+
+    def discrep_sample_batch(self, yobs, preds, covs, itemps):
+        """
+        Gibbs draw of the discrepancy basis coefficients for all temperatures at once
+
+        yobs   : observations (n)
+        preds  : predictions, one row per temperature (ntemps x n)
+        covs   : list of likelihood covariances from lik_cov_inv, one per temperature
+        itemps : inverse temperatures (ntemps)
+        """
+        invs = [cov["inv"] for cov in covs]
+        # D^T W D only changes with the covariance and basis (cached while s2 is fixed)
+        cache = getattr(self, "_gram_cache", {})
+        self._gram_cache = {}
+        DtWD = np.empty((len(invs), self.nd, self.nd))
+        for t, inv in enumerate(invs):
+            key = (id(inv), id(self.D))
+            hit = cache.get(key) or self._gram_cache.get(key)
+            if hit is None or hit[0] is not inv or hit[1] is not self.D:
+                hit = (inv, self.D, self.discrep_gram(inv))
+            self._gram_cache[key] = hit
+            DtWD[t] = hit[2]
+        # scalar or vector-valued discrep_tau (defined by addVecExperiments)
+        prec = np.eye(self.nd) / self.discrep_tau + DtWD
+        mean = np.linalg.solve(
+            prec, self.discrep_rhs(yobs - preds, invs)[..., None]
+        )[..., 0]
+        chol = np.linalg.cholesky(prec)
+        z = np.random.standard_normal(mean.shape) / np.sqrt(itemps)[:, None]
+        return (
+            mean
+            + np.linalg.solve(np.swapaxes(chol, -1, -2), z[..., None])[..., 0]
+        )
+
+    def discrep_sample(self, yobs, pred, cov, itemp):
+        return self.discrep_sample_batch(
+            yobs, np.reshape(pred, (1, -1)), [cov], np.array([itemp])
+        )[0]
+
     def step(self):
         return
 
@@ -129,14 +453,6 @@ class ModelmvBayes(AbstractModel):
         self.ii = np.random.choice(range(self.nmcmc), 1).item()
         self.emu_vars = self.mod_s2[self.ii]
 
-    def discrep_sample(self, yobs, pred, cov, itemp):
-        S = np.linalg.inv(
-            np.eye(self.nd) / self.discrep_tau + self.D.T @ cov["inv"] @ self.D
-        )
-        m = self.D.T @ cov["inv"] @ (yobs - pred)
-        discrep_vars = chol_sample(S @ m, S / itemp)
-        return discrep_vars
-
     def eval(self, parmat, pool=None, nugget=False):
         """
         parmat : ~
@@ -150,21 +466,7 @@ class ModelmvBayes(AbstractModel):
 
         if pool is True:
             return pred
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            return np.concatenate(
-                [
-                    pred[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
-            )
-            # this is evaluating all experiments for all thetas, which is overkill
+        return self.eval_hier(pred, lambda i, pred_i, cols: pred_i[:, cols])
 
     def llik(self, yobs, pred, cov):
         vec = yobs - pred
@@ -243,27 +545,20 @@ class ModelBassPca_mult(AbstractModel):
         parmat_array = np.vstack([
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
-        pred = self.mod.predict(
-            parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
-        )[0, :, :]
-
         if pool is True:
-            return pred
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            return np.concatenate(
-                [
-                    pred[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
-            )
-            # this is evaluating all experiments for all thetas, which is overkill
+            return self.mod.predict(
+                parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
+            )[0, :, :]
+        # each theta only on its own experiment's slice of the basis
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return self.eval_hier(
+            coefs, lambda i, coefs_i, cols: pca_expand(self.mod, coefs_i, cols)
+        )
+
+    def eval_exp(self, parmat, i, nugget=False):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return pca_expand(self.mod, coefs, self.exp_blocks()[i])
 
     def llik(self, yobs, pred, cov):
         vec = yobs - pred
@@ -343,27 +638,20 @@ class ModelBpprPca_mult(AbstractModel):
         parmat_array = np.vstack([
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
-        pred = self.mod.predict(
-            parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
-        )[0, :, :]
-
         if pool is True:
-            return pred
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            return np.concatenate(
-                [
-                    pred[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
-            )
-            # this is evaluating all experiments for all thetas, which is overkill
+            return self.mod.predict(
+                parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
+            )[0, :, :]
+        # each theta only on its own experiment's slice of the basis
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return self.eval_hier(
+            coefs, lambda i, coefs_i, cols: pca_expand(self.mod, coefs_i, cols)
+        )
+
+    def eval_exp(self, parmat, i, nugget=False):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return pca_expand(self.mod, coefs, self.exp_blocks()[i])
 
     def llik(self, yobs, pred, cov):
         vec = yobs - pred
@@ -447,16 +735,6 @@ class ModelBassPca_func(AbstractModel):
         self.emu_vars = self.mod_s2[self.ii]
 
     # @profile
-    def discrep_sample(self, yobs, pred, cov, itemp):
-        # if self.nd>0:
-        S = np.linalg.inv(
-            np.eye(self.nd) / self.discrep_tau + self.D.T @ cov["inv"] @ self.D
-        )
-        m = self.D.T @ cov["inv"] @ (yobs - pred)
-        discrep_vars = chol_sample(S @ m, S / itemp)
-        # self.discrep = self.D @ self.discrep_vars
-        return discrep_vars
-
     # @profile
     def eval(self, parmat, pool=None, nugget=False):
         """
@@ -465,27 +743,20 @@ class ModelBassPca_func(AbstractModel):
         parmat_array = np.vstack([
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
-        pred = self.mod.predict(
-            parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
-        )[0, :, :]
-
         if pool is True:
-            return pred
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            return np.concatenate(
-                [
-                    pred[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
-            )
-            # this is evaluating all experiments for all thetas, which is overkill
+            return self.mod.predict(
+                parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
+            )[0, :, :]
+        # each theta only on its own experiment's slice of the basis
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return self.eval_hier(
+            coefs, lambda i, coefs_i, cols: pca_expand(self.mod, coefs_i, cols)
+        )
+
+    def eval_exp(self, parmat, i, nugget=False):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return pca_expand(self.mod, coefs, self.exp_blocks()[i])
 
     # @profile
     def llik(self, yobs, pred, cov):
@@ -590,16 +861,6 @@ class ModelBpprPca_func(AbstractModel):
         self.emu_vars = self.mod_s2[self.ii]
 
     # @profile
-    def discrep_sample(self, yobs, pred, cov, itemp):
-        # if self.nd>0:
-        S = np.linalg.inv(
-            np.eye(self.nd) / self.discrep_tau + self.D.T @ cov["inv"] @ self.D
-        )
-        m = self.D.T @ cov["inv"] @ (yobs - pred)
-        discrep_vars = chol_sample(S @ m, S / itemp)
-        # self.discrep = self.D @ self.discrep_vars
-        return discrep_vars
-
     # @profile
     def eval(self, parmat, pool=None, nugget=False):
         """
@@ -608,27 +869,20 @@ class ModelBpprPca_func(AbstractModel):
         parmat_array = np.vstack([
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
-        pred = self.mod.predict(
-            parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
-        )[0, :, :]
-
         if pool is True:
-            return pred
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            return np.concatenate(
-                [
-                    pred[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
-            )
-            # this is evaluating all experiments for all thetas, which is overkill
+            return self.mod.predict(
+                parmat_array, mcmc_use=np.array([self.ii]), nugget=nugget
+            )[0, :, :]
+        # each theta only on its own experiment's slice of the basis
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return self.eval_hier(
+            coefs, lambda i, coefs_i, cols: pca_expand(self.mod, coefs_i, cols)
+        )
+
+    def eval_exp(self, parmat, i, nugget=False):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        coefs = pca_coefs(self.mod, parmat_array, np.array([self.ii]), nugget)
+        return pca_expand(self.mod, coefs, self.exp_blocks()[i])
 
     # @profile
     def llik(self, yobs, pred, cov):
@@ -676,21 +930,83 @@ class ModelBpprPca_func(AbstractModel):
         return out
 
 
+class FuncEvalMixin:
+    """
+    Evaluation of a user function mod (or f_exp for one experiment) over parameter rows, for
+    ModelF and ModelF_bigdata: vectorized, or mapped through a persistent worker pool started
+    on first use (ncores, backend, chunksize).
+    """
+
+    def __getstate__(self):  # worker pools cannot be pickled
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def close(self):
+        """Shut down the worker pool, if one was started"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def eval_rows(self, parmat_array, exp=None):
+        """predictions (rows x outputs) of mod, or of f_exp for experiment exp"""
+        if (
+            self.ncores is not None
+            and not self.vectorized
+            and self._pool is None
+        ):
+            self._pool = make_eval_pool(self.ncores, self.backend)
+        chunksize = self.chunksize
+        if chunksize is None and self.ncores is not None:
+            chunksize = ceil(parmat_array.shape[0] / (4 * self.ncores))
+        return eval_rows(
+            self.mod if exp is None else partial(call_exp, self.f_exp, exp),
+            parmat_array,
+            vectorized=self.vectorized,
+            pool=self._pool,
+            chunksize=chunksize,
+        )
+
+
 #######
 ### ModelF: Function for Simulator Model Evaluation or Evaluation of Alternative Emulator Model
-class ModelF(AbstractModel):
+class ModelF(FuncEvalMixin, AbstractModel):
     """Custom Simulator/Emulator Model"""
 
+    diag_lik = True
+
     def __init__(
-        self, f, input_names, exp_ind=None, s2="gibbs"
-    ):  # not sure if this is vectorized
+        self,
+        f,
+        input_names,
+        exp_ind=None,
+        s2="gibbs",
+        vectorized=False,
+        ncores=None,
+        backend="process",
+        chunksize=None,
+        f_exp=None,
+    ):
         """
         f           : user-defined function taking single input with elements x[0] = first element of theta, x[1] = second element of theta, etc. Function must output predictions for all observations
         input_names : list of the names of the inputs to bmod
         s2          : method for handling experiment-specific noise s2; options are 'MH' (Metropolis-Hastings Sampling), 'fix' (fixed at s2_est from addVecExperiments call), and 'gibbs' (Gibbs sampling)
+        vectorized  : if True, f takes the whole parameter matrix (rows = parameter combinations, columns ordered as input_names) and returns a 2d array with one row of predictions per parameter combination
+        ncores      : (optional) number of workers in a persistent pool used to map a non-vectorized f over parameter rows, default = no pool
+        backend     : 'process' (multiprocessing, f must be picklable) or 'thread' (useful when f releases the GIL)
+        chunksize   : (optional) number of parameter rows per task sent to the pool
+        f_exp       : (optional) function f_exp(x, i) giving predictions for the observations of experiment i only
+                      (exp_ind == i), vectorized like f. Used for hierarchical evaluation, so each theta is only run
+                      for its own experiment instead of predicting all observations with f
         """
         self.mod = f
         self.input_names = input_names
+        self.vectorized = vectorized
+        self.ncores = ncores
+        self.backend = backend
+        self.chunksize = chunksize
+        self.f_exp = f_exp
+        self._pool = None
         self.stochastic = False
         self.yobs = None
         self.meas_error_cor = 1.0  # np.diag(self.basis.shape[0])
@@ -707,55 +1023,68 @@ class ModelF(AbstractModel):
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
         if pool is True:
-            return np.apply_along_axis(self.mod, 1, parmat_array)
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            out_all = np.apply_along_axis(self.mod, 1, parmat_array)
-
-            # out_sub = np.concatenate([out_all[(i*nrep):(i*nrep+nrep), self.exp_ind==i] for i in range(self.nexp)], 1)
-            out_sub = np.concatenate(
-                [
-                    out_all[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
+            return self.eval_rows(parmat_array)
+        if self.f_exp is not None:  # each theta only on its own experiment
+            return self.eval_hier(
+                parmat_array, lambda i, x_i, cols: self.eval_rows(x_i, i)
             )
-            return out_sub
-            # this is evaluating all experiments for all thetas, which is overkill
-        # need to have some way of dealing with non-pooled eval fo this and bassPCA version
-
-    def discrep_sample(
-        self, yobs, pred, cov, itemp
-    ):  # Added by Lauren on 11/17/23.
-        S = np.linalg.inv(
-            np.eye(self.nd) / self.discrep_tau  # defined by addVecExperiments
-            + self.D.T @ (cov["inv"].flatten() * np.eye(len(yobs))) @ self.D
+        return self.eval_hier(
+            self.eval_rows(parmat_array),
+            lambda i, pred_i, cols: pred_i[:, cols],
         )
-        m = self.D.T @ (cov["inv"] * np.eye(len(yobs))) @ (yobs - pred)
-        discrep_vars = chol_sample(S @ m, S / itemp)
-        return discrep_vars
+
+    def eval_exp(self, parmat, i):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        if self.f_exp is not None:
+            return self.eval_rows(parmat_array, i)
+        return self.eval_rows(parmat_array)[:, self.exp_blocks()[i]]
 
 
 #######
 ### ModelF_bigdata: Function for Simulator Model Evaluation or Evaluation of Alternative Emulator Model using Bigger Data
-class ModelF_bigdata(AbstractModel):
+class ModelF_bigdata(FuncEvalMixin, AbstractModel):
     """Custom Simulator/Emulator Model"""
 
+    diag_lik = True
+
     def __init__(
-        self, f, input_names, exp_ind=None, s2="gibbs"
-    ):  # not sure if this is vectorized
+        self,
+        f,
+        input_names,
+        exp_ind=None,
+        s2="gibbs",
+        vectorized=False,
+        ncores=None,
+        backend="process",
+        chunksize=None,
+        obs_chunk=None,
+        f_exp=None,
+        f_obs=None,
+    ):
         """
         f           : user-defined function taking single input with elements x[0] = first element of theta, x[1] = second element of theta, etc. Function must output predictions for all observations
         input_names : list of the names of the inputs to bmod
         s2          : method for handling experiment-specific noise s2; options are 'MH' (Metropolis-Hastings Sampling), 'fix' (fixed at s2_est from addVecExperiments call), and 'gibbs' (Gibbs sampling)
+        vectorized  : if True, f takes the whole parameter matrix (rows = parameter combinations, columns ordered as input_names) and returns a 2d array with one row of predictions per parameter combination
+        ncores      : (optional) number of workers in a persistent pool used to map a non-vectorized f over parameter rows, default = no pool
+        backend     : 'process' (multiprocessing, f must be picklable) or 'thread' (useful when f releases the GIL)
+        chunksize   : (optional) number of parameter rows per task sent to the pool
+        f_exp       : (optional) function f_exp(x, i) giving predictions for the observations of experiment i only
+                      (exp_ind == i), vectorized like f. Used for hierarchical evaluation, so each theta is only run
+                      for its own experiment instead of predicting all observations with f
+        obs_chunk   : (optional) number of observations per block used for the likelihood, s2 sufficient statistics and
+                      discrepancy normal equations, bounding peak memory for very long outputs. Default = no blocking
+        f_obs       : (optional) function f_obs(x, idx) giving predictions for the observations idx only, vectorized
+                      like f. Used by subsampled likelihoods (CalibSetup.setSubsampling)
         """
         self.mod = f
         self.input_names = input_names
+        self.vectorized = vectorized
+        self.ncores = ncores
+        self.backend = backend
+        self.chunksize = chunksize
+        self.f_exp = f_exp
+        self._pool = None
         self.stochastic = False
         self.yobs = None
         self.meas_error_cor = 1.0  # np.diag(self.basis.shape[0])
@@ -765,21 +1094,11 @@ class ModelF_bigdata(AbstractModel):
         self.exp_ind = exp_ind
         self.nd = 0
         self.s2 = s2
-        self.vec = np.linspace(
-            1, 16200, 16200
-        )  # define to speed up llik evaluation
-        self.vec2 = np.linspace(
-            1, 16200, 16200
-        )  # define to speed up llik evaluation
-        self.inv = np.linspace(
-            1, 16200, 16200
-        )  # define to speed up lik_cov_inv evaluation
-        self.m = np.linspace(
-            1, 16200, 16200
-        )  # define to speed up discrep_sample evaluation
-        self.vmat = np.linspace(
-            1, 16200, 16200
-        )  # define to speed up discrep_sample evaluation
+        self.obs_chunk = obs_chunk
+        self.f_obs = f_obs
+        self.subset_eval = f_obs is not None
+        self.vec = None  # scratch buffers, sized from the data on first use
+        self.vmat = None
         self.constants = None
 
     def eval(self, parmat, pool=None, nugget=False):
@@ -787,56 +1106,93 @@ class ModelF_bigdata(AbstractModel):
             parmat[v] for v in self.input_names
         ]).T  # get correct subset/ordering of inputs
         if pool is True:
-            return np.apply_along_axis(self.mod, 1, parmat_array)
-        else:
-            nrep = next(iter(parmat.values())).shape[0] // self.nexp
-            out_all = np.apply_along_axis(self.mod, 1, parmat_array)
-
-            # out_sub = np.concatenate([out_all[(i*nrep):(i*nrep+nrep), self.exp_ind==i] for i in range(self.nexp)], 1)
-            out_sub = np.concatenate(
-                [
-                    out_all[
-                        np.ix_(
-                            np.arange(i, nrep * self.nexp, self.nexp),
-                            np.where(self.exp_ind == i)[0],
-                        )
-                    ]
-                    for i in range(self.nexp)
-                ],
-                1,
+            return self.eval_rows(parmat_array)
+        if self.f_exp is not None:  # each theta only on its own experiment
+            return self.eval_hier(
+                parmat_array, lambda i, x_i, cols: self.eval_rows(x_i, i)
             )
-            return out_sub
-            # this is evaluating all experiments for all thetas, which is overkill
-        # need to have some way of dealing with non-pooled eval fo this and bassPCA version
-
-    def discrep_sample(
-        self, yobs, pred, cov, itemp
-    ):  # Added by Lauren on 11/17/23.
-        self.vec = cov["inv"].reshape(-1, 1) * (yobs - pred).reshape(-1, 1)
-        self.vmat = (
-            np.repeat(cov["inv"].reshape(-1, 1), self.nd, axis=1) * self.D
+        return self.eval_hier(
+            self.eval_rows(parmat_array),
+            lambda i, pred_i, cols: pred_i[:, cols],
         )
-        S = np.linalg.inv(
-            # np.eye(self.nd) / self.discrep_tau #defined by addVecExperiments
-            np.diag(
-                1 / self.discrep_tau
-            )  # modification to allow vector-valued discrep_tau
-            + self.D.T @ self.vmat
+
+    def eval_exp(self, parmat, i):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        if self.f_exp is not None:
+            return self.eval_rows(parmat_array, i)
+        return self.eval_rows(parmat_array)[:, self.exp_blocks()[i]]
+
+    def eval_obs(self, parmat, idx):
+        parmat_array = np.vstack([parmat[v] for v in self.input_names]).T
+        if self.f_obs is None:
+            return self.eval_rows(parmat_array)[:, idx]
+        return eval_rows(
+            partial(call_exp, self.f_obs, idx),
+            parmat_array,
+            vectorized=self.vectorized,
         )
-        self.m = self.D.T @ self.vec
-        discrep_vars = chol_sample((S @ self.m).flatten(), S / itemp)
-        return discrep_vars
+
+    def scratch(self, n):
+        """Scratch vector of length n (reused between calls to avoid reallocation)"""
+        if self.vec is None or self.vec.shape[0] != n:
+            self.vec = np.empty(n)
+        return self.vec
+
+    def blocks(self, n):
+        """Slices covering range(n) in blocks of obs_chunk observations"""
+        step = n if self.obs_chunk is None else self.obs_chunk
+        return [slice(lo, min(lo + step, n)) for lo in range(0, n, step)]
+
+    def discrep_gram(self, inv):
+        if self.obs_chunk is None and not issparse(self.D):
+            if self.vmat is None or self.vmat.shape != self.D.shape:
+                self.vmat = np.empty(self.D.shape)
+            np.multiply(self.D, inv.reshape(-1, 1), out=self.vmat)
+            return self.D.T @ self.vmat
+        DtWD = np.zeros((self.nd, self.nd))
+        for blk in self.blocks(inv.shape[0]):
+            Dk = self.D[blk]
+            DtWD += gram(Dk, scale_rows(Dk, inv[blk]))
+        return DtWD
+
+    def discrep_rhs(self, resid, invs):
+        DtWr = np.zeros((resid.shape[0], self.nd))
+        for blk in self.blocks(resid.shape[1]):
+            DtWr += matmul_right(
+                resid[:, blk] * np.stack([v[blk] for v in invs]), self.D[blk]
+            )
+        return DtWr
 
     def llik(self, yobs, pred, cov):  # assumes diagonal cov
-        self.vec = yobs.flatten() - pred.flatten()
-        self.vec2 = self.vec * self.vec * cov["inv"]
-        out = -0.5 * cov["ldet"] - 0.5 * self.vec2.sum()
+        yobs = yobs.ravel()
+        pred = pred.ravel()
+        inv = cov["inv"]
+        n = yobs.shape[0]
+        buf = self.scratch(
+            n if self.obs_chunk is None else min(n, self.obs_chunk)
+        )
+        sse = 0.0
+        for blk in self.blocks(n):
+            vec = buf[: blk.stop - blk.start]
+            np.subtract(yobs[blk], pred[blk], out=vec)
+            np.multiply(vec, vec, out=vec)
+            sse += np.dot(vec, inv[blk])
+        out = -0.5 * cov["ldet"] - 0.5 * sse
         return out
 
     def lik_cov_inv(self, s2vec):  # default is diagonal covariance matrix
-        self.inv = 1 / s2vec
+        # callers keep the returned inverse, so it is not a reused buffer
+        inv = 1 / s2vec
         ldet = np.log(s2vec).sum()
-        out = {"inv": self.inv, "ldet": ldet}
+        out = {"inv": inv, "ldet": ldet}
+        return out
+
+    def dev_sq(self, yobs, pred, s2_ind, ns2):
+        out = np.zeros((pred.shape[0], ns2))
+        for blk in self.blocks(yobs.shape[0]):
+            out += (pred[:, blk] - yobs[blk]) ** 2 @ (
+                s2_ind[blk, None] == np.arange(ns2)
+            )
         return out
 
 
@@ -852,6 +1208,8 @@ class ModelMaterialStrength(AbstractModel):
     Currently not able to handle pooled model discrepancy.
     """
 
+    diag_lik = True
+
     def __init__(
         self,
         temps,
@@ -879,10 +1237,8 @@ class ModelMaterialStrength(AbstractModel):
         pool                : False if fitting hierarchical model, True if fitting pooled model
         s2                  : method for handling experiment-specific noise s2; options are 'MH' (Metropolis-Hastings Sampling), 'fix' (fixed at s2_est from addVecExperiments call)
         """
-        self.meas_strain_histories = strain_histories
-        self.meas_strain_max = np.array([v.max() for v in strain_histories])
-        self.strain_max = self.meas_strain_max.max()
-        self.nhists = sum(len(v) for v in strain_histories)
+        self.strain_histories_full = strain_histories
+        self.set_strain_histories(strain_histories)
         self.model = pm_vec.MaterialModel(
             flow_stress_model=eval("pm_vec." + flow_stress_model),
             shear_modulus_model=eval("pm_vec." + shear_model),
@@ -910,6 +1266,35 @@ class ModelMaterialStrength(AbstractModel):
 
         # self.meas_error_cor = np.diag(self.basis.shape[0])
 
+    def set_strain_histories(self, strain_histories):
+        self.meas_strain_histories = strain_histories
+        self.meas_strain_max = np.array([v.max() for v in strain_histories])
+        self.strain_max = self.meas_strain_max.max()
+        self.nhists = sum(len(v) for v in strain_histories)
+
+    def setObservations(self, keep=None):
+        """Only the kept strains of each history are interpolated (and simulated up to)"""
+        full = self.strain_histories_full
+        if keep is None:
+            hists = full
+        else:
+            keep = np.asarray(keep)
+            ends = np.cumsum([len(v) for v in full])
+            starts = ends - [len(v) for v in full]
+            hists = [
+                v[keep[(keep >= lo) & (keep < hi)] - lo]
+                for v, lo, hi in zip(full, starts, ends)
+            ]
+            if any(len(v) == 0 for v in hists):
+                raise ValueError("keep should retain strains of every history")
+        self.set_strain_histories(hists)
+        if self.eval_cache is not None:
+            self.eval_cache.clear()
+
+    def eval_state(self):
+        state = super().eval_state()
+        return state + (self.Nhist,)
+
     def eval(
         self, parmat, pool=None, nugget=False
     ):  # note: extra parameters ignored
@@ -926,15 +1311,26 @@ class ModelMaterialStrength(AbstractModel):
                 next(iter(parmat.values())).shape[0] // self.nexp
             )  # number of temper temps
             parmat_big = parmat
+        return self.simulate(parmat_big, nrep, np.arange(self.nexp))
+
+    def eval_exp(self, parmat, i):
+        """flow stress predictions for experiment i only, at each row of parmat"""
+        nrep = next(iter(parmat.values())).shape[0]
+        return self.simulate(parmat, nrep, np.array([i]))
 
+    def simulate(self, parmat_big, nrep, exps):
+        """
+        Run the strength model for experiments exps, rows of parmat_big cycling over them (nrep
+        times).  Returns the predictions at the measured strains, one row per repetition.
+        """
         edots = np.kron(
-            np.ones(nrep), self.edots
+            np.ones(nrep), np.atleast_1d(self.edots)[exps]
         )  # 1d vector, nexp * temper_temps
         temps = np.kron(
-            np.ones(nrep), self.temps
+            np.ones(nrep), np.atleast_1d(self.temps)[exps]
         )  # 1d vector, nexp * temper_temps
         strain_maxs = np.kron(
-            np.ones(nrep), self.meas_strain_max
+            np.ones(nrep), self.meas_strain_max[exps]
         )  # 1d vector, nexp * temper_temps
         ntot = edots.shape[0]  # nexp * temper_temps
         self.model.set_history_variables(strain_maxs, edots, self.Nhist)
@@ -963,7 +1359,8 @@ class ModelMaterialStrength(AbstractModel):
                 [
                     x + y
                     for x, y in zip(
-                        cycle(self.meas_strain_histories), strain_ends
+                        cycle([self.meas_strain_histories[k] for k in exps]),
+                        strain_ends,
                     )
                 ]
             )
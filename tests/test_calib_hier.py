@@ -0,0 +1,506 @@
+import numpy as np
+
+from impala import superCal as sc
+
+from .test_model_eval import friedman, friedman_vec
+
+NEXP = 3
+
+
+def friedman_stacked(theta):
+    return np.tile(friedman(theta), NEXP)
+
+
+def friedman_shifted(theta):
+    # cheaper stand-in model for the hot temperatures of a fidelity ladder
+    return friedman(theta) + 0.02
+
+
+def make_setup(nmcmc=100, diag_lik=True):
+    np.random.seed(10)
+    names = ["a", "b", "c", "d"]
+    theta_ind = np.repeat(np.arange(NEXP), 20)
+    yobs = np.concatenate([
+        friedman(th) for th in np.random.uniform(size=(NEXP, 4))
+    ]) + np.random.normal(scale=0.1, size=theta_ind.shape[0])
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+    model = sc.ModelF(friedman_stacked, names, exp_ind=theta_ind)
+    model.diag_lik = diag_lik
+    setup.addVecExperiments(
+        yobs,
+        model,
+        sd_est=[0.1] * NEXP,
+        s2_df=[0] * NEXP,
+        s2_ind=theta_ind,
+        theta_ind=theta_ind,
+    )
+    setup.setTemperatureLadder(1.1 ** np.arange(3))
+    setup.setMCMC(nmcmc=nmcmc, decor=25)
+    setup.setHierPriors(
+        theta0_prior_mean=np.repeat(0.5, 4),
+        theta0_prior_cov=np.eye(4),
+        Sigma0_prior_df=6,
+        Sigma0_prior_scale=np.eye(4) * 0.1,
+    )
+    setup.setClusterPriors(nclustmax=4)
+    return setup
+
+
+def test_gauss_lik_segments():
+    """segmented likelihoods match per-theta model.llik calls"""
+    np.random.seed(11)
+    n, ntheta, ns2 = 200, 5, 3
+    yobs = np.random.normal(size=n)
+    pred = np.random.normal(size=(2, 4, n))
+    theta_ind = np.random.randint(0, ntheta, size=n)
+    s2_ind = np.random.randint(0, ns2, size=n)
+    log_s2 = np.random.normal(size=(2, 1, ns2))
+    model = sc.ModelF(friedman, ["a"])
+    engine = sc.GaussLikSegments(yobs, theta_ind, ntheta, s2_ind, ns2)
+    sse = engine.sse(pred)
+    llik = engine.llik(sse, log_s2)
+    assert llik.shape == (2, 4, ntheta)
+    for t in range(2):
+        covs = sc.lik_cov_theta(
+            model,
+            np.repeat(log_s2[t], 4, axis=0),
+            s2_ind,
+            [np.where(theta_ind == j)[0] for j in range(ntheta)],
+        )
+        ref = sc.llik_theta(
+            model,
+            yobs,
+            pred[t],
+            covs,
+            [np.where(theta_ind == j)[0] for j in range(ntheta)],
+        )
+        assert np.allclose(llik[t], ref)
+    assert np.allclose(
+        engine.dev_sq(sse), model.dev_sq(yobs, pred, s2_ind, ns2)
+    )
+
+
+def test_eval_theta_rows():
+    """only the requested (temperature, theta) rows are evaluated, on their own experiment"""
+    setup = make_setup()
+    nrows = []
+
+    def count_exp(x, i):
+        nrows.append(x.shape[0])
+        return friedman_vec(x)
+
+    model = setup.models[0]
+    model.f_exp = count_exp
+    model.vectorized = True
+    np.random.seed(15)
+    theta = np.random.uniform(size=(3, NEXP, 4))
+    full = sc.eval_theta(setup, 0, theta)
+    assert full.shape == (3, 60)
+    assert nrows == [3] * NEXP
+    rows = np.array([
+        [True, False, False],
+        [False, False, False],
+        [True, False, True],
+    ])
+    pred_curr = np.zeros((3, 60))
+    nrows.clear()
+    pred = sc.eval_theta(setup, 0, theta, rows, pred_curr)
+    assert nrows == [2, 1]
+    mask = rows[:, setup.theta_ind[0]]
+    assert np.allclose(pred[mask], full[mask])
+    assert np.all(pred[~mask] == 0)
+
+
+def test_calib_hier_clust_vectorized_likelihood():
+    """the vectorized likelihood gives the same chains as the per-theta loops"""
+    for calib in [sc.calibHier, sc.calibClust]:
+        outs = []
+        for diag_lik in [True, False]:
+            setup = make_setup(diag_lik=diag_lik)
+            outs.append(calib(setup))
+        assert np.allclose(outs[0].theta[-1], outs[1].theta[-1])
+        assert np.all(np.isfinite(outs[0].theta[-1]))
+
+
+def test_invwishart_rvs_batch():
+    """batched Bartlett draws: factors are consistent and the mean is scale / (df - p - 1)"""
+    np.random.seed(12)
+    p, ndraw = 3, 20000
+    A = np.random.normal(size=(2, p, p))
+    scales = A @ np.swapaxes(A, -1, -2) + np.eye(p)
+    dfs = np.array([8.0, 12.5])
+    Sigma, chol, inv, ldet = sc.invwishart_rvs_batch(dfs, scales)
+    assert np.allclose(chol @ np.swapaxes(chol, -1, -2), Sigma)
+    assert np.allclose(np.triu(chol, 1), 0)
+    assert np.allclose(inv, np.linalg.inv(Sigma))
+    assert np.allclose(ldet, np.linalg.slogdet(Sigma)[1])
+    assert np.allclose(
+        sc.invwishart_logpdf(Sigma, p + 2, np.eye(p)),
+        sc.invwishart_logpdf(Sigma, p + 2, np.eye(p), ldet, inv),
+    )
+
+    draws = sc.invwishart_rvs_batch(
+        np.tile(dfs, ndraw), np.tile(scales, (ndraw, 1, 1))
+    )[0].reshape(ndraw, 2, p, p)
+    expected = scales / (dfs - p - 1)[:, None, None]
+    assert np.allclose(draws.mean(axis=0), expected, rtol=0.05, atol=0.02)
+
+
+def make_multi_setup(nmcmc=150, ncores=None):
+    # NEXP separate experiments, one theta each
+    np.random.seed(14)
+    names = ["a", "b", "c", "d"]
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+    for th in np.random.uniform(size=(NEXP, 4)):
+        setup.addVecExperiments(
+            friedman(th) + np.random.normal(scale=0.1, size=20),
+            sc.ModelF(friedman, names, s2="gibbs", ncores=ncores),
+            sd_est=[0.1],
+            s2_df=[0],
+            s2_ind=np.zeros(20, dtype=int),
+        )
+    setup.setTemperatureLadder(1.1 ** np.arange(3), start_temper=50)
+    setup.setMCMC(nmcmc=nmcmc, decor=25)
+    setup.setHierPriors(
+        theta0_prior_mean=np.repeat(0.5, 4),
+        theta0_prior_cov=np.eye(4),
+        Sigma0_prior_df=6,
+        Sigma0_prior_scale=np.eye(4) * 0.1,
+    )
+    return setup
+
+
+def test_calib_hier_sharded():
+    """experiments split across worker processes: valid output in experiment order"""
+    setup = make_multi_setup()
+    assert sc.shard_experiments(setup, 2) == [[0, 2], [1]]
+    np.random.seed(13)
+    out = sc.calibHier(setup, nshards=2)
+    assert out.theta0.shape == (150, 3, 4)
+    for i in range(NEXP):
+        assert out.theta[i].shape == (150, 3, 1, 4)
+        assert np.all(out.s2[i] > 0)
+        # current predictions belong to the final thetas of experiment i
+        assert np.allclose(
+            out.pred_curr[i], friedman_vec(out.theta[i][-1, :, 0]), atol=1e-8
+        )
+    assert np.all(np.isfinite(out.Sigma0))
+    assert np.all(np.linalg.eigvalsh(out.Sigma0[-1]) > 0)
+
+    setup.setClusterPriors()
+    setup.setFidelityLadder([0, 0, 1])
+    with np.testing.assert_raises(ValueError):
+        sc.calibClust(setup)
+
+
+def test_calib_hier_shard_chains():
+    """seeded runs are reproducible, sharded or not"""
+    for nshards in [1, 2]:
+        outs = []
+        for _ in range(2):
+            setup = make_multi_setup(nmcmc=60)
+            np.random.seed(15)
+            outs.append(sc.calibHier(setup, nshards=nshards))
+        assert np.array_equal(outs[1].theta0, outs[0].theta0)
+        assert np.array_equal(outs[1].Sigma0, outs[0].Sigma0)
+        for i in range(NEXP):
+            assert np.array_equal(outs[1].theta[i], outs[0].theta[i])
+            assert np.array_equal(outs[1].s2[i], outs[0].s2[i])
+
+
+def test_calib_hier_sharded_pooled_models():
+    """shard processes can run models with their own process pools"""
+    outs = []
+    for ncores in [None, 2]:
+        setup = make_multi_setup(nmcmc=40, ncores=ncores)
+        np.random.seed(16)
+        outs.append(sc.calibHier(setup, nshards=2))
+    assert np.array_equal(outs[1].theta0, outs[0].theta0)
+    for i in range(NEXP):
+        assert np.array_equal(outs[1].theta[i], outs[0].theta[i])
+
+
+def set_ladder(setup):
+    # the hottest temperature runs friedman_shifted
+    setup.setFidelityLadder(
+        [0, 0, 1], model_args=[[{"mod": friedman_shifted}] * NEXP]
+    )
+
+
+def test_hier_shard_fidelity_swaps():
+    """states swapped across fidelities carry their predictions and likelihoods at the new level"""
+    for diag_lik in [True, False]:
+        setup = make_multi_setup(nmcmc=5)
+        for model in setup.models:
+            model.diag_lik = diag_lik
+        set_ladder(setup)
+        shard = sc.HierShard(setup, range(NEXP))
+        theta0 = np.full((3, 4), 0.5)
+        Sigma0 = np.tile(np.eye(4) * 0.01, (3, 1, 1))
+        np.random.seed(21)
+        shard.init(theta0, Sigma0)
+        for e in range(
+            NEXP
+        ):  # initial predictions at each temperature's fidelity
+            th = shard.theta[e][0, :, 0]
+            assert np.allclose(shard.pred_curr[e][0], friedman(th[0]))
+            assert np.allclose(shard.pred_curr[e][2], friedman_shifted(th[2]))
+        shard.swap_terms(
+            0, theta0, np.linalg.inv(Sigma0), np.linalg.slogdet(Sigma0)[1]
+        )
+        lik = shard.swap_llik(0, np.array([2, 1]), np.array([0, 1]))
+        shard.swap_apply(0, np.array([0, 2, 1]))
+        for e in range(NEXP):
+            pred = shard.eval(e, shard.theta[e][0])
+            assert np.allclose(shard.pred_curr[e], pred)
+            llik = shard.llik(e, pred, shard.log_s2[e][0])[0]
+            assert np.allclose(shard.llik_curr[e], llik)
+            assert np.allclose(lik[e], llik[1:].sum(axis=1))
+
+
+def test_calib_hier_fidelity_ladder():
+    """hot temperatures of calibHier at a cheaper fidelity, with and without shards"""
+    for nshards in [1, 2]:
+        setup = make_multi_setup(nmcmc=200)
+        setup.setTemperatureLadder(1.05 ** np.arange(3), start_temper=50)
+        set_ladder(setup)
+        np.random.seed(22)
+        out = sc.calibHier(setup, nshards=nshards)
+        assert setup.models[0].mod is friedman
+        if nshards == 1:
+            assert out.count_temper[1, 2] > 0  # swaps between fidelities
+        # current predictions at the fidelity of each temperature, also after swaps
+        for i in range(NEXP):
+            th = out.theta[i][-1, :, 0]
+            assert np.allclose(out.pred_curr[i][:2], friedman_vec(th[:2]))
+            assert np.allclose(out.pred_curr[i][2], friedman_shifted(th[2]))
+
+    # levels that all run the full models give the chains without a ladder
+    outs = []
+    for ladder in [False, True]:
+        setup = make_multi_setup(nmcmc=200)
+        setup.setTemperatureLadder(1.05 ** np.arange(3), start_temper=50)
+        if ladder:
+            setup.setFidelityLadder([0, 0, 1])
+        np.random.seed(23)
+        outs.append(sc.calibHier(setup))
+    assert outs[0].count_temper.sum() > 0
+    assert np.allclose(outs[1].theta0, outs[0].theta0)
+
+    # observation subsets are for calibPool only
+    setup.setFidelityLadder([0, 0, 1], obs=[[np.arange(0, 20, 2)] * NEXP])
+    with np.testing.assert_raises(ValueError):
+        sc.calibHier(setup)
+
+
+def test_calib_clust_cached_predictions():
+    """cluster prediction cache matches a fresh evaluation of the final thetas"""
+    setup = make_setup(nmcmc=80)
+    np.random.seed(16)
+    out = sc.calibClust(setup)
+    theta = out.theta_hist[0][-1]
+    assert theta.shape == (3, NEXP, 4)
+    assert np.allclose(out.pred_curr[0], sc.eval_theta(setup, 0, theta))
+
+
+def test_calib_clust_theta_step_evaluations():
+    """theta steps evaluate the candidates only, not the accepted thetas again"""
+    setup = make_setup(nmcmc=80)
+    model = setup.models[0]
+    nrows = []  # non-pooled rows evaluated (one theta of one experiment each)
+    eval_exp = model.eval_exp
+
+    def eval_counted(parmat, pool=None, nugget=False):
+        if pool is not True:
+            nrows.append(next(iter(parmat.values())).shape[0])
+        return sc.ModelF.eval(model, parmat, pool, nugget)
+
+    def eval_exp_counted(parmat, i):
+        nrows.append(next(iter(parmat.values())).shape[0])
+        return eval_exp(parmat, i)
+
+    model.eval, model.eval_exp = eval_counted, eval_exp_counted
+    np.random.seed(16)
+    sc.calibClust(setup)
+    # initial thetas, then at most one candidate per theta and iteration
+    assert sum(nrows) <= setup.ntemps * NEXP * setup.nmcmc
+
+
+def cluster_covariance_loop(am, n, delta):
+    # sequential pairwise merge of experiment histories into their clusters
+    n_hc = np.zeros((am.ntemps, am.nclustmax))
+    mu_clust = np.zeros((am.ntemps, am.nclustmax, am.p))
+    cov_clust = np.zeros((am.ntemps, am.nclustmax, am.p, am.p))
+    for i in range(am.nexp):
+        for j in range(delta[i].shape[1]):
+            for t in range(am.ntemps):
+                c = delta[i][t, j]
+                n1, m1, m2 = n_hc[t, c], mu_clust[t, c], am.mu_hist[i][t, j]
+                mu_new = (n1 * m1 + n * m2) / (n1 + n)
+                cov_clust[t, c] = (
+                    n1 * cov_clust[t, c]
+                    + n * am.cov_hist[i][t, j]
+                    + n1 * np.outer(m1 - mu_new, m1 - mu_new)
+                    + n * np.outer(m2 - mu_new, m2 - mu_new)
+                ) / (n1 + n)
+                mu_clust[t, c], n_hc[t, c] = mu_new, n1 + n
+    return n_hc, mu_clust, cov_clust
+
+
+def test_cluster_covariance_update():
+    """pooled scatter-add matches the sequential merge; empty clusters stay zero"""
+    np.random.seed(17)
+    ntheta, ntemps, p, nclustmax = [3, 5], 4, 3, 6
+    am = sc.AMcov_clust(2, ntheta, ntemps, p, nclustmax)
+    for i in range(2):
+        am.mu_hist[i][:] = np.random.normal(size=am.mu_hist[i].shape)
+        A = np.random.normal(size=am.cov_hist[i].shape)
+        am.cov_hist[i][:] = A @ np.swapaxes(A, -1, -2)
+    # cluster 5 is never used
+    delta = [
+        np.random.randint(0, nclustmax - 1, size=(ntemps, k)) for k in ntheta
+    ]
+    am.cluster_covariance_update(120, delta)
+    n_hc, mu_clust, cov_clust = cluster_covariance_loop(am, 120, delta)
+    assert np.allclose(am.n_hc, n_hc)
+    assert np.allclose(am.mu_clust, mu_clust)
+    assert np.allclose(am.cov_clust, cov_clust)
+    assert np.all(am.cov_clust[:, -1] == 0)
+    assert np.all(am.mu_clust[:, -1] == 0)
+
+
+def test_calib_clust_aux_clusters():
+    """only occupied clusters and nclust_aux candidates are evaluated"""
+    setup = make_setup(nmcmc=60)
+    setup.setClusterPriors(nclustmax=8, nclust_aux=1)
+    model = setup.models[0]
+    eval_pooled = model.eval
+    nrows = []
+
+    def counting_eval(parmat, pool=True, *args, **kwargs):
+        if pool:
+            nrows.append(len(next(iter(parmat.values()))))
+        return eval_pooled(parmat, pool, *args, **kwargs)
+
+    model.eval = counting_eval
+    np.random.seed(18)
+    out = sc.calibClust(setup)
+    assert nrows[0] == 3 * 8  # initialization
+    # at most NEXP occupied clusters and one candidate per temperature
+    assert max(nrows[1:]) <= 3 * (NEXP + 1)
+    assert np.all(np.isfinite(out.theta[-1]))
+    assert np.allclose(
+        out.pred_curr[0], sc.eval_theta(setup, 0, out.theta_hist[0][-1])
+    )
+
+
+def clust_likelihood_count(setup):
+    # theta likelihoods computed in a calibClust run
+    nlik = []
+    engine_llik = sc.GaussLikSegments.llik
+    model = setup.models[0]
+    model_llik = model.llik
+
+    def counting_engine_llik(engine, sse, log_s2):
+        nlik.append(NEXP * np.prod(sse.shape[:-1]))  # rows of all thetas
+        return engine_llik(engine, sse, log_s2)
+
+    def counting_model_llik(*args):
+        nlik.append(1)
+        return model_llik(*args)
+
+    sc.GaussLikSegments.llik = counting_engine_llik
+    model.llik = counting_model_llik
+    np.random.seed(20)
+    try:
+        sc.calibClust(setup)
+    finally:
+        sc.GaussLikSegments.llik = engine_llik
+    return sum(nlik)
+
+
+def test_calib_clust_aux_likelihoods():
+    """cluster likelihoods are only computed for occupied and candidate clusters"""
+    ntemps, nmcmc = 3, 40
+    for diag_lik in [True, False]:
+        setup = make_setup(nmcmc=nmcmc, diag_lik=diag_lik)
+        setup.setClusterPriors(nclustmax=8, nclust_aux=1)
+        # per iteration: theta candidates and s2 update, then the delta likelihoods
+        # of at most NEXP occupied clusters and one candidate per temperature
+        assert clust_likelihood_count(setup) <= (
+            NEXP * nmcmc * (2 * ntemps + ntemps * (NEXP + 1))
+        )
+
+
+def test_theta_hist_view():
+    """theta_hist gathered on request equals theta at the current clusters"""
+    np.random.seed(19)
+    theta = np.random.normal(size=(6, 3, 5, 2))
+    delta = np.random.randint(0, 5, size=(6, 3, 4)).astype(np.uint8)
+    full = np.take_along_axis(theta, delta[..., None].astype(int), axis=2)
+    view = sc.ThetaHist(theta, delta)
+    assert view.shape == full.shape and len(view) == 6
+    sel = np.array([1, 4, 5])
+    assert np.array_equal(view[3], full[3])
+    assert np.array_equal(view[:4], full[:4])
+    assert np.array_equal(view[sel, 0], full[sel, 0])
+    assert np.array_equal(view[sel, 0, 2, 1], full[sel, 0, 2, 1])
+    assert np.array_equal(view[-1, :, 1:], full[-1, :, 1:])
+    assert np.array_equal(np.asarray(view), full)
+
+    setup = make_setup(nmcmc=20)
+    out = sc.calibClust(setup)
+    assert out.delta[0].dtype == np.uint8
+    assert isinstance(out.theta_hist[0], sc.ThetaHist)
+
+
+def test_am_cholesky_updates():
+    """rank-one maintained proposal factors match the AM covariances through refreshes and tau changes"""
+    np.random.seed(21)
+    L = np.linalg.cholesky(np.cov(np.random.normal(size=(4, 50))))
+    v = np.random.normal(size=(4, 3))
+    up = sc.chol_rank1_update(np.repeat(L[:, :, None], 3, axis=2), v)
+    for k in range(3):
+        assert np.allclose(
+            up[:, :, k] @ up[:, :, k].T, L @ L.T + np.outer(v[:, k], v[:, k])
+        )
+        assert np.allclose(np.triu(up[:, :, k], 1), 0)
+
+    ntemps, ntheta, p, nmcmc = 2, [3, 1], 4, 260
+    xh = [
+        np.cumsum(np.random.normal(size=(nmcmc, ntemps, k, p)), axis=0)
+        for k in ntheta
+    ]
+    hier = sc.AMcov_hier(2, ntheta, ntemps, p, start_adapt_iter=20)
+    for m in range(1, nmcmc):
+        hier.update(xh, m)
+        for i in range(2):
+            # adaptive Metropolis covariance, scaled by exp(tau) as of this update
+            S = np.broadcast_to(np.eye(p) * 1e-4, hier.S[i].shape)
+            if m >= 20:
+                S = (
+                    hier.AM_SCALAR
+                    * (hier.cov[i] + np.eye(p) * hier.eps)
+                    * np.exp(hier.tau[i])[..., None, None]
+                )
+            assert np.allclose(hier.S[i], S)
+        if m % 100 == 0:
+            hier.tau[0] += np.random.normal(size=(ntemps, 3))
+
+
+def test_calib_hier_population_moves():
+    """population proposals in (sharded) hierarchical calibration"""
+    for move, nshards in [("de", 1), ("stretch", 2)]:
+        setup = make_multi_setup(nmcmc=100)
+        setup.setProposal(move)
+        np.random.seed(23)
+        out = sc.calibHier(setup, nshards=nshards)
+        assert isinstance(out.cov_theta_cand, sc.DEprop_hier)
+        for i in range(NEXP):
+            assert np.all(np.isfinite(out.theta[i]))
+            assert out.count[i].sum() > 0
+            assert np.allclose(
+                out.pred_curr[i],
+                friedman_vec(out.theta[i][-1, :, 0]),
+                atol=1e-8,
+            )
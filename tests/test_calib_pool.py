@@ -0,0 +1,562 @@
+import numpy as np
+import pytest
+
+from impala import superCal as sc
+
+from .test_model_eval import friedman, friedman_vec
+
+
+def run_pool(diag_lik, s2, nd=0, nmcmc=200):
+    np.random.seed(20)
+    names = ["a", "b", "c", "d"]
+    s2_ind = np.repeat([0, 1], 10)
+    yobs = friedman(np.random.uniform(size=4)) + np.random.normal(
+        scale=0.1, size=20
+    )
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+    model = sc.ModelF(friedman, names, s2=s2)
+    model.diag_lik = diag_lik
+    setup.addVecExperiments(
+        yobs,
+        model,
+        sd_est=[0.1, 0.2],
+        s2_df=[0, 0],
+        s2_ind=s2_ind,
+        D=np.random.normal(size=(20, nd)) if nd > 0 else None,
+    )
+    setup.setTemperatureLadder(1.1 ** np.arange(3))
+    setup.setMCMC(nmcmc=nmcmc, decor=50)
+    return sc.calibPool(setup)
+
+
+def test_calib_pool_cached_sse():
+    """cached sums of squares give the same chains as full likelihood evaluations"""
+    for s2, nd in [("gibbs", 0), ("MH", 0), ("gibbs", 2)]:
+        fast, slow = run_pool(True, s2, nd), run_pool(False, s2, nd)
+        assert np.allclose(fast.theta, slow.theta)
+        assert np.allclose(fast.s2[0], slow.s2[0])
+        assert np.allclose(fast.llik[1:], slow.llik[1:])
+
+
+def test_calib_pool_fixed_s2():
+    """with s2 = 'fix', the likelihood uses sd_est from the first iteration"""
+    for diag_lik in [True, False]:
+        out = run_pool(diag_lik, "fix", nmcmc=20)
+        assert np.allclose(out.s2[0], np.array([0.1, 0.2]) ** 2)
+        # the cold chain's likelihood at every iteration, held at sd_est
+        np.random.seed(20)
+        yobs = friedman(np.random.uniform(size=4)) + np.random.normal(
+            scale=0.1, size=20
+        )
+        sd = np.repeat([0.1, 0.2], 10)
+        for m in range(1, 20):
+            pred = friedman(out.theta[m, 0])
+            llik = -np.log(sd).sum() - 0.5 * (((yobs - pred) / sd) ** 2).sum()
+            assert np.isclose(out.llik[m], llik)
+
+
+def test_calib_pool_discrepancy_s2():
+    """the Gibbs s2 update uses the residuals left by the current discrepancy"""
+    np.random.seed(22)
+    names = ["a", "b", "c", "d"]
+    D = np.random.normal(size=(20, 2))
+    yobs = (
+        friedman(np.full(4, 0.5))
+        + D @ np.array([3.0, -2.0])
+        + np.random.normal(scale=0.1, size=20)
+    )
+    for diag_lik in [True, False]:
+        setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+        model = sc.ModelF(friedman, names)
+        model.diag_lik = diag_lik
+        setup.addVecExperiments(
+            yobs,
+            model,
+            sd_est=[0.1],
+            s2_df=[0],
+            s2_ind=np.zeros(20, dtype=int),
+            D=D,
+            discrep_tau=100.0,
+        )
+        setup.setTemperatureLadder(np.array([1.0]))
+        setup.setMCMC(nmcmc=4000, decor=100)
+        np.random.seed(1)
+        out = sc.calibPool(setup)
+        # near the noise variance 0.01, not the variance of D @ v
+        assert np.median(out.s2[0][3000:, 0]) < 0.03
+
+
+def test_calib_pool_user_llik():
+    """a user model overriding llik is sampled under its own likelihood"""
+
+    class Laplace(sc.AbstractModel):
+        def __init__(self):
+            self.stochastic = False
+            self.nd = 0
+            self.s2 = "fix"
+            self.constants = None
+
+        def eval(self, parmat, pool=None, nugget=False):
+            return friedman_vec(np.column_stack([parmat[k] for k in "abcd"]))
+
+        def llik(self, yobs, pred, cov):
+            return -0.5 * cov["ldet"] - np.abs(yobs - pred) @ np.sqrt(
+                cov["inv"]
+            )
+
+    np.random.seed(21)
+    yobs = friedman(np.random.uniform(size=4)) + np.random.laplace(
+        scale=0.1, size=20
+    )
+    model = Laplace()
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in "abcd"})
+    setup.addVecExperiments(
+        yobs, model, sd_est=[0.1], s2_df=[0], s2_ind=np.zeros(20, dtype=int)
+    )
+    setup.setTemperatureLadder(np.array([1.0]))
+    setup.setMCMC(nmcmc=50, decor=10)
+    out = sc.calibPool(setup)
+    assert not model.diag_lik
+    pred = model.eval({k: v[-1:] for k, v in out.theta_native.items()})
+    cov = model.lik_cov_inv(np.full(20, 0.01))
+    assert np.isclose(out.llik[-1], model.llik(yobs, pred[0], cov))
+
+
+def test_emulator_refresh():
+    """stochastic models take a new draw every `every` iterations, or with probability prob"""
+
+    class Stochastic(sc.ModelF):
+        def step(self):
+            self.ii += 1
+
+    np.random.seed(23)
+    names = ["a", "b", "c", "d"]
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+    model = Stochastic(friedman, names, s2="fix")
+    model.stochastic, model.ii = True, 0
+    setup.addVecExperiments(
+        friedman(np.random.uniform(size=4))
+        + np.random.normal(scale=0.1, size=20),
+        model,
+        sd_est=[0.1],
+        s2_df=[0],
+        s2_ind=np.zeros(20, dtype=int),
+    )
+    setup.setTemperatureLadder(np.array([1.0]))
+    setup.setMCMC(nmcmc=1001, decor=50)
+    for every, prob in [(0, None), (1.5, None), (1, 0), (1, 1.5)]:
+        with pytest.raises(ValueError):
+            setup.setEmulatorRefresh(every, prob)
+
+    setup.setEmulatorRefresh(every=7)
+    assert [m for m in range(1, 30) if setup.emulatorRefresh(m)] == [
+        7,
+        14,
+        21,
+        28,
+    ]
+    sc.calibPool(setup)
+    assert model.ii == 1000 // 7
+
+    model.ii = 0
+    setup.setEmulatorRefresh(prob=0.2)
+    sc.calibPool(setup)
+    assert abs(model.ii - 0.2 * 1000) < 5 * np.sqrt(1000 * 0.2 * 0.8)
+
+
+def test_calib_pool_population_moves():
+    """de and stretch moves recover a strongly correlated gaussian posterior without warm-up"""
+    A = np.array([[1.0, 1.0], [1.0, 1.05], [0.5, 0.6]])
+    sd = 0.005
+    post_sd = np.sqrt(np.diag(sd**2 * np.linalg.inv(A.T @ A)))
+    for move in ["de", "stretch"]:
+        np.random.seed(22)
+        setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+        setup.addVecExperiments(
+            A @ np.array([0.5, 0.45]),
+            sc.ModelF(lambda th: A @ th, ["a", "b"], s2="fix"),
+            sd_est=[sd],
+            s2_df=[0],
+            s2_ind=np.zeros(3, dtype=int),
+        )
+        setup.setTemperatureLadder(1.2 ** np.arange(3))
+        setup.setMCMC(nmcmc=3000, decor=10**9)
+        setup.setProposal(move)
+        theta = sc.calibPool(setup).theta[750:, 0]
+        assert np.allclose(theta.mean(axis=0), [0.5, 0.45], atol=0.02)
+        assert np.allclose(theta.std(axis=0), post_sd, rtol=0.15)
+        assert np.corrcoef(theta.T)[0, 1] < -0.99
+
+
+def linear_setup(A, y, sd, s2, s2_df):
+    setup = sc.CalibSetup({k: np.array([0, 1]) for k in "ab"[: A.shape[1]]})
+    setup.addVecExperiments(
+        y,
+        sc.ModelF(lambda th: A @ th, list("ab"[: A.shape[1]]), s2=s2),
+        sd_est=[sd],
+        s2_df=[s2_df],
+        s2_ind=np.zeros(A.shape[0], dtype=int),
+    )
+    return setup
+
+
+def test_calib_smc_evidence():
+    """SMC recovers the posterior and log evidence of a linear gaussian model, also with s2
+    integrated out, and runs identically across worker processes"""
+    A = np.array([[1.0, 0.5], [0.2, 1.0], [0.7, 0.3]])
+    sd = 0.02
+    setup = linear_setup(A, A @ np.array([0.4, 0.6]), sd, "fix", 0)
+    np.random.seed(23)
+    out = sc.calibSMC(setup, nparticles=1000)
+    evidence = (
+        -0.5 * (A.shape[0] - A.shape[1]) * np.log(2 * np.pi * sd**2)
+        - 0.5 * np.linalg.slogdet(A.T @ A)[1]
+    )
+    assert out.phi[0] == 0 and out.phi[-1] == 1
+    assert abs(out.log_evidence - evidence) < 0.2
+    assert np.allclose(out.theta.mean(axis=0), [0.4, 0.6], atol=0.005)
+
+    np.random.seed(24)
+    out2 = sc.calibSMC(setup, nparticles=200, nproc=2)
+    np.random.seed(24)
+    out1 = sc.calibSMC(setup, nparticles=200)
+    assert np.allclose(out1.theta, out2.theta)
+    assert out1.log_evidence == out2.log_evidence
+    # fewer particles (and candidates) than worker processes
+    np.random.seed(26)
+    out4 = sc.calibSMC(setup, nparticles=3, nproc=4)
+    np.random.seed(26)
+    out1 = sc.calibSMC(setup, nparticles=3)
+    assert np.allclose(out1.theta, out4.theta)
+
+    # s2 integrated out under IG(2, 2 sd^2), evidence by quadrature over a theta grid
+    A = np.linspace(0.5, 1.5, 8)[:, None]
+    y = 0.3 * A[:, 0] + np.random.normal(scale=0.05, size=8)
+    setup = linear_setup(A, y, 0.05, "gibbs", 4)
+    grid = (np.arange(20000)[:, None] + 0.5) / 20000
+    evidence = np.log(np.exp(sc.smc_llik(setup, grid)).mean())
+    np.random.seed(25)
+    out = sc.calibSMC(setup, nparticles=1000)
+    assert abs(out.log_evidence - evidence) < 0.2
+
+    setup = linear_setup(A, y, 0.05, "gibbs", 0)
+    with np.testing.assert_raises(ValueError):
+        sc.calibSMC(setup)
+
+    # no finite likelihood to reweight by
+    setup = linear_setup(A, y, 0.05, "fix", 0)
+    setup.models[0].mod = lambda th: np.full(A.shape[0], np.nan)
+    with np.testing.assert_raises(ValueError):
+        sc.calibSMC(setup, nparticles=50)
+
+
+def grid_posterior(f, yobs, sd):
+    """posterior mean and sd of (a, b) on a grid over the unit square, for noise sd"""
+    grid = (np.arange(200) + 0.5) / 200
+    a, b = np.meshgrid(grid, grid, indexing="ij")
+    llik = np.array([
+        [-0.5 * ((f([ai, bi]) - yobs) ** 2).sum() / sd**2 for bi in grid]
+        for ai in grid
+    ])
+    w = np.exp(llik - llik.max())
+    w /= w.sum()
+    mean = np.array([(w * a).sum(), (w * b).sum()])
+    return mean, np.sqrt([
+        (w * (a - mean[0]) ** 2).sum(),
+        (w * (b - mean[1]) ** 2).sum(),
+    ])
+
+
+def test_calib_pool_delayed_acceptance():
+    """delayed acceptance with a surrogate keeps the posterior and evaluates the model less"""
+    x = np.linspace(0, 1, 6)
+    f = lambda th: np.sin(6 * th[0] * x) + th[1] * x**2
+    yobs = f(np.array([0.4, 0.5])) + 0.1 * np.random.default_rng(0).normal(
+        size=6
+    )
+    neval = [0]
+
+    def model(th):
+        neval[0] += 1
+        return f(th)
+
+    np.random.seed(30)
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+    setup.addVecExperiments(
+        yobs,
+        sc.ModelF(model, ["a", "b"], s2="fix"),
+        sd_est=[0.1],
+        s2_df=[0],
+        s2_ind=np.zeros(6, dtype=int),
+    )
+    setup.setTemperatureLadder(np.array([1.0]))
+    setup.setMCMC(nmcmc=10000, decor=10**9)
+    setup.setDelayedAcceptance(start=500, neighbors=10)
+    out = sc.calibPool(setup)
+    theta = out.theta[1000:, 0]
+    mean, sd = grid_posterior(f, yobs, 0.1)
+    assert np.allclose(theta.mean(axis=0), mean, atol=0.25 * sd)
+    assert np.allclose(theta.std(axis=0), sd, rtol=0.15)
+    assert out.surrogate.count_pass[0] < out.surrogate.count_screen[0] / 2
+    assert neval[0] < 0.5 * setup.nmcmc
+
+
+def test_calib_pool_fidelity_ladder():
+    """hot chains at a cheaper fidelity leave the cold chain on the full posterior"""
+    x = np.linspace(0, 1, 8)
+    f = lambda th: np.sin(6 * th[0] * x) + th[1] * x**2
+    yobs = f(np.array([0.4, 0.5])) + 0.1 * np.random.default_rng(0).normal(
+        size=8
+    )
+    np.random.seed(31)
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+    model = sc.ModelF(
+        lambda th: f(th) + model.bias * x**2, ["a", "b"], s2="fix"
+    )
+    model.bias = 0.0
+    setup.addVecExperiments(
+        yobs, model, sd_est=[0.1], s2_df=[0], s2_ind=np.zeros(8, dtype=int)
+    )
+    setup.setTemperatureLadder(1.5 ** np.arange(4), start_temper=100)
+    setup.setMCMC(nmcmc=10000, decor=10**9)
+    with np.testing.assert_raises(ValueError):
+        setup.setFidelityLadder([0, 1, 0, 1])
+    setup.setFidelityLadder(
+        [0, 0, 1, 1], model_args=[[{"bias": 0.5}]], obs=[[np.arange(0, 8, 2)]]
+    )
+    out = sc.calibPool(setup)
+    assert model.bias == 0.0
+    assert out.count[0, 2] + out.count[1, 3] > 0  # swaps between fidelities
+
+    # the cold chain likelihood is always the full one, also after swaps
+    sse = np.array([((f(th) - yobs) ** 2).sum() for th in out.theta[1:, 0]])
+    assert np.allclose(out.llik[1:], -0.5 * (8 * np.log(0.01) + sse / 0.01))
+    th = out.theta[-1, 3]
+    pred = out.pred_curr[0][3]
+    assert np.allclose(pred[::2], (f(th) + 0.5 * x**2)[::2])
+    assert np.array_equal(pred[1::2], yobs[1::2])  # not predicted at level 1
+
+    mean, sd = grid_posterior(f, yobs, 0.1)
+    theta = out.theta[1000:, 0]
+    assert np.allclose(theta.mean(axis=0), mean, atol=0.25 * sd)
+    assert np.allclose(theta.std(axis=0), sd, rtol=0.15)
+
+
+def test_calib_pool_fidelity_obs_evaluated():
+    """levels with a subset of the observations only evaluate those"""
+    x = np.linspace(0, 1, 8)
+    keep = np.arange(0, 8, 2)
+    nobs = {}  # observations evaluated per level
+
+    def f_obs(th, idx):
+        pred = np.sin(6 * th[:, :1] * x[idx]) + th[:, 1:2] * x[idx] ** 2
+        level = int(pred.shape[1] < x.shape[0])
+        nobs[level] = nobs.get(level, 0) + pred.size
+        return pred
+
+    yobs = f_obs(np.array([[0.4, 0.5]]), slice(None))[0]
+    np.random.seed(33)
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+    model = sc.ModelF_bigdata(
+        lambda th: f_obs(th, slice(None)),
+        ["a", "b"],
+        vectorized=True,
+        f_obs=f_obs,
+        s2="fix",
+    )
+    setup.addVecExperiments(
+        yobs, model, sd_est=[0.1], s2_df=[0], s2_ind=np.zeros(8, dtype=int)
+    )
+    setup.setTemperatureLadder(1.5 ** np.arange(4), start_temper=50)
+    setup.setMCMC(nmcmc=200, decor=10**9)
+    setup.setFidelityLadder([0, 0, 1, 1], obs=[[keep]])
+    out = sc.calibPool(setup)
+    assert model.obs_keep is None
+    assert nobs[0] % 8 == 0 and nobs[1] % 4 == 0
+    assert nobs[1] >= 4 * 2 * setup.nmcmc  # two level 1 chains
+    assert np.array_equal(out.pred_curr[0][2][1::2], yobs[1::2])
+
+
+def test_calib_pool_early_rejection():
+    """early rejection accepts the same proposals while skipping experiment evaluations"""
+
+    def run(order, diag_lik):
+        np.random.seed(21)
+        names = ["a", "b", "c", "d"]
+        theta0 = np.random.uniform(size=4)
+        setup = sc.CalibSetup({k: np.array([0, 1]) for k in names})
+        for j in range(3):
+            model = sc.ModelF(friedman, names, s2=["gibbs", "fix", "MH"][j])
+            model.diag_lik = diag_lik
+            setup.addVecExperiments(
+                friedman(theta0) + np.random.normal(scale=0.1, size=20),
+                model,
+                sd_est=[0.1],
+                s2_df=[0],
+                s2_ind=np.zeros(20, dtype=int),
+            )
+        setup.setTemperatureLadder(1.1 ** np.arange(3))
+        setup.setMCMC(nmcmc=500, decor=50, start_adapt_iter=100)
+        setup.setEarlyRejection(order)
+        return sc.calibPool(setup)
+
+    for diag_lik in [True, False]:
+        ref = run(None, diag_lik)
+        for order in ["auto", [2, 0, 1]]:
+            out = run(order, diag_lik)
+            assert np.allclose(out.theta, ref.theta)
+            assert np.allclose(out.llik, ref.llik)
+            early = out.early_reject
+            assert early.count_eval.sum() < 3 * early.count_cand
+            assert early.count_eval.max() == early.count_cand
+
+
+def test_calib_pool_subsampling():
+    """subsampled acceptance tests recover the posterior of a large data set from few observations"""
+    n = 10000
+    x = np.linspace(0, 1, n)
+
+    def f_obs(th, idx):
+        th = np.atleast_2d(th)
+        return np.sin(3 * th[:, :1] * x[idx]) + th[:, 1:2] * x[idx] ** 2
+
+    theta0 = np.array([0.4, 0.5])
+    yobs = f_obs(theta0, slice(None))[0] + np.random.default_rng(0).normal(
+        scale=0.2, size=n
+    )
+    np.random.seed(32)
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+    model = sc.ModelF_bigdata(
+        lambda th: f_obs(th, slice(None)),
+        ["a", "b"],
+        vectorized=True,
+        f_obs=f_obs,
+        s2="fix",
+    )
+    setup.addVecExperiments(
+        yobs, model, sd_est=[0.2], s2_df=[0], s2_ind=np.zeros(n, dtype=int)
+    )
+    setup.setTemperatureLadder(np.array([1.0]))
+    setup.setMCMC(nmcmc=10000, decor=10**9)
+    setup.setSubsampling(start=1000, batch=200)
+    out = sc.calibPool(setup)
+    theta = out.theta[2000:, 0]
+
+    # gaussian approximation at the least squares fit
+    jac = np.column_stack([3 * x * np.cos(3 * 0.4 * x), x**2])
+    cov = 0.04 * np.linalg.inv(jac.T @ jac)
+    fit = theta0 + cov @ jac.T @ (yobs - f_obs(theta0, slice(None))[0]) / 0.04
+    sd = np.sqrt(np.diag(cov))
+    assert np.allclose(theta.mean(axis=0), fit, atol=0.3 * sd)
+    assert np.allclose(theta.std(axis=0), sd, rtol=0.2)
+    sub = out.subsample
+    assert sub.count_obs < 0.1 * n * sub.count_test
+    assert sub.count_exact < 0.1 * sub.count_test
+
+    setup.setEarlyRejection()
+    with pytest.raises(ValueError):
+        sc.calibPool(setup)
+    # without f_obs each batch would be a full evaluation
+    setup.setEarlyRejection(None)
+    model.f_obs = None
+    model.subset_eval = False
+    with pytest.raises(ValueError):
+        sc.calibPool(setup)
+
+
+def test_calib_pool_coreset():
+    """a weighted coreset of a smooth curve recovers the full data posterior, s2 included"""
+    n = 2000
+    x = np.linspace(0, 1, n)
+
+    def f(th):
+        th = np.atleast_2d(th)
+        return np.sin(3 * th[:, :1] * x) + th[:, 1:2] * x**2
+
+    theta0 = np.array([0.4, 0.5])
+    yobs = f(theta0)[0] + np.random.default_rng(0).normal(scale=0.2, size=n)
+    np.random.seed(33)
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])})
+    setup.addVecExperiments(
+        yobs,
+        sc.ModelF(f, ["a", "b"], vectorized=True),
+        sd_est=[0.2],
+        s2_df=[0],
+        s2_ind=np.zeros(n, dtype=int),
+    )
+    setup.setTemperatureLadder(np.array([1.0]))
+    setup.setMCMC(nmcmc=6000, decor=10**9)
+    setup.setCoreset(100)
+    assert setup.y_lens[0] <= 100
+    assert np.isclose(setup.ny_s2[0][0], n)
+    assert setup.models[0].cached_eval({
+        "a": np.array([0.3]),
+        "b": np.array([0.6]),
+    }).shape == (1, setup.y_lens[0])
+    out = sc.calibPool(setup)
+    theta = out.theta[1000:, 0]
+
+    # gaussian approximation at the least squares fit
+    jac = np.column_stack([3 * x * np.cos(3 * 0.4 * x), x**2])
+    cov = 0.04 * np.linalg.inv(jac.T @ jac)
+    fit = theta0 + cov @ jac.T @ (yobs - f(theta0)[0]) / 0.04
+    sd = np.sqrt(np.diag(cov))
+    assert np.allclose(theta.mean(axis=0), fit, atol=0.3 * sd)
+    assert np.allclose(theta.std(axis=0), sd, rtol=0.2)
+    assert np.isclose(out.s2[0][1000:, 0].mean(), 0.04, rtol=0.1)
+
+    w = sc.coresetReweight(setup, out, np.arange(1000, 6000))
+    assert np.isclose(w.sum(), 1)
+    assert 1 / (w * w).sum() > 0.5 * w.shape[0]
+    assert setup.models[0].obs_keep.shape == (setup.y_lens[0],)
+
+
+def test_linear_constraints():
+    """linear constraints on the unit scale match the native constraint functions"""
+    np.random.seed(34)
+    bounds = {
+        "theta": np.array([1e-4, 0.2]),
+        "p": np.array([1e-4, 5.0]),
+        "s0": np.array([1e-4, 0.05]),
+        "sInf": np.array([1e-4, 0.05]),
+        "y0": np.array([1e-4, 0.05]),
+        "yInf": np.array([1e-4, 0.04]),
+        "y1": np.array([1e-3, 0.1]),
+        "y2": np.array([0.3, 1.0]),
+    }
+    theta = np.random.uniform(-0.05, 1.05, size=(5000, 8))
+    native = sc.tran_unif(theta, np.array(list(bounds.values())), bounds)
+    for cf in ["bounds", sc.constraints_ptw, lambda x, b, c: x["y2"] > 0.6]:
+        setup = sc.CalibSetup(bounds, cf)
+        setup.constants = {"beta": 0.33}
+        good = setup.checkConstraintsUnit(theta.reshape(50, 100, 8))
+        assert good.dtype == bool and good.shape == (50, 100)
+        assert np.array_equal(good.ravel(), setup.checkConstraints(native))
+    assert 0 < good.sum() < 5000
+
+    # x + 2 y < 1
+    lin = sc.LinearConstraints([[1.0, 2.0]], [1.0], ["a", "b"])
+    setup = sc.CalibSetup({"a": np.array([0, 1]), "b": np.array([0, 1])}, lin)
+    setup.addVecExperiments(
+        np.array([0.2, 0.1]),
+        sc.ModelF(lambda th: th, ["a", "b"], s2="fix"),
+        sd_est=[0.5],
+        s2_df=[0],
+        s2_ind=np.zeros(2, dtype=int),
+    )
+    setup.setTemperatureLadder(1.1 ** np.arange(3))
+    setup.setMCMC(nmcmc=500, decor=50)
+    out = sc.calibPool(setup)
+    assert np.all(out.theta @ np.array([1.0, 2.0]) < 1)
+    with pytest.raises(ValueError):
+        sc.LinearConstraints([[1.0, 2.0]], [1.0], ["a", "c"]).unit(setup.bounds)
+
+    # a + c < 1 follows in-place changes of the constant c
+    setup = sc.CalibSetup(
+        {"a": np.array([0, 1]), "b": np.array([0, 1])},
+        sc.LinearConstraints([[1.0, 1.0]], [1.0], ["a", "c"]),
+    )
+    setup.constants = {"c": 0.0}
+    assert setup.checkConstraintsUnit(np.array([0.8, 0.5]))
+    setup.constants["c"] = 0.5
+    assert not setup.checkConstraintsUnit(np.array([0.8, 0.5]))
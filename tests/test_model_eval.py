@@ -0,0 +1,450 @@
+import pickle
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from impala import superCal as sc
+
+
+def friedman(theta):
+    grid = np.linspace(0, 1, 20)
+    return (
+        10 * np.sin(np.pi * grid * theta[0])
+        + 20 * (theta[1] - 0.5) ** 2
+        + 10 * theta[2]
+        + 5 * theta[3]
+    )
+
+
+def friedman_vec(theta):
+    grid = np.linspace(0, 1, 20)
+    return (
+        10 * np.sin(np.pi * np.outer(theta[:, 0], grid))
+        + (20 * (theta[:, 1] - 0.5) ** 2 + 10 * theta[:, 2] + 5 * theta[:, 3])[
+            :, None
+        ]
+    )
+
+
+def random_parmat(names, n):
+    return {k: np.random.uniform(size=n) for k in names}
+
+
+def test_modelf_vectorized_and_pool():
+    """vectorized functions and worker pools should match row-by-row evaluation"""
+    np.random.seed(0)
+    names = ["a", "b", "c", "d"]
+    parmat = random_parmat(names, 9)
+    ref = sc.ModelF(friedman, names).eval(parmat, pool=True)
+
+    models = [
+        sc.ModelF(friedman_vec, names, vectorized=True),
+        sc.ModelF(friedman, names, ncores=2),
+        sc.ModelF(friedman, names, ncores=2, backend="thread", chunksize=2),
+        sc.ModelF_bigdata(friedman_vec, names, vectorized=True),
+        sc.ModelF_bigdata(friedman, names, ncores=2),
+    ]
+    for model in models:
+        assert np.allclose(model.eval(parmat, pool=True), ref)
+        # setups holding models are pickled by calibPoolParallel
+        pickle.loads(pickle.dumps(model))
+        model.close()
+
+
+def test_modelf_hier_vectorized():
+    """hierarchical (pool=False) evaluation with a vectorized function"""
+    np.random.seed(1)
+    names = ["a", "b", "c", "d"]
+    exp_ind = np.repeat([0, 1], 10)
+    parmat = random_parmat(names, 6)
+    ref = sc.ModelF(friedman, names, exp_ind=exp_ind).eval(parmat, pool=False)
+    out = sc.ModelF(friedman_vec, names, exp_ind=exp_ind, vectorized=True).eval(
+        parmat, pool=False
+    )
+    assert out.shape == (3, 20)
+    assert np.allclose(out, ref)
+
+
+def friedman_exp(theta, i):
+    # friedman outputs of experiment i, for exp_ind = np.repeat([0, 1], 10)
+    return friedman(theta)[10 * i : 10 * i + 10]
+
+
+class BasisEmulator:
+    """linear stand-in with the layout of a pyBASS / pyBayesPPR basis (PCA) emulator"""
+
+    class Coef:
+        def __init__(self, w):
+            self.w = w
+            self.samples = type(
+                "samples", (), {"s2": np.ones(3), "sdResid": np.ones(3)}
+            )
+
+        def predict(self, X, mcmc_use=None, nugget=False):
+            return (X @ self.w)[None]
+
+    def __init__(self, p, ny, nbasis):
+        self.nbasis = nbasis
+        self.bm_list = [
+            self.Coef(np.random.normal(size=p)) for _ in range(nbasis)
+        ]
+        self.basis = np.random.normal(size=(ny, nbasis))
+        self.y_mean = np.random.normal(size=ny)
+        self.y_sd = 2.0
+        self.trunc_error = np.random.normal(size=(ny, 5))
+
+    def predict(self, X, mcmc_use=None, nugget=False):
+        coefs = np.dstack([
+            bm.predict(X, mcmc_use, nugget) for bm in self.bm_list
+        ])
+        return coefs @ self.basis.T * self.y_sd + self.y_mean
+
+
+def test_hier_eval_own_experiment():
+    """non-pooled evaluation computes each theta on its own experiment's outputs only"""
+    np.random.seed(8)
+    names = ["a", "b", "c", "d"]
+    exp_ind = np.repeat([0, 1], 10)
+    parmat = random_parmat(names, 6)
+    rows = np.arange(6).reshape(3, 2).T
+    ref = sc.ModelF(friedman, names).eval(parmat, pool=True)
+    ref = np.concatenate([ref[rows[0], :10], ref[rows[1], 10:]], 1)
+
+    models = [
+        sc.ModelF(friedman, names, f_exp=friedman_exp),
+        sc.ModelF(friedman, names, f_exp=friedman_exp, ncores=2),
+        sc.ModelF_bigdata(friedman, names, f_exp=friedman_exp),
+        sc.ModelF(friedman, names),
+    ]
+    for model in models:
+        model.exp_ind = exp_ind  # as set by CalibSetup.addVecExperiments
+        assert np.allclose(model.eval(parmat, pool=False), ref)
+        model.close()
+
+    emu = BasisEmulator(4, 20, 3)
+    full = emu.predict(np.vstack([parmat[v] for v in names]).T)[0]
+    ref = np.concatenate([full[rows[0], :10], full[rows[1], 10:]], 1)
+    for Model in [
+        sc.ModelBassPca_mult,
+        sc.ModelBassPca_func,
+        sc.ModelBpprPca_mult,
+        sc.ModelBpprPca_func,
+    ]:
+        model = Model(emu, names, exp_ind=exp_ind)
+        assert np.allclose(model.eval(parmat, pool=False), ref)
+        assert np.allclose(model.eval(parmat, pool=True), full)
+
+
+def check_pca_fit(emu, Models):
+    # model evaluations at posterior draw ii against the library's own predict
+    np.random.seed(10)
+    names = ["a", "b", "c", "d"]
+    exp_ind = np.repeat([0, 1], 10)
+    parmat = random_parmat(names, 6)
+    rows = np.arange(6).reshape(3, 2).T
+    for Model in Models:
+        model = Model(emu, names, exp_ind=exp_ind)
+        model.ii = 3
+        full = emu.predict(
+            np.vstack([parmat[v] for v in names]).T, mcmc_use=np.array([3])
+        )[0]
+        ref = np.concatenate([full[rows[0], :10], full[rows[1], 10:]], 1)
+        assert np.allclose(model.eval(parmat, pool=False), ref)
+        assert np.allclose(model.eval(parmat, pool=True), full)
+        for i in range(2):
+            assert np.allclose(
+                model.eval_exp(parmat, i), full[:, 10 * i : 10 * i + 10]
+            )
+
+
+def test_bass_pca_eval():
+    """BASS emulator models match pyBASS predictions of a small fit"""
+    pb = pytest.importorskip("pyBASS")
+    np.random.seed(9)
+    X = np.random.uniform(size=(100, 4))
+    emu = pb.bassPCA(X, friedman_vec(X), npc=3, nmcmc=1000, nburn=900, thin=10)
+    check_pca_fit(emu, [sc.ModelBassPca_mult, sc.ModelBassPca_func])
+
+
+def test_bppr_pca_eval():
+    """BayesPPR emulator models match pyBayesPPR predictions of a small fit"""
+    pbppr = pytest.importorskip("pyBayesPPR")
+    np.random.seed(9)
+    X = np.random.uniform(size=(100, 4))
+    emu = pbppr.bpprPCA(
+        X, friedman_vec(X), npc=3, n_post=10, n_burn=900, n_thin=1
+    )
+    check_pca_fit(emu, [sc.ModelBpprPca_mult, sc.ModelBpprPca_func])
+
+
+def test_material_strength_eval_exp():
+    """single-experiment strength model runs match the pooled run"""
+    consts = {
+        "alpha": 0.84,
+        "beta": 0.33,
+        "matomic": 45.9,
+        "chi": 1.0,
+        "G0": 0.44,
+        "rho0": 4.419,
+        "rho_0": 4.45,
+        "gamma_1": 2.2,
+        "gamma_2": -4.7,
+        "q2": 0.8,
+        "c0": 4.730036e-05,
+        "tm0": -3925.796,
+        "tm1": 1448.2,
+        "r0": 4.426741,
+        "c1": 1.371e-8,
+        "r1": -2.5965e-5,
+    }
+    params = {
+        "theta": 0.1,
+        "p": 2.0,
+        "s0": 0.02,
+        "sInf": 0.01,
+        "kappa": 0.3,
+        "lgamma": -12.0,
+        "y0": 0.01,
+        "yInf": 0.003,
+        "y1": 0.09,
+        "y2": 0.7,
+    }
+    parmat = {k: v * np.array([1.0, 1.01, 0.99]) for k, v in params.items()}
+    strains = [np.linspace(0.01, 0.5, 30), np.linspace(0.01, 0.3, 20)]
+    model = sc.ModelMaterialStrength(
+        temps=np.array([1000.0, 700.0]),
+        edots=np.array([2500.0, 1000.0]) * 1e-6,
+        consts=consts,
+        strain_histories=strains,
+        flow_stress_model="PTW_Yield_Stress",
+        melt_model="Linear_Melt_Temperature",
+        shear_model="BGP_PW_Shear_Modulus",
+        specific_heat_model="Linear_Specific_Heat",
+        density_model="Linear_Density",
+    )
+    pooled = model.eval(parmat, pool=True)
+    assert pooled.shape == (3, 50)
+    assert np.allclose(model.eval_exp(parmat, 0), pooled[:, :30])
+    assert np.allclose(model.eval_exp(parmat, 1), pooled[:, 30:])
+
+    # kept strains, including each history's last so the simulations are unchanged
+    keep = np.array([0, 5, 29, 31, 40, 49])
+    model.setObservations(keep)
+    assert np.allclose(model.eval(parmat, pool=True), pooled[:, keep])
+    assert np.allclose(model.eval_exp(parmat, 1), pooled[:, keep[3:]])
+    model.setObservations(None)
+    assert np.allclose(model.eval(parmat, pool=True), pooled)
+
+
+def test_bigdata_chunked_likelihood():
+    """blocked likelihood, s2 statistics and discrepancy match unblocked"""
+    np.random.seed(2)
+    n, nd = 1003, 3
+    yobs = np.random.normal(size=n)
+    pred = np.random.normal(size=(4, n))
+    s2_ind = np.random.randint(0, 2, size=n)
+    D = np.random.normal(size=(n, nd))
+    full = sc.ModelF_bigdata(friedman, ["a"])
+    blocked = sc.ModelF_bigdata(friedman, ["a"], obs_chunk=100)
+    for model in [full, blocked]:
+        model.D = D
+        model.nd = nd
+        model.discrep_tau = np.ones(nd)
+    cov = full.lik_cov_inv(np.array([0.5, 2.0])[s2_ind])
+    assert np.isclose(
+        full.llik(yobs, pred[0], cov), blocked.llik(yobs, pred[0], cov)
+    )
+    assert np.allclose(
+        full.dev_sq(yobs, pred, s2_ind, 2),
+        blocked.dev_sq(yobs, pred, s2_ind, 2),
+    )
+    assert np.allclose(
+        full.dev_sq(yobs, pred, s2_ind, 2),
+        sc.AbstractModel.dev_sq(full, yobs, pred, s2_ind, 2),
+    )
+    np.random.seed(3)
+    d_full = full.discrep_sample(yobs, pred[0], cov, 1.0)
+    np.random.seed(3)
+    d_blocked = blocked.discrep_sample(yobs, pred[0], cov, 1.0)
+    assert np.allclose(d_full, d_blocked)
+
+
+def test_discrep_sample_batch():
+    """batched discrepancy draws: diagonal and dense covariances agree"""
+    np.random.seed(4)
+    n, nd, ntemps = 50, 3, 4
+    yobs = np.random.normal(size=n)
+    preds = np.random.normal(size=(ntemps, n))
+    itemps = 1 / 1.1 ** np.arange(ntemps)
+    model = sc.ModelF(friedman, ["a"])
+    model.D = np.random.normal(size=(n, nd))
+    model.nd = nd
+    model.discrep_tau = 2.0
+    covs = [model.lik_cov_inv(np.full(n, 0.1 * (t + 1))) for t in range(ntemps)]
+    dense = [{"inv": np.diag(c["inv"]), "ldet": c["ldet"]} for c in covs]
+
+    np.random.seed(5)
+    d_diag = model.discrep_sample_batch(yobs, preds, covs, itemps)
+    np.random.seed(5)
+    d_dense = model.discrep_sample_batch(yobs, preds, dense, itemps)
+    assert d_diag.shape == (ntemps, nd)
+    assert np.allclose(d_diag, d_dense)
+
+    # posterior mean is recovered as the temperature goes to zero
+    d_cold = model.discrep_sample_batch(
+        yobs, preds, covs, np.full(ntemps, 1e12)
+    )
+    for t in range(ntemps):
+        W = dense[t]["inv"]
+        prec = np.eye(nd) / model.discrep_tau + model.D.T @ W @ model.D
+        mean = np.linalg.solve(prec, model.D.T @ W @ (yobs - preds[t]))
+        assert np.allclose(d_cold[t], mean, atol=1e-5)
+
+    # cached D^T W D is not reused for a new basis with the same covariances
+    model.D = 2 * model.D
+    d_cold = model.discrep_sample_batch(
+        yobs, preds, covs, np.full(ntemps, 1e12)
+    )
+    for t in range(ntemps):
+        W = dense[t]["inv"]
+        prec = np.eye(nd) / model.discrep_tau + model.D.T @ W @ model.D
+        mean = np.linalg.solve(prec, model.D.T @ W @ (yobs - preds[t]))
+        assert np.allclose(d_cold[t], mean, atol=1e-5)
+
+
+def test_discrep_sparse_basis():
+    """a scipy.sparse discrepancy basis gives the same draws as the dense one"""
+    np.random.seed(6)
+    n, nd, ntemps = 60, 6, 3
+    yobs = np.random.normal(size=n)
+    preds = np.random.normal(size=(ntemps, n))
+    D = np.kron(np.eye(nd), np.ones((n // nd, 1)))  # piecewise constant basis
+    models = [
+        sc.ModelF(friedman, ["a"]),
+        sc.ModelF_bigdata(friedman, ["a"]),
+        sc.ModelF_bigdata(friedman, ["a"], obs_chunk=7),
+    ]
+    for model in models:
+        draws = []
+        for basis in [D, scipy.sparse.csr_matrix(D)]:
+            # fresh covariances, so D^T W D is computed from this basis
+            covs = [model.lik_cov_inv(np.full(n, 0.5)) for t in range(ntemps)]
+            model.D = basis
+            model.nd = nd
+            model.discrep_tau = 1.0
+            np.random.seed(7)
+            draws.append(
+                model.discrep_sample_batch(yobs, preds, covs, np.ones(ntemps))
+            )
+        assert np.allclose(draws[0], draws[1])
+
+
+def test_eval_cache():
+    """cached pooled evaluations match direct ones and only evaluate unseen rows"""
+    np.random.seed(4)
+    names = ["a", "b", "c", "d"]
+    nrows = []
+
+    def f(x):
+        nrows.append(x.shape[0])
+        return friedman_vec(x)
+
+    model = sc.ModelF(f, names, vectorized=True)
+    model.setEvalCache(maxsize=6)
+    parmat = random_parmat(names, 4)
+    ref = friedman_vec(np.column_stack([parmat[k] for k in names]))
+    assert np.allclose(model.cached_eval(parmat), ref)
+    # partial hits: two new rows (one repeated) in a batch of five
+    new = random_parmat(names, 1)
+    batch = {
+        k: np.r_[parmat[k][:2], new[k], parmat[k][3], new[k]] for k in names
+    }
+    assert np.allclose(
+        model.cached_eval(batch),
+        friedman_vec(np.column_stack([batch[k] for k in names])),
+    )
+    assert nrows == [4, 1]
+    # eval itself is never cached
+    model.eval(parmat, pool=True)
+    assert nrows[-1] == 4
+    assert (model.eval_cache.hits, model.eval_cache.misses) == (4, 5)
+    # least recently used rows are dropped beyond maxsize
+    assert len(model.eval_cache.store) == 5
+    model.cached_eval(random_parmat(names, 2))
+    model.cached_eval({k: v[2:3] for k, v in parmat.items()})
+    assert nrows[-1] == 1
+    # non-pooled evaluations bypass the cache
+    model.cached_eval(parmat, pool=False)
+    assert nrows[-1] == 4
+    model.setEvalCache(None)
+    model.cached_eval(parmat)
+    assert nrows[-1] == 4
+
+    # emulator draws and model settings are part of the key
+    model = sc.ModelF(friedman, names)
+    model.setEvalCache()
+    model.cached_eval(parmat)
+    copy = pickle.loads(pickle.dumps(model))
+    assert np.allclose(copy.cached_eval(parmat), ref)
+    assert copy.eval_cache.hits == 4
+    model.setEvalCache()
+    model.stochastic, model.ii = True, 0
+    model.cached_eval(parmat)
+    model.ii = 1
+    model.cached_eval(parmat)
+    assert model.eval_cache.hits == 0
+    model.eval_tag = 1
+    model.cached_eval(parmat)
+    assert model.eval_cache.hits == 0
+
+
+def test_cached_eval_subclass_super():
+    """an eval override calling super().eval is cached and subset once by cached_eval"""
+    np.random.seed(5)
+    names = ["a", "b", "c", "d"]
+
+    class Shifted(sc.ModelF):
+        def eval(self, parmat, pool=None, nugget=False):
+            return super().eval(parmat, pool, nugget) + 1.0
+
+    model = Shifted(friedman_vec, names, vectorized=True)
+    model.exp_ind = np.zeros(20, dtype=int)
+    parmat = random_parmat(names, 3)
+    ref = friedman_vec(np.column_stack([parmat[k] for k in names])) + 1.0
+    model.setEvalCache()
+    assert np.allclose(model.cached_eval(parmat), ref)
+    assert len(model.eval_cache.store) == 3
+    assert np.allclose(model.cached_eval(parmat), ref)
+    assert model.eval_cache.hits == 3
+    model.setObservations([1, 3, 5])
+    assert np.allclose(model.cached_eval(parmat), ref[:, [1, 3, 5]])
+    assert np.allclose(model.cached_eval(parmat, pool=False), ref[:, [1, 3, 5]])
+    # eval keeps its plain meaning
+    assert np.allclose(model.eval(parmat, pool=True), ref)
+
+
+def test_eval_exp_default_observations():
+    """cached_eval subsets each experiment's eval_exp block to the kept observations"""
+
+    class Plain(sc.AbstractModel):
+        def __init__(self):
+            self.stochastic = False
+
+        def eval(self, parmat, pool=None, nugget=False):
+            return friedman_vec(np.column_stack([parmat[k] for k in "abcd"]))
+
+    np.random.seed(6)
+    model = Plain()
+    model.exp_ind = np.repeat([0, 1], 10)
+    parmat = random_parmat("abcd", 3)
+    full = model.eval(parmat, pool=True)
+    assert np.allclose(model.eval_exp(parmat, 1), full[:, 10:])
+    model.setObservations([0, 2, 16, 18])
+    assert np.allclose(model.cached_eval(parmat), full[:, [0, 2, 16, 18]])
+    assert np.allclose(model.cached_eval(parmat, i=0), full[:, [0, 2]])
+    assert np.allclose(model.cached_eval(parmat, i=1), full[:, [16, 18]])
+    model.setEvalCache()
+    assert np.allclose(model.cached_eval(parmat, i=1), full[:, [16, 18]])
+    assert np.allclose(model.cached_eval(parmat, i=1), full[:, [16, 18]])
+    assert model.eval_cache.hits == 3